@@ -0,0 +1,92 @@
+# generate.py
+"""
+Синтетическая база для бенчмарков: users пользователей, по habits привычек,
+days дней истории. Запуск: python -m benchmarks.generate [PATH] [--users=N] [--habits=N] [--days=N]
+По умолчанию база создаётся во временном каталоге (DEFAULT_DB), а не в дереве проекта.
+"""
+import asyncio
+import datetime
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+
+from data.db import ALL_DAYS, Database
+
+DEFAULT_DB = os.path.join(tempfile.gettempdir(), "habits-bench.db")
+
+
+async def generate(
+    path: str,
+    users: int = 1000,
+    habits: int = 5,
+    days: int = 365,
+    done_ratio: float = 0.6,
+    reminder_ratio: float = 0.5,
+    seed: int = 1,
+) -> dict:
+    """
+    Пересоздаёт базу по path (схема — через миграции Database) и заполняет её.
+    Прогресс пишется только за прошлые дни, чтобы сегодня было что отмечать.
+    """
+    rnd = random.Random(seed)
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+    db = Database(path)
+    await db.connect()
+    await db.close()
+
+    today = datetime.date.today()
+    conn = sqlite3.connect(path)
+    habit_rows = []
+    progress_rows = []
+    with conn:
+        conn.executemany(
+            "INSERT INTO users (id, chat_id, username) VALUES (?, ?, ?)",
+            ((uid, uid, f"user{uid}") for uid in range(1, users + 1)),
+        )
+        habit_id = 0
+        for uid in range(1, users + 1):
+            for i in range(habits):
+                habit_id += 1
+                weekly = rnd.random() < 0.3
+                mask = rnd.randint(1, ALL_DAYS) if weekly else ALL_DAYS
+                reminder = f"{rnd.randrange(24):02d}:{rnd.randrange(60):02d}" if rnd.random() < reminder_ratio else None
+                habit_rows.append((habit_id, uid, f"habit {i + 1}", "weekly" if weekly else "daily", mask, reminder))
+                for k in range(1, days + 1):
+                    d = today - datetime.timedelta(days=k)
+                    if mask & (1 << d.weekday()) and rnd.random() < done_ratio:
+                        progress_rows.append((habit_id, d.isoformat()))
+        conn.executemany(
+            "INSERT INTO habits (id, user_id, name, frequency, schedule_mask, reminder_time) VALUES (?, ?, ?, ?, ?, ?)",
+            habit_rows,
+        )
+        conn.executemany("INSERT INTO progress (habit_id, date, status) VALUES (?, ?, 1)", progress_rows)
+    conn.close()
+
+    db = Database(path)
+    await db.connect()
+    try:
+        await db.rebuild_habit_stats()
+    finally:
+        await db.close()
+    return {"users": users, "habits": len(habit_rows), "progress": len(progress_rows), "days": days}
+
+
+def _parse_args(argv):
+    path = DEFAULT_DB
+    opts = {}
+    for arg in argv:
+        if arg.startswith("--") and "=" in arg:
+            key, value = arg[2:].split("=", 1)
+            opts[key.replace("-", "_")] = float(value) if "." in value else int(value)
+        else:
+            path = arg
+    return path, opts
+
+
+if __name__ == "__main__":
+    path, opts = _parse_args(sys.argv[1:])
+    print(asyncio.run(generate(path, **opts)))
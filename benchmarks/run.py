@@ -0,0 +1,274 @@
+# run.py
+"""
+Бенчмарк обработчиков bot.py без сети: обновления идут через dp.feed_update,
+Bot API заменён заглушкой. Результат — JSON с p50/p99 и числом SQL-запросов на команду.
+
+    python -m benchmarks.run [--users=1000] [--habits=5] [--days=365] [--iterations=500]
+                             [--api-latency-ms=0] [--cold] [--db=PATH]
+                             [--out=result.json] [--no-generate]
+
+База по умолчанию — habits-bench.db во временном каталоге.
+"""
+import asyncio
+import json
+import logging
+import os
+import random
+import subprocess
+import sys
+import time
+from typing import Any, Dict, List
+
+os.environ.setdefault("BOT_TOKEN", "123456:BENCHMARKBENCHMARKBENCHMARKBENCHMAR")
+
+from aiogram.client.session.base import BaseSession
+
+from benchmarks.generate import DEFAULT_DB, generate
+
+# управляющие команды транзакций в число запросов не входят
+_TX_PREFIXES = ("BEGIN", "COMMIT", "ROLLBACK", "SAVEPOINT", "RELEASE", "PRAGMA")
+
+
+class StubSession(BaseSession):
+    """Сессия Bot API без сети: считает вызовы и при желании имитирует задержку."""
+
+    def __init__(self, latency: float = 0.0):
+        super().__init__()
+        self.latency = latency
+        self.calls: Dict[str, int] = {}
+
+    async def make_request(self, bot, method, timeout=None):
+        name = type(method).__name__
+        self.calls[name] = self.calls.get(name, 0) + 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return None
+
+    async def stream_content(self, url, headers=None, timeout=30, chunk_size=65536, raise_for_status=True):
+        yield b""
+
+    async def close(self):
+        pass
+
+
+class QueryCounter:
+    """Счётчик SQL-запросов через sqlite3 trace callback на всех соединениях Database."""
+
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, statement: str) -> None:
+        if not statement.lstrip().upper().startswith(_TX_PREFIXES):
+            self.count += 1
+
+    async def attach(self, database) -> None:
+        for conn in [database.conn, *database._reader_conns]:
+            await conn.set_trace_callback(self)
+
+
+# ---------- Обновления ----------
+def _user(chat_id: int) -> dict:
+    return {"id": chat_id, "is_bot": False, "first_name": "Bench", "username": f"user{chat_id}"}
+
+
+def message_update(update_id: int, chat_id: int, text: str) -> dict:
+    message = {
+        "message_id": update_id,
+        "date": int(time.time()),
+        "chat": {"id": chat_id, "type": "private"},
+        "from": _user(chat_id),
+        "text": text,
+    }
+    if text.startswith("/"):
+        message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+    return {"update_id": update_id, "message": message}
+
+
+def callback_update(update_id: int, chat_id: int, data: str) -> dict:
+    return {
+        "update_id": update_id,
+        "callback_query": {
+            "id": str(update_id),
+            "from": _user(chat_id),
+            "chat_instance": str(chat_id),
+            "data": data,
+            "message": {
+                "message_id": update_id,
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"},
+                "from": _user(chat_id),
+                "text": "bench",
+            },
+        },
+    }
+
+
+# ---------- Замеры ----------
+def percentile(sorted_values: List[float], q: float) -> float:
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * q))]
+
+
+def summarize(latencies: List[float], queries: List[int]) -> Dict[str, Any]:
+    lat = sorted(latencies)
+    return {
+        "n": len(lat),
+        "p50_ms": round(percentile(lat, 0.50) * 1000, 3),
+        "p99_ms": round(percentile(lat, 0.99) * 1000, 3),
+        "max_ms": round(lat[-1] * 1000, 3) if lat else 0.0,
+        "mean_ms": round(sum(lat) / len(lat) * 1000, 3) if lat else 0.0,
+        "queries_per_call": round(sum(queries) / len(queries), 2) if queries else 0.0,
+    }
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], text=True, stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ""
+
+
+async def run(opts: Dict[str, Any]) -> Dict[str, Any]:
+    db_path = opts["db"]
+    os.environ["DB_PATH"] = db_path
+    dataset = None
+    if not opts["no_generate"]:
+        dataset = await generate(db_path, users=opts["users"], habits=opts["habits"], days=opts["days"])
+
+    import bot as app  # импорт после DB_PATH: настройки читаются при импорте
+    from aiogram.types import Update
+
+    logging.getLogger().setLevel(logging.WARNING)
+    session = StubSession(opts["api_latency_ms"] / 1000)
+    session.middleware = app.bot.session.middleware  # замеры Bot API остаются на месте
+    app.bot.session = session
+    await app.db.connect()
+    counter = QueryCounter()
+    await counter.attach(app.db.db)
+    await app.reminders.load()
+
+    rnd = random.Random(opts["seed"])
+    users = [r["chat_id"] for r in await app.db._fetchall("SELECT chat_id FROM users")]
+    today_wd = time.localtime().tm_wday
+    pending = [
+        (r["chat_id"], r["id"])
+        for r in await app.db._fetchall(
+            "SELECT h.id, u.chat_id FROM habits h JOIN users u ON u.id = h.user_id WHERE h.schedule_mask & (1 << ?)",
+            (today_wd,),
+        )
+    ]
+    rnd.shuffle(pending)
+    update_id = 0
+
+    async def measure(fn) -> tuple:
+        if opts["cold"]:
+            for cache in (app.db.users, app.db.habits, app.db.user_habits, app.db.today, app.renders.cache):
+                cache.clear()
+        before = counter.count
+        started = time.perf_counter()
+        await fn()
+        return time.perf_counter() - started, counter.count - before
+
+    def command(text: str):
+        async def fn():
+            nonlocal update_id
+            update_id += 1
+            upd = Update.model_validate(message_update(update_id, rnd.choice(users), text), context={"bot": app.bot})
+            await app.dp.feed_update(app.bot, upd)
+        return fn
+
+    def mark():
+        async def fn():
+            nonlocal update_id
+            update_id += 1
+            chat_id, habit_id = pending.pop() if pending else (rnd.choice(users), 0)
+            upd = Update.model_validate(callback_update(update_id, chat_id, f"mark:{habit_id}"), context={"bot": app.bot})
+            await app.dp.feed_update(app.bot, upd)
+        return fn
+
+    def reminder_tick():
+        # каждый шаг — следующая по времени минута с напоминаниями (вершина кучи)
+        async def fn():
+            fire = app.reminders.next_fire_at()
+            if fire is not None:
+                await app.reminders.tick(fire)
+        return fn
+
+    scenarios = {
+        "today": command("/today"),
+        "week": command("/week"),
+        "month": command("/month"),
+        "done": command("/done"),
+        "stats": command("/stats"),
+        "mark_done": mark(),
+        "reminder_tick": reminder_tick(),
+    }
+    results = {}
+    try:
+        for name, fn in scenarios.items():
+            latencies, queries = [], []
+            for _ in range(opts["iterations"]):
+                elapsed, n = await measure(fn)
+                latencies.append(elapsed)
+                queries.append(n)
+            results[name] = summarize(latencies, queries)
+    finally:
+        await app.db.close()
+
+    return {
+        "commit": git_commit(),
+        "timestamp": int(time.time()),
+        "options": opts,
+        "dataset": dataset,
+        "bot_api_calls": session.calls,
+        "results": results,
+        # разбивка по обработчикам: доли SQL / Bot API / остального
+        "handlers": app.handler_metrics.snapshot()["handlers"],
+    }
+
+
+DEFAULTS = {
+    "db": DEFAULT_DB,
+    "users": 1000,
+    "habits": 5,
+    "days": 365,
+    "iterations": 500,
+    "api_latency_ms": 0.0,
+    "seed": 1,
+    "cold": False,
+    "no_generate": False,
+    "out": None,
+}
+
+
+def parse_args(argv: List[str]) -> Dict[str, Any]:
+    opts = dict(DEFAULTS)
+    for arg in argv:
+        if not arg.startswith("--"):
+            raise SystemExit(f"Unknown argument: {arg}")
+        key, _, value = arg[2:].partition("=")
+        key = key.replace("-", "_")
+        if key not in opts:
+            raise SystemExit(f"Unknown option: --{key}")
+        default = DEFAULTS[key]
+        if isinstance(default, bool):
+            opts[key] = True
+        elif isinstance(default, (int, float)):
+            opts[key] = type(default)(value)
+        else:
+            opts[key] = value
+    return opts
+
+
+def main() -> None:
+    opts = parse_args(sys.argv[1:])
+    result = json.dumps(asyncio.run(run(opts)), ensure_ascii=False, indent=2)
+    if opts["out"]:
+        with open(opts["out"], "w", encoding="utf-8") as f:
+            f.write(result + "\n")
+    print(result)
+
+
+if __name__ == "__main__":
+    main()
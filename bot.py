@@ -1,25 +1,38 @@
 import asyncio
 import logging
+import os
 import re
+import tempfile
 from typing import List
 from aiogram import Bot, Dispatcher, Router
 from aiogram.filters import Command, CommandStart
 from aiogram.filters.state import StateFilter
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
-from aiogram.fsm.storage.memory import MemoryStorage
 from aiogram.types import (
     Message,
     ReplyKeyboardMarkup,
     KeyboardButton,
     ReplyKeyboardRemove,
-    InlineKeyboardButton, CallbackQuery
+    InlineKeyboardButton, CallbackQuery,
+    BufferedInputFile, FSInputFile,
 )
 from aiogram.utils.keyboard import InlineKeyboardBuilder
-import datetime
 from data.utils import get_motivation
 from config import get_settings
 from data.db import Database
+from data.cache import CachedDatabase, cache_prometheus, format_cache_stats
+from data.fsm_storage import SQLiteStorage
+from data.reports import build_period_report, daterange
+from data.snapshot import write_snapshot
+from data.transfer import export_to, import_file
+from data.tz import local_now, local_today, normalize_tz
+from reminders import ReminderDispatcher
+from render import RenderCache, patch_mark_button
+from outbox import Outbox
+from webhook import run_webhook, start_metrics_server
+from middlewares import ApiTimingMiddleware, AuthMiddleware, HandlerMetrics, HandlerNameMiddleware, UpdateTimingMiddleware
+from sharding import consume, run_front
 from datetime import date, timedelta, datetime as dt
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from apscheduler.triggers.cron import CronTrigger
@@ -29,14 +42,44 @@ logging.basicConfig(level=logging.INFO, format="%(asctime)s | %(levelname)s | %(
 
 settings = get_settings()
 bot = Bot(token=settings.bot_token)
+outbox = Outbox(
+    bot,
+    rate=settings.send_rate,
+    per_chat_rate=settings.send_chat_rate,
+    workers=settings.send_workers,
+)
+
+db = CachedDatabase(
+    Database(
+        path=settings.db_path,
+        synchronous=settings.db_synchronous,
+        batch_delay=settings.db_batch_delay,
+        batch_size=settings.db_batch_size,
+        readers=settings.db_readers,
+        slow_query_threshold=settings.db_slow_query,
+    ),
+    maxsize=settings.cache_size,
+    ttl=settings.cache_ttl,
+)
 
-storage = MemoryStorage()
+# готовые тексты отчётов и клавиатуры; сбрасываются сменой версии данных пользователя
+renders = RenderCache(db, maxsize=settings.cache_size, ttl=settings.cache_ttl)
+
+storage = SQLiteStorage(db, ttl=settings.fsm_ttl, maxsize=settings.fsm_cache_size)
 dp = Dispatcher(storage=storage)
 
 router = Router()
 dp.include_router(router)
-
-db = Database()
+# задержки обновлений и обработчиков с разбивкой на SQL / Bot API / остальное;
+# замеры Database размечаются именем обработчика
+handler_metrics = HandlerMetrics()
+dp.update.outer_middleware(UpdateTimingMiddleware(handler_metrics))
+router.message.middleware(HandlerNameMiddleware(handler_metrics))
+router.callback_query.middleware(HandlerNameMiddleware(handler_metrics))
+bot.session.middleware(ApiTimingMiddleware(handler_metrics))
+# пользователь и привычка для обработчиков с флагами user / habit (см. AuthMiddleware)
+router.message.middleware(AuthMiddleware(db))
+router.callback_query.middleware(AuthMiddleware(db))
 
 # ---------- FSM ----------
 class AddHabit(StatesGroup):
@@ -51,6 +94,10 @@ class EditHabitStates(StatesGroup):
     waiting_for_schedule = State()
     waiting_for_reminder = State()
 
+class BackfillStates(StatesGroup):
+    habits = State()  # выбор привычек
+    dates = State()   # выбор дней в сетке
+
 # Клавиатура для выбора частоты
 FREQ_KEYBOARD = ReplyKeyboardMarkup(
     keyboard=[
@@ -132,6 +179,10 @@ async def on_help(message: Message):
         "/add — добавить привычку\n"
         "/cancel — отменить текущее добавление\n"
         "/today /week /month — статистика\n"
+        "/stats — серии и итоги по привычкам\n"
+        "/backfill — отметить пропущенные дни задним числом\n"
+        "/tz — часовой пояс для напоминаний и отчётов\n"
+        "/digest — напоминания одним сообщением со списком привычек\n"
     )
 
 # /cancel — универсальная отмена состояний
@@ -211,13 +262,14 @@ async def process_reminder_time(message: Message, state: FSMContext):
     data = await state.get_data()
     user = await db.get_user_by_chat(message.chat.id)
     user_id = user["id"]
-    await db.add_habit(
+    habit_id = await db.add_habit(
         user_id=user_id,
         name=data["name"],
         frequency=data["frequency"],
         schedule=data.get("schedule"),
         reminder_time=reminder_time
     )
+    reminders.add({"id": habit_id, "reminder_time": reminder_time, "tz": user.get("tz")})
     await state.clear()
     await message.answer(f"Готово — привычка '{data['name']}' добавлена ✅", reply_markup=ReplyKeyboardRemove())
     
@@ -247,47 +299,119 @@ async def process_schedule(message: Message, state: FSMContext):
     await message.answer(f"Готово — привычка '{name}' добавлена (еженедельно: {pretty}) ✅", reply_markup=ReplyKeyboardRemove())
 
 # ---------- Main ----------
-async def main():
+metrics_runner = None
+
+async def startup():
+    global metrics_runner
     await db.connect()
+    await db.rollover_zones()  # на случай, если бот был выключен в полночь
+    storage.start()
+    await outbox.start()
     await schedule_reminders()
-    # снятие возможного вебхука (безопасно)
-    await bot.delete_webhook(drop_pending_updates=True)
+    if settings.metrics_port:
+        metrics_runner = await start_metrics_server(metrics_text, settings.metrics_host, settings.metrics_port)
+
+async def shutdown():
+    if metrics_runner:
+        await metrics_runner.cleanup()
+    await outbox.stop()
+    await storage.close()
+    await db.close()
+
+async def main():
+    if settings.shards > 1:
+        # фронт: сам базу не открывает, только раздаёт обновления воркерам
+        await run_front(bot, settings)
+        return
+    await startup()
     try:
-        await dp.start_polling(bot)
+        if settings.webhook_url:
+            await run_webhook(dp, bot, settings)
+        else:
+            # снятие возможного вебхука (безопасно)
+            await bot.delete_webhook(drop_pending_updates=True)
+            await dp.start_polling(bot)
+    finally:
+        await shutdown()
+
+async def run_worker(queue):
+    """Процесс-воркер шарда: обновления приходят от фронта через queue."""
+    await startup()
+    try:
+        await consume(queue, dp, bot, concurrency=settings.webhook_concurrency)
     finally:
-        await db.close()
+        await shutdown()
+        await bot.session.close()
 
 async def schedule_reminders():
-    habits = await db.get_all_habits_with_reminders()
-    for h in habits:
-        rt = h.get("reminder_time")
-        if not rt:
-            continue
-        hour, minute = map(int, rt.split(":"))
-        
+    await reminders.load()
+    # одна задача на весь бот: раз в минуту снимаются наступившие напоминания
+    scheduler.add_job(
+        reminders.tick,
+        trigger=CronTrigger(second=0),
+        id="reminders_tick",
+        replace_existing=True,
+        coalesce=True,
+        misfire_grace_time=30,
+    )
+    # пересчёт агрегатов /stats (окна 7/30 дней, прерванные серии) после полуночи
+    # в каждом поясе; раз в 15 минут — чтобы успеть и за поясами со сдвигом :30 / :45
+    scheduler.add_job(
+        db.rollover_zones,
+        trigger=CronTrigger(minute="1,16,31,46"),
+        id="habit_stats_rollover",
+        replace_existing=True,
+        coalesce=True,
+        misfire_grace_time=3600,
+    )
+    if settings.archive_horizon_days:
+        # старые отметки -> помесячные битовые маски в progress_archive
         scheduler.add_job(
-            send_reminder,
-            trigger=CronTrigger(hour=hour, minute=minute),
-            args=[h],
-            id=f"habit_{h['id']}",
+            db.archive_progress,
+            trigger=CronTrigger(hour=3, minute=0),
+            args=[settings.archive_horizon_days],
+            id="progress_archive",
             replace_existing=True,
             coalesce=True,
+            misfire_grace_time=3600,
+        )
+    if settings.analytics_dir:
+        # колоночный снимок для аналитики: отдельное соединение только для чтения, в потоке
+        scheduler.add_job(
+            write_analytics_snapshot,
+            trigger=CronTrigger(hour=4, minute=30),
+            id="analytics_snapshot",
+            replace_existing=True,
+            coalesce=True,
+            misfire_grace_time=3600,
         )
     scheduler.start()
+
+async def write_analytics_snapshot():
+    # у каждого шарда свой каталог: analytics/habits.shard0/...
+    name = os.path.splitext(os.path.basename(settings.db_path))[0]
+    path = await asyncio.to_thread(
+        write_snapshot, settings.db_path, os.path.join(settings.analytics_dir, name), settings.analytics_keep
+    )
+    logging.info("Analytics snapshot written: %s", path)
     
 
         # ----------------- вспомогательная функция -----------------
-async def build_today_habits_keyboard(user_id: int):
+async def build_today_habits_keyboard(user: dict):
+    today = user_today(user)
+    return await renders.get_or_render(
+        renders.key(user["id"], "today_kb", iso(today)), lambda: render_today_habits_keyboard(user["id"], today)
+    )
+
+async def render_today_habits_keyboard(user_id: int, today: date):
     kb = InlineKeyboardBuilder()
-    habits = await db.get_today_habits(user_id)
-    today = datetime.date.today().isoformat()
+    habits = await db.get_today_status(user_id, today)
 
     if not habits:
         return None
 
     for habit in habits:
-        prog = await db.get_progress_for_habit(habit["id"], start_date=today, end_date=today)
-        status = "✅" if prog else "⬜"
+        status = "✅" if habit["done"] else "⬜"
 
         kb.row(
             InlineKeyboardButton(text=habit["name"], callback_data=f"habit:{habit['id']}"),
@@ -303,65 +427,61 @@ async def build_today_habits_keyboard(user_id: int):
     return kb.as_markup()
 
 # ----------------- /done — показать привычки и клавиатуру -----------------
-@router.message(Command("done"))
-async def cmd_done(message: Message):
-    user = await db.get_user_by_chat(message.chat.id)
-    if not user:
-        # регистрация
-        user = await db.get_user_by_chat(message.chat.id)
-    kb = await build_today_habits_keyboard(user["id"])
+@router.message(Command("done"), flags={"user": True})
+async def cmd_done(message: Message, user: dict):
+    kb = await build_today_habits_keyboard(user)
     if kb is None:
         await message.answer("На сегодня у тебя нет привычек. Добавь новую привычку командой /add.")
         return
     await message.answer("Выбери привычку, чтобы отметить её выполненной:", reply_markup=kb)
 
 # ----------------- Callback для отметки выполнения -----------------
-@router.callback_query(lambda c: c.data and c.data.startswith("mark:"))
-async def cb_mark_done(callback: CallbackQuery):
-    
-    data = callback.data.split(":", 1)[1]
-    
-    if data == "cancel":
-        await callback.answer("Отмена.", show_alert=False)
-        # убрать клавиатуру
-        try:
-            await callback.message.edit_reply_markup(reply_markup=None)
-        except Exception:
-            pass
-        return
-
+@router.callback_query(lambda c: c.data == "mark:cancel")
+async def cb_mark_cancel(callback: CallbackQuery):
+    await callback.answer("Отмена.", show_alert=False)
+    # убрать клавиатуру
     try:
-        habit_id = int(data)
-    except ValueError:
-        await callback.answer("Неверные данные.", show_alert=True)
-        return
+        await callback.message.edit_reply_markup(reply_markup=None)
+    except Exception:
+        pass
 
-    # проверка принадлежности привычки пользователю
-    habit = await db.get_habit(habit_id)
-    user = await db.get_user_by_chat(callback.message.chat.id)
-    if not habit or not user or habit["user_id"] != user["id"]:
-        await callback.answer("Нельзя отмечать эту привычку.", show_alert=True)
-        return
+@router.callback_query(lambda c: c.data and c.data.startswith("mark:"), flags={"habit": "Нельзя отмечать эту привычку."})
+async def cb_mark_done(callback: CallbackQuery, user: dict, habit: dict):
+    # user и habit уже найдены и проверены AuthMiddleware
+    habit_id = habit["id"]
 
-    today = datetime.date.today().isoformat()
-    # проверка, не отмечена ли уже
-    already = await db.get_progress_for_habit(habit_id, start_date=today, end_date=today)
+    today = user_today(user)
+    # проверка, не отмечена ли уже (статус на сегодня берётся из кэша)
+    today_status = await db.get_today_status(user["id"], today)
+    already = any(h["id"] == habit_id and h["done"] for h in today_status)
     if already:
         await callback.answer("Эта привычка уже отмечена сегодня ✅", show_alert=False)
-        # обновление интерфейса
+        # обновление интерфейса: меняем только кнопку этой привычки
         try:
-            kb = await build_today_habits_keyboard(user["id"])
-            if kb:
+            kb = patch_mark_button(callback.message.reply_markup, habit_id)
+            if kb is None:
+                kb = await build_today_habits_keyboard(user)
+            if kb and kb != callback.message.reply_markup:
                 await callback.message.edit_reply_markup(reply_markup=kb)
         except Exception:
             pass
         return
 
-    await db.mark_done(habit_id, date=today)
+    await db.mark_done(habit_id, date=iso(today), today=today)
     phrase = get_motivation()
     # короткое всплывающее подтверждение
     await callback.answer(phrase, show_alert=False)
 
+    if (callback.message.text or "").startswith(DIGEST_HEADER):
+        # сводка остаётся на экране: в ней можно отметить и остальные привычки
+        try:
+            kb = patch_mark_button(callback.message.reply_markup, habit_id)
+            if kb is not None:
+                await callback.message.edit_reply_markup(reply_markup=kb)
+        except Exception:
+            pass
+        return
+
     try:
         await callback.message.edit_text(f"Готово — ты отметил(а) привычку: «{habit['name']}»\n\n{phrase}")
     except Exception:
@@ -369,58 +489,17 @@ async def cb_mark_done(callback: CallbackQuery):
         await callback.message.answer(f"Готово — ты отметил(а) привычку: «{habit['name']}»\n\n{phrase}")
 
 # ---------- Вспомогательные утилиты для статистики ----------
-def daterange(start_date: date, end_date: date):
-    """Генерирует даты от start_date до end_date включительно."""
-    for n in range((end_date - start_date).days + 1):
-        yield start_date + timedelta(days=n)
-
 def iso(d: date) -> str:
     return d.isoformat()
 
+def user_today(user: dict) -> date:
+    """«Сегодня» в часовом поясе пользователя (без пояса — по времени сервера)."""
+    return local_today(user.get("tz"))
+
 def parse_date(s: str) -> date:
     """Парсинг строки 'YYYY-MM-DD' в date"""
     return dt.strptime(s, "%Y-%m-%d").date()
 
-def expected_occurrences(habit: dict, start_date: date, end_date: date) -> int:
-    """
-    Считает, сколько раз привычка должна была появиться в интервале.
-    Правила:
-      - daily -> каждый день в интервале
-      - weekly -> если schedule не None -> считаем дни недели из schedule
-                 если schedule is None -> используем день недели created_at
-      - другие частоты -> считаем как daily (фоллбек)
-    """
-    freq = (habit.get("frequency") or "daily").lower()
-    if freq == "daily":
-        return (end_date - start_date).days + 1
-
-    # weekly
-    if freq == "weekly":
-        sched = habit.get("schedule") 
-        if sched:
-            # schedule — список чисел 0..6 (понедельник=0)
-            s = set(int(x) for x in sched)
-            cnt = 0
-            for d in daterange(start_date, end_date):
-                if d.weekday() in s:
-                    cnt += 1
-            return cnt
-        
-        created = habit.get("created_at")
-        if created:
-            try:
-                c_date = dt.strptime(created.split(" ")[0], "%Y-%m-%d").date()
-                target_wd = c_date.weekday()
-                cnt = sum(1 for d in daterange(start_date, end_date) if d.weekday() == target_wd)
-                return cnt
-            except Exception:
-                pass
-            
-        days = (end_date - start_date).days + 1
-        return max(1, days // 7)
-
-    return (end_date - start_date).days + 1
-
 def pretty_percent(done: int, total: int) -> str:
     if total <= 0:
         return "—"
@@ -434,133 +513,428 @@ def progress_bar(done: int, total: int, width: int = 10) -> str:
     filled = min(max(filled, 0), width)
     return "█" * filled + "░" * (width - filled)
 
-@router.message(Command("today"))
-async def cmd_today(message: Message):
-    user = await db.get_user_by_chat(message.chat.id)
-    if not user:
-        await db.add_user(chat_id=message.chat.id, username=message.from_user.username)
-        user = await db.get_user_by_chat(message.chat.id)
-
-    today = date.today()
-    today_iso = iso(today)
+@router.message(Command("today"), flags={"user": True})
+async def cmd_today(message: Message, user: dict):
+    today = user_today(user)
+    text = await renders.get_or_render(
+        renders.key(user["id"], "today", iso(today)), lambda: render_today_status(user["id"], today)
+    )
+    if not text:
+        await message.answer("На сегодня у тебя нет привычек — добавь с помощью /add.")
+        return
+    await message.answer(text)
 
+async def render_today_status(user_id: int, today: date):
     # получение актуальных привычек на сегодня
-    habits = await db.get_today_habits(user["id"])
+    habits = await db.get_today_status(user_id, today)
     if not habits:
-        await message.answer("На сегодня у тебя нет привычек — добавь с помощью /add.")
-        return
+        return None
 
-    lines = [f"📅 Статус на сегодня — {today_iso}\n"]
+    lines = [f"📅 Статус на сегодня — {iso(today)}\n"]
     for idx, h in enumerate(habits, start=1):
-        done = await db.get_progress_for_habit(h["id"], start_date=today_iso, end_date=today_iso)
-        mark = "✅" if done else "❌"
+        mark = "✅" if h["done"] else "❌"
         lines.append(f"{idx}. {h['name']} — {mark}")
+    return "\n".join(lines)
 
-    await message.answer("\n".join(lines))
+async def send_period_report(message: Message, user: dict, kind: str, header: str, start_date: date, end_date: date):
+    # kind + end_date однозначно задают период, header от них зависит
+    text = await renders.get_or_render(
+        renders.key(user["id"], kind, iso(end_date)),
+        lambda: render_period_report(user["id"], header, start_date, end_date),
+    )
+    if not text:
+        await message.answer("У тебя ещё нет привычек. Добавь через /add.")
+        return
+    await message.answer(text)
 
-@router.message(Command("week"))
-async def cmd_week(message: Message):
-    user = await db.get_user_by_chat(message.chat.id)
-    if not user:
-        await db.add_user(chat_id=message.chat.id, username=message.from_user.username)
-        user = await db.get_user_by_chat(message.chat.id)
+async def render_period_report(user_id: int, header: str, start_date: date, end_date: date):
+    report = await build_period_report(db, user_id, start_date, end_date)
+    if not report:
+        return None
 
-    end_date = date.today()
-    start_date = end_date - timedelta(days=6)  # последние 7 дней
-    dates = list(daterange(start_date, end_date))
+    dates = [iso(d) for d in daterange(start_date, end_date)]
+    lines = [f"{header} ({start_date.isoformat()} — {end_date.isoformat()}):\n"]
+    for idx, item in enumerate(report, start=1):
+        done_dates = item["done_dates"]
+        done_count = item["done_count"]
+        expected = item["expected"]
 
-    lines = [f"📊 Прогресс за последние 7 дней ({start_date.isoformat()} — {end_date.isoformat()}):\n"]
+        per_day = " ".join("✅" if d in done_dates else "·" for d in dates)
+        pct = pretty_percent(done_count, expected) if expected > 0 else "—"
+        bar = progress_bar(done_count, expected) if expected > 0 else ""
 
-    habits = await db.get_habits(user["id"])
-    if not habits:
-        await message.answer("У тебя ещё нет привычек. Добавь через /add.")
-        return
+        lines.append(f"{idx}. {item['habit']['name']}\n   {done_count}/{expected} {pct} {bar}\n   {per_day}\n")
 
-    for idx, h in enumerate(habits, start=1):
-        prog_rows = await db.get_progress_for_habit(h["id"], start_date=start_date.isoformat(), end_date=end_date.isoformat())
-        done_dates = set(r["date"] for r in prog_rows)
+    return "\n".join(lines)
 
-        done_count = len(done_dates)
-        expected = expected_occurrences(h, start_date, end_date)
+@router.message(Command("week"), flags={"user": True})
+async def cmd_week(message: Message, user: dict):
+    end_date = user_today(user)
+    start_date = end_date - timedelta(days=6)  # последние 7 дней
+    await send_period_report(message, user, "week", "📊 Прогресс за последние 7 дней", start_date, end_date)
 
-        per_day = " ".join("✅" if d.isoformat() in done_dates else "·" for d in dates)
+@router.message(Command("month"), flags={"user": True})
+async def cmd_month(message: Message, user: dict):
+    today = user_today(user)
+    await send_period_report(message, user, "month", "📅 Прогресс за месяц", today.replace(day=1), today)
 
-        pct = pretty_percent(done_count, expected) if expected > 0 else "—"
-        bar = progress_bar(done_count, expected) if expected > 0 else ""
 
-        lines.append(f"{idx}. {h['name']}\n   {done_count}/{expected} {pct} {bar}\n   {per_day}\n")
+@router.message(Command("stats"), flags={"user": True})
+async def cmd_stats(message: Message, user: dict):
+    stats = await db.get_user_stats(user["id"])
+    if not stats:
+        await message.answer("У тебя ещё нет привычек. Добавь через /add.")
+        return
 
+    lines = ["📈 Статистика по привычкам:\n"]
+    for idx, s in enumerate(stats, start=1):
+        lines.append(
+            f"{idx}. {s['name']}\n"
+            f"   🔥 серия: {s['current_streak'] or 0} (рекорд {s['longest_streak'] or 0})\n"
+            f"   всего: {s['total_done'] or 0}, за 7 дней: {s['done_7d'] or 0}, за 30 дней: {s['done_30d'] or 0}\n"
+            f"   последний раз: {s['last_done'] or '—'}\n"
+        )
     await message.answer("\n".join(lines))
 
-@router.message(Command("month"))
-async def cmd_month(message: Message):
+@router.message(Command("stats_rebuild"))
+async def cmd_stats_rebuild(message: Message):
     user = await db.get_user_by_chat(message.chat.id)
     if not user:
-        await db.add_user(chat_id=message.chat.id, username=message.from_user.username)
-        user = await db.get_user_by_chat(message.chat.id)
+        await message.answer("Сначала зарегистрируйся командой /start.")
+        return
+    count = await db.rebuild_habit_stats(user_id=user["id"])
+    await message.answer(f"Статистика пересчитана по истории ({count} привычек). Смотри /stats.")
 
-    today = date.today()
-    start_date = today.replace(day=1)
-    end_date = today
-    dates = list(daterange(start_date, end_date))
 
-    lines = [f"📅 Прогресс за месяц ({start_date.isoformat()} — {end_date.isoformat()}):\n"]
+# ---------- /tz — часовой пояс ----------
+@router.message(Command("tz"), flags={"user": True})
+async def cmd_tz(message: Message, user: dict):
+    arg = (message.text or "").partition(" ")[2].strip()
+    if not arg:
+        now = local_now(user.get("tz")).strftime("%H:%M")
+        await message.answer(
+            f"Часовой пояс: {user.get('tz') or 'время сервера'} (сейчас {now}).\n"
+            "Поменять: /tz Europe/Moscow или /tz +3, вернуть время сервера — /tz -"
+        )
+        return
+    if arg == "-":
+        tz = None
+    else:
+        try:
+            tz = normalize_tz(arg)
+        except ValueError:
+            await message.answer("Не знаю такой пояс. Пример: /tz Europe/Moscow, /tz Asia/Almaty или /tz +5")
+            return
+    await db.set_user_timezone(message.chat.id, tz)
+    # напоминания переводятся на местное время нового пояса
+    for h in await db.get_habits(user["id"]):
+        if h.get("reminder_time"):
+            reminders.add({**h, "tz": tz})
+    now = local_now(tz).strftime("%H:%M")
+    await message.answer(f"Готово — часовой пояс {tz or 'сервера'} (сейчас {now}). Напоминания и «сегодня» считаются по нему.")
+
+
+# ---------- /digest — режим сводки ----------
+@router.message(Command("digest"), flags={"user": True})
+async def cmd_digest(message: Message, user: dict):
+    arg = (message.text or "").partition(" ")[2].strip().lower()
+    if arg in ("on", "вкл"):
+        enabled = True
+    elif arg in ("off", "выкл"):
+        enabled = False
+    else:
+        enabled = not user.get("digest")
+    await db.set_user_digest(message.chat.id, enabled)
+    if enabled:
+        await message.answer(
+            "Режим сводки включён: напоминания на одно время приходят одним сообщением, "
+            "отмечать привычки можно прямо в нём. Выключить — /digest off"
+        )
+    else:
+        await message.answer("Режим сводки выключен: каждое напоминание — отдельным сообщением.")
+
+
+# ---------- /backfill — отметки задним числом ----------
+BACKFILL_DAYS = 14  # сколько последних дней доступно в сетке
+WD_SHORT = ["пн", "вт", "ср", "чт", "пт", "сб", "вс"]
 
+def backfill_habits_keyboard(habits, selected):
+    kb = InlineKeyboardBuilder()
+    for h in habits:
+        mark = "✅" if h["id"] in selected else "⬜"
+        kb.row(InlineKeyboardButton(text=f"{mark} {h['name']}", callback_data=f"bf:h:{h['id']}"))
+    kb.row(
+        InlineKeyboardButton(text="Дальше ➡️", callback_data="bf:next"),
+        InlineKeyboardButton(text="Отмена", callback_data="bf:cancel"),
+    )
+    return kb.as_markup()
+
+def backfill_dates_keyboard(selected, today: date):
+    """Сетка по неделям (пн..вс) за последние BACKFILL_DAYS дней; будущие и более ранние дни — пустые клетки."""
+    first = today - timedelta(days=BACKFILL_DAYS - 1)
+    start = first - timedelta(days=first.weekday())
+    kb = InlineKeyboardBuilder()
+    kb.row(*(InlineKeyboardButton(text=wd, callback_data="bf:noop") for wd in WD_SHORT))
+    day = start
+    while day <= today:
+        row = []
+        for _ in range(7):
+            if first <= day <= today:
+                d = iso(day)
+                text = f"✅{day.day}" if d in selected else str(day.day)
+                row.append(InlineKeyboardButton(text=text, callback_data=f"bf:d:{d}"))
+            else:
+                row.append(InlineKeyboardButton(text=" ", callback_data="bf:noop"))
+            day += timedelta(days=1)
+        kb.row(*row)
+    kb.row(
+        InlineKeyboardButton(text="⬅️ Назад", callback_data="bf:back"),
+        InlineKeyboardButton(text="Сохранить", callback_data="bf:save"),
+        InlineKeyboardButton(text="Отмена", callback_data="bf:cancel"),
+    )
+    return kb.as_markup()
+
+@router.message(Command("backfill"), flags={"user": True})
+async def cmd_backfill(message: Message, state: FSMContext, user: dict):
     habits = await db.get_habits(user["id"])
     if not habits:
         await message.answer("У тебя ещё нет привычек. Добавь через /add.")
         return
+    await state.set_state(BackfillStates.habits)
+    await state.update_data(bf_habits=[], bf_dates=[])
+    await message.answer(
+        "Выбери привычки, которые нужно отметить задним числом:",
+        reply_markup=backfill_habits_keyboard(habits, set()),
+    )
 
-    for idx, h in enumerate(habits, start=1):
-        prog_rows = await db.get_progress_for_habit(h["id"], start_date=start_date.isoformat(), end_date=end_date.isoformat())
-        done_dates = set(r["date"] for r in prog_rows)
+@router.callback_query(StateFilter(BackfillStates.habits, BackfillStates.dates), lambda c: c.data and c.data.startswith("bf:"), flags={"user": True})
+async def cb_backfill(callback: CallbackQuery, state: FSMContext, user: dict):
+    action, _, arg = callback.data[3:].partition(":")
+    data = await state.get_data()
+    habits = await db.get_habits(user["id"])
+    own_ids = {h["id"] for h in habits}
+    selected_habits = [hid for hid in data.get("bf_habits", []) if hid in own_ids]
+    selected_dates = data.get("bf_dates", [])
+    today = user_today(user)
 
-        done_count = len(done_dates)
-        expected = expected_occurrences(h, start_date, end_date)
+    if action == "noop":
+        await callback.answer()
+        return
+    if action == "cancel":
+        await state.clear()
+        await callback.answer("Отмена.")
+        await callback.message.edit_text("Отметка задним числом отменена.")
+        return
+    if action == "h" and arg.isdigit() and int(arg) in own_ids:
+        hid = int(arg)
+        selected_habits = [x for x in selected_habits if x != hid] if hid in selected_habits else selected_habits + [hid]
+        await state.update_data(bf_habits=selected_habits)
+        await callback.answer()
+        await callback.message.edit_reply_markup(reply_markup=backfill_habits_keyboard(habits, set(selected_habits)))
+        return
+    if action == "next":
+        if not selected_habits:
+            await callback.answer("Выбери хотя бы одну привычку.", show_alert=True)
+            return
+        await state.set_state(BackfillStates.dates)
+        await callback.answer()
+        await callback.message.edit_text(
+            "Отметь дни, когда привычки были выполнены, и нажми «Сохранить»:",
+            reply_markup=backfill_dates_keyboard(set(selected_dates), today),
+        )
+        return
+    if action == "back":
+        await state.set_state(BackfillStates.habits)
+        await callback.answer()
+        await callback.message.edit_text(
+            "Выбери привычки, которые нужно отметить задним числом:",
+            reply_markup=backfill_habits_keyboard(habits, set(selected_habits)),
+        )
+        return
+    if action == "d":
+        try:
+            day = parse_date(arg)
+        except ValueError:
+            await callback.answer("Неверные данные.", show_alert=True)
+            return
+        if not (today - timedelta(days=BACKFILL_DAYS - 1) <= day <= today):
+            await callback.answer()
+            return
+        selected_dates = [x for x in selected_dates if x != arg] if arg in selected_dates else selected_dates + [arg]
+        await state.update_data(bf_dates=selected_dates)
+        await callback.answer()
+        await callback.message.edit_reply_markup(reply_markup=backfill_dates_keyboard(set(selected_dates), today))
+        return
+    if action == "save":
+        if not selected_habits or not selected_dates:
+            await callback.answer("Выбери хотя бы один день.", show_alert=True)
+            return
+        # все отметки и пересчёт статистики — одной транзакцией, кэши сбрасываются один раз
+        added = await db.mark_many(selected_habits, sorted(selected_dates), today=today)
+        await state.clear()
+        await callback.answer("Сохранено ✅")
+        await callback.message.edit_text(
+            f"Готово — добавлено отметок: {added} "
+            f"(дни вне расписания привычки и уже отмеченные пропущены)."
+        )
+        # обновлённые неделя и месяц — один раз после всех отметок
+        await send_period_report(callback.message, user, "week", "📊 Прогресс за последние 7 дней", today - timedelta(days=6), today)
+        await send_period_report(callback.message, user, "month", "📅 Прогресс за месяц", today.replace(day=1), today)
+        return
+    await callback.answer()
 
-        per_day = " ".join("✅" if d.isoformat() in done_dates else "·" for d in dates)
-        pct = pretty_percent(done_count, expected) if expected > 0 else "—"
-        bar = progress_bar(done_count, expected) if expected > 0 else ""
 
-        lines.append(f"{idx}. {h['name']}\n   {done_count}/{expected} {pct} {bar}\n   {per_day}\n")
+# ---------- Служебные команды ----------
+def is_admin(message: Message) -> bool:
+    return message.from_user is not None and message.from_user.id in settings.admin_ids
 
-    await message.answer("\n".join(lines))
+def cache_stats() -> dict:
+    """Счётчики кэша данных и кэша отрисовки."""
+    return {**db.stats(), "render": renders.stats()}
 
+def metrics_text() -> str:
+    """Все метрики в текстовом формате Prometheus."""
+    return (
+        db.metrics.prometheus() + handler_metrics.prometheus() + outbox.prometheus()
+        + cache_prometheus(cache_stats())
+    )
 
-scheduler = AsyncIOScheduler()
+def format_top(title: str, items, width: int = 60) -> List[str]:
+    lines = [title]
+    for item in items:
+        name = item["name"] if len(item["name"]) <= width else item["name"][:width - 1] + "…"
+        lines.append(
+            f"• {name}\n   {item['calls']} выз., {item['total'] * 1000:.0f} мс всего, "
+            f"p50 ≤{item['p50'] * 1000:g} мс, p99 ≤{item['p99'] * 1000:g} мс, строк {item['rows']}"
+        )
+    return lines
 
-async def send_reminder(habit):
-    chat_id = habit["chat_id"]
+@router.message(Command("dbstats"))
+async def cmd_dbstats(message: Message):
+    """/dbstats — сводка по БД; /dbstats prom — файл с метриками; /dbstats reset — обнулить."""
+    if not is_admin(message):
+        return
+    arg = (message.text or "").split(maxsplit=1)[1:]
+    metrics = db.metrics
+    if arg and arg[0] == "reset":
+        metrics.reset()
+        await message.answer("Счётчики БД обнулены.")
+        return
+    if arg and arg[0] == "prom":
+        await message.answer_document(BufferedInputFile(metrics_text().encode(), filename="metrics.prom"))
+        return
 
-    today_iso = date.today().isoformat()
+    lines = [
+        f"Медленных запросов: {metrics.slow} (порог {metrics.slow_threshold * 1000:g} мс)",
+        f"Ожидание записи (очередь + COMMIT): p50 ≤{metrics.write_wait.quantile(0.5) * 1000:g} мс, "
+        f"p99 ≤{metrics.write_wait.quantile(0.99) * 1000:g} мс, записей {metrics.write_wait.count}",
+        format_cache_stats(cache_stats()) + "\n",
+    ]
+    lines += format_top("Методы:", metrics.top_methods(5))
+    lines += format_top("\nЗапросы:", metrics.top_queries(5))
+    lines += format_top("\nОбработчики (время в SQL):", metrics.top_handlers(5))
+    await message.answer("\n".join(lines))
 
-    # проверка, не выполнена ли привычка сегодня
-    done = await db.get_progress_for_habit(habit["id"], start_date=today_iso, end_date=today_iso)
-    if done:
+@router.message(Command("perf"))
+async def cmd_perf(message: Message):
+    """/perf — перцентили обработчиков и доля времени в SQL / Bot API / остальном."""
+    if not is_admin(message):
         return
+    snap = handler_metrics.snapshot()
+    lines = [
+        f"В обработке: {snap['in_flight']} (макс. {snap['max_in_flight']}), "
+        f"{snap['throughput']:.2f} обновл./с за минуту\n"
+    ]
+    rows = [("все обновления", snap["updates"])] + sorted(
+        snap["handlers"].items(), key=lambda kv: kv[1]["p99"], reverse=True
+    )
+    for name, s in rows[:12]:
+        lines.append(
+            f"• {name}: {s['calls']} выз., ошибок {s['errors']}\n"
+            f"   p50 {s['p50'] * 1000:.1f} / p95 {s['p95'] * 1000:.1f} / p99 {s['p99'] * 1000:.1f} мс; "
+            f"SQL {s['db_share']:.0%}, API {s['api_share']:.0%}, прочее {s['other_share']:.0%}"
+        )
+    out = outbox.metrics()
+    lines.append(
+        f"\nOutbox: в очереди {out['queue_depth']}, отложено {out['delayed']}; "
+        f"отправлено {out['sent']}, ошибок {out['failed']}, повторов {out['retried']}, "
+        f"отброшено {out['dropped']}\n"
+        f"   задержка avg {out['latency_avg'] * 1000:.0f} / p99 {out['latency_p99'] * 1000:.0f} / "
+        f"max {out['latency_max'] * 1000:.0f} мс"
+    )
+    await message.answer("\n".join(lines))
 
-    # проверка расписания для weekly
-    if habit["frequency"] == "weekly" and habit["schedule"]:
-        today_wd = date.today().weekday()  
-        if today_wd not in eval(habit["schedule"]):
-            return  # не день из расписания
+@router.message(Command("export"))
+async def cmd_export(message: Message):
+    """/export [chat_id] [csv] — выгрузка привычек и отметок (всех или одного чата) файлом."""
+    if not is_admin(message):
+        return
+    args = (message.text or "").split()[1:]
+    fmt = "csv" if "csv" in args else "jsonl"
+    chat_id = next((int(a) for a in args if a.lstrip("-").isdigit()), None)
+    fd, path = tempfile.mkstemp(suffix=f".{fmt}")
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8", newline="") as out:
+            count = await export_to(db.path, out, fmt, chat_id)
+        name = f"habits-{chat_id or 'all'}-{date.today().isoformat()}.{fmt}"
+        await message.answer_document(FSInputFile(path, filename=name), caption=f"Записей: {count}")
+    finally:
+        os.remove(path)
 
+@router.message(Command("import"))
+async def cmd_import(message: Message):
+    """/import в подписи к файлу .jsonl/.csv (или ответом на сообщение с файлом) — загрузка выгрузки."""
+    if not is_admin(message):
+        return
+    document = message.document or (message.reply_to_message.document if message.reply_to_message else None)
+    if document is None:
+        await message.answer("Пришли файл .jsonl или .csv с подписью /import.")
+        return
+    fmt = "csv" if (document.file_name or "").lower().endswith(".csv") else "jsonl"
+    fd, path = tempfile.mkstemp(suffix=f".{fmt}")
+    os.close(fd)
     try:
-        await bot.send_message(chat_id, f"⏰ Напоминание: {habit['name']}")
-    except Exception as e:
-        print("Ошибка отправки напоминания:", e)
+        await bot.download(document, destination=path)
+        counts, created = await import_file(db, path, fmt)
+    finally:
+        os.remove(path)
+    # напоминания — только новым привычкам; у существующих они уже стоят
+    for habit in created:
+        if habit["reminder_time"]:
+            user = await db.get_user_by_chat(habit["chat_id"])
+            reminders.add({**habit, "tz": user.get("tz") if user else None})
+    await message.answer(
+        f"Загружено: пользователей {counts['users']}, привычек {counts['habits']} "
+        f"(новых {counts['habits_created']}), отметок {counts['progress_inserted']} из {counts['progress']}, "
+        f"пропущено {counts['skipped']}."
+    )
 
-@router.callback_query(lambda c: c.data and c.data.startswith("habit:del:") and not c.data.startswith("habit:del:yes:"))
-async def cb_habit_delete_confirm(callback: CallbackQuery):
-    await callback.answer()
-    parts = callback.data.split(":")
-    habit_id = int(parts[2])
 
-    habit = await db.get_habit(habit_id)
-    user = await db.get_user_by_chat(callback.message.chat.id)
-    if not habit or not user or habit["user_id"] != user["id"]:
-        await callback.answer("Нельзя удалить эту привычку.", show_alert=True)
-        return
+scheduler = AsyncIOScheduler()
+
+async def send_reminder(habit):
+    # расписание и отметку за сегодня уже проверил ReminderDispatcher;
+    # сама отправка — через очередь с лимитами Telegram
+    outbox.send_message(habit["chat_id"], f"⏰ Напоминание: {habit['name']}")
+
+DIGEST_HEADER = "⏰ Напоминания"
+
+async def send_reminder_digest(chat_id: int, habits: List[dict]):
+    # все напоминания минуты для чата — одно сообщение с клавиатурой «на сегодня»
+    user = {"id": habits[0]["user_id"], "chat_id": chat_id, "tz": habits[0].get("tz")}
+    kb = await build_today_habits_keyboard(user)
+    names = "\n".join(f"• {h['name']}" for h in habits)
+    outbox.send_message(chat_id, f"{DIGEST_HEADER}:\n{names}\n\nОтметь выполненные кнопками ниже.", reply_markup=kb)
+
+reminders = ReminderDispatcher(db, send_reminder, send_reminder_digest)
+
+@router.callback_query(
+    lambda c: c.data and c.data.startswith("habit:del:") and not c.data.startswith("habit:del:yes:"),
+    flags={"habit": "Нельзя удалить эту привычку."},
+)
+async def cb_habit_delete_confirm(callback: CallbackQuery, habit: dict):
+    await callback.answer()
+    habit_id = habit["id"]
 
     kb = InlineKeyboardBuilder()
     kb.row(
@@ -575,32 +949,19 @@ async def cb_habit_delete_confirm(callback: CallbackQuery):
     )
 
 
-@router.callback_query(lambda c: c.data and c.data.startswith("habit:del:yes:"))
-async def cb_habit_delete_execute(callback: CallbackQuery):
+@router.callback_query(lambda c: c.data and c.data.startswith("habit:del:yes:"), flags={"habit": "Нельзя удалить эту привычку."})
+async def cb_habit_delete_execute(callback: CallbackQuery, habit: dict):
     await callback.answer()
-    parts = callback.data.split(":")
-    habit_id = int(parts[3])
-
-    habit = await db.get_habit(habit_id)
-    user = await db.get_user_by_chat(callback.message.chat.id)
-    if not habit or not user or habit["user_id"] != user["id"]:
-        await callback.answer("Нельзя удалить эту привычку.", show_alert=True)
-        return
+    habit_id = habit["id"]
 
     await db.delete_habit(habit_id)
+    reminders.remove(habit_id)
     await callback.message.edit_text(f"Привычка «{habit['name']}» удалена ✅")
 
-@router.callback_query(lambda c: c.data and c.data.startswith("habit:edit:"))
-async def cb_habit_edit(callback: CallbackQuery, state: FSMContext):
+@router.callback_query(lambda c: c.data and c.data.startswith("habit:edit:"), flags={"habit": "Нельзя редактировать эту привычку."})
+async def cb_habit_edit(callback: CallbackQuery, state: FSMContext, habit: dict):
     await callback.answer()
-    parts = callback.data.split(":")
-    habit_id = int(parts[2])
-
-    habit = await db.get_habit(habit_id)
-    user = await db.get_user_by_chat(callback.message.chat.id)
-    if not habit or not user or habit["user_id"] != user["id"]:
-        await callback.answer("Нельзя редактировать эту привычку.", show_alert=True)
-        return
+    habit_id = habit["id"]
 
     await state.update_data(habit_id=habit_id)
 
@@ -632,9 +993,13 @@ async def edit_habit_frequency(message: Message, state: FSMContext):
         if freq not in ("daily", "weekly"):
             await message.answer("Некорректная частота. Введи daily или weekly, либо «-».")
             return
-        await db.update_habit(habit_id, frequency=freq)
+        if freq == "daily":
+            # ежедневная привычка — все дни недели
+            await db.update_habit(habit_id, frequency=freq, schedule=None)
+        else:
+            await db.update_habit(habit_id, frequency=freq)
 
-    await message.answer("Укажи расписание (например [0,2,4]) или «-», чтобы оставить как есть.")
+    await message.answer("Укажи дни недели (например: пн, ср, пт или 0,2,4) или «-», чтобы оставить как есть.")
     await state.set_state(EditHabitStates.waiting_for_schedule)
 
 @router.message(EditHabitStates.waiting_for_schedule)
@@ -645,11 +1010,11 @@ async def edit_habit_schedule(message: Message, state: FSMContext):
 
     if sched != "-":
         try:
-            schedule = json.loads(sched) 
-            await db.update_habit(habit_id, schedule=schedule)
-        except Exception:
-            await message.answer("Некорректный формат. Введи JSON массив (например [0,2,4]) или «-».")
+            schedule = parse_weekdays(sched)
+        except ValueError as e:
+            await message.answer(f"Не понял дни: {e}\nПример: 'пн, ср, пт' или '0,2,4', либо «-».")
             return
+        await db.update_habit(habit_id, schedule=schedule)
 
     await message.answer("Укажи время напоминания (HH:MM) или «-», чтобы оставить как есть.")
     await state.set_state(EditHabitStates.waiting_for_reminder)
@@ -665,6 +1030,8 @@ async def edit_habit_reminder(message: Message, state: FSMContext):
             await message.answer("Некорректный формат времени. Используй HH:MM или «-».")
             return
         await db.update_habit(habit_id, reminder_time=rem)
+        user = await db.get_user_by_chat(message.chat.id)
+        reminders.add({"id": habit_id, "reminder_time": rem, "tz": user.get("tz") if user else None})
 
     await state.clear()
     await message.answer("✅ Привычка успешно обновлена!")
@@ -1,5 +1,6 @@
 from dataclasses import dataclass
 from os import getenv
+from typing import Optional, Tuple
 from dotenv import load_dotenv
 
 load_dotenv() 
@@ -7,9 +8,63 @@ load_dotenv()
 @dataclass
 class Settings:
     bot_token: str
+    cache_size: int = 10000     # макс. записей в каждом кэше
+    cache_ttl: float = 300.0    # время жизни записи кэша, сек
+    send_rate: float = 25.0     # исходящих сообщений в секунду (на весь бот)
+    send_chat_rate: float = 1.0 # исходящих сообщений в секунду на один чат
+    send_workers: int = 8       # число задач, отправляющих сообщения
+    db_synchronous: str = "NORMAL"  # PRAGMA synchronous: OFF / NORMAL / FULL
+    db_batch_delay: float = 0.005   # окно group commit, сек
+    db_batch_size: int = 100        # макс. записей в одной транзакции
+    db_readers: int = 0             # соединений только для чтения (0 — читать через писателя)
+    fsm_ttl: float = 86400.0        # через сколько секунд брошенный диалог (/add, правка) удаляется
+    fsm_cache_size: int = 10000     # макс. состояний FSM в памяти
+    webhook_url: Optional[str] = None  # публичный адрес; если задан — webhook вместо polling
+    webhook_host: str = "0.0.0.0"
+    webhook_port: int = 8080
+    webhook_path: str = "/webhook"
+    webhook_secret: Optional[str] = None
+    webhook_concurrency: int = 100  # одновременно обрабатываемых обновлений
+    db_path: str = "data/habits.db"
+    shards: int = 1                 # >1 — фронт + столько процессов-воркеров со своими шардами базы
+    archive_horizon_days: int = 400 # отметки старше — в помесячный архив (0 — не архивировать)
+    db_slow_query: float = 0.1      # запросы дольше (сек) пишутся в лог с планом
+    admin_ids: Tuple[int, ...] = () # Telegram id пользователей с доступом к служебным командам
+    metrics_host: str = "127.0.0.1"
+    metrics_port: int = 0           # >0 — отдавать метрики Prometheus на http://host:port/metrics
+    analytics_dir: Optional[str] = None  # каталог колоночных снимков для аналитики (None — не делать)
+    analytics_keep: int = 3         # сколько последних снимков хранить
 
 def get_settings() -> Settings:
     token = getenv("BOT_TOKEN")
     if not token:
         raise RuntimeError("BOT_TOKEN is not set. Put it into .env as BOT_TOKEN=...")
-    return Settings(bot_token=token)
+    return Settings(
+        bot_token=token,
+        cache_size=int(getenv("CACHE_SIZE", "10000")),
+        cache_ttl=float(getenv("CACHE_TTL", "300")),
+        send_rate=float(getenv("SEND_RATE", "25")),
+        send_chat_rate=float(getenv("SEND_CHAT_RATE", "1")),
+        send_workers=int(getenv("SEND_WORKERS", "8")),
+        db_synchronous=getenv("DB_SYNCHRONOUS", "NORMAL").upper(),
+        db_batch_delay=float(getenv("DB_BATCH_DELAY_MS", "5")) / 1000,
+        db_batch_size=int(getenv("DB_BATCH_SIZE", "100")),
+        db_readers=int(getenv("DB_READERS", "0")),
+        fsm_ttl=float(getenv("FSM_TTL", "86400")),
+        fsm_cache_size=int(getenv("FSM_CACHE_SIZE", "10000")),
+        webhook_url=getenv("WEBHOOK_URL") or None,
+        webhook_host=getenv("WEBHOOK_HOST", "0.0.0.0"),
+        webhook_port=int(getenv("WEBHOOK_PORT", "8080")),
+        webhook_path=getenv("WEBHOOK_PATH", "/webhook"),
+        webhook_secret=getenv("WEBHOOK_SECRET") or None,
+        webhook_concurrency=int(getenv("WEBHOOK_CONCURRENCY", "100")),
+        db_path=getenv("DB_PATH", "data/habits.db"),
+        shards=int(getenv("SHARDS", "1")),
+        archive_horizon_days=int(getenv("ARCHIVE_HORIZON_DAYS", "400")),
+        db_slow_query=float(getenv("DB_SLOW_QUERY_MS", "100")) / 1000,
+        admin_ids=tuple(int(x) for x in getenv("ADMIN_IDS", "").replace(",", " ").split()),
+        metrics_host=getenv("METRICS_HOST", "127.0.0.1"),
+        metrics_port=int(getenv("METRICS_PORT", "0")),
+        analytics_dir=getenv("ANALYTICS_DIR") or None,
+        analytics_keep=int(getenv("ANALYTICS_KEEP", "3")),
+    )
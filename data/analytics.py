@@ -0,0 +1,273 @@
+# analytics.py
+"""
+Аналитика по колоночному снимку (data.snapshot): доля выполнения, распределение
+серий, тепловая карта по дням недели, удержание по когортам. Считается векторно
+на numpy по файлам снимка — рабочая база при этом не открывается.
+numpy нужен только этому модулю (pip install numpy), боту он не требуется.
+
+python -m data.analytics ROOT [rates|streaks|heatmap|retention] [--from=YYYY-MM-DD] [--to=YYYY-MM-DD] [--period=7]
+"""
+import os
+import sys
+from typing import Any, Dict, List, Optional, Tuple
+
+from data.snapshot import day_date, day_number, latest_snapshot, read_meta
+
+try:
+    import numpy as np
+except ImportError:  # снимки пишутся без numpy, а запросы без него не работают
+    np = None
+
+
+def _require_numpy() -> None:
+    if np is None:
+        raise RuntimeError("numpy is required for data.analytics: pip install numpy")
+
+
+def load_snapshot(path: str) -> Dict[str, Any]:
+    """
+    Колонки снимка как массивы numpy, отображённые в память (mmap, только чтение).
+    path — каталог снимка или корень с LATEST. Ключи — 'таблица.колонка' и 'meta'.
+    """
+    _require_numpy()
+    path = latest_snapshot(path)
+    meta = read_meta(path)
+    snap: Dict[str, Any] = {"meta": meta, "path": path}
+    for column, rows in meta["rows"].items():
+        file = os.path.join(path, f"{column}.npy")
+        # пустой файл данных mmap не открывает
+        snap[column] = np.load(file, mmap_mode="r") if rows else np.load(file)
+    return snap
+
+
+# ---------- Календарь ----------
+def weekday(days):
+    """Номер дня -> день недели, 0 = пн (1970-01-01 — четверг)."""
+    return (days + 3) % 7
+
+
+def _weekday_counts(a, b):
+    """(7, n): сколько дней каждого дня недели в отрезках [a, b] (пустой, если a > b)."""
+    a = np.asarray(a, dtype=np.int64)
+    b = np.asarray(b, dtype=np.int64)
+    out = np.empty((7,) + np.broadcast(a, b).shape, dtype=np.int64)
+    for w in range(7):
+        c = (w - 3) % 7  # день d попадает на w, если d ≡ c (mod 7)
+        out[w] = np.maximum((b - c) // 7 - (a - 1 - c) // 7, 0)
+    return out
+
+
+def _scheduled_counts(masks, a, b):
+    """Число дней по расписанию (маска, бит 0 = пн) в отрезках [a, b]."""
+    counts = _weekday_counts(a, b)
+    masks = np.asarray(masks, dtype=np.int64)
+    bits = (masks[None, ...] >> np.arange(7).reshape((7,) + (1,) * masks.ndim)) & 1
+    return (bits * counts).sum(axis=0)
+
+
+def _window(snap: Dict[str, Any], start: Optional[int], end: Optional[int], days: int) -> Tuple[int, int]:
+    end = snap["meta"]["today"] if end is None else end
+    start = end - days + 1 if start is None else start
+    return start, end
+
+
+def _progress_rows(snap: Dict[str, Any], scheduled_only: bool = True):
+    """
+    Отметки, которые идут в расчёт: индекс привычки в habits.*, номер дня и маска.
+    С scheduled_only отметки вне расписания отбрасываются (для долей выполнения).
+    """
+    habit_ids = snap["habits.id"]
+    hid = snap["progress.habit_id"]
+    day = np.asarray(snap["progress.day"], dtype=np.int64)
+    hidx = np.searchsorted(habit_ids, hid)
+    known = hidx < len(habit_ids)
+    known[known] = habit_ids[hidx[known]] == hid[known]
+    hidx, day = hidx[known], day[known]
+    mask = np.asarray(snap["habits.schedule_mask"], dtype=np.int64)[hidx]
+    if not scheduled_only:
+        return hidx, day, mask
+    keep = ((mask >> weekday(day)) & 1).astype(bool)
+    return hidx[keep], day[keep], mask[keep]
+
+
+# ---------- Запросы ----------
+def completion_rates(snap: Dict[str, Any], start: Optional[int] = None, end: Optional[int] = None) -> Dict[str, Any]:
+    """
+    Доля выполнения по привычкам за [start, end] (номера дней; по умолчанию 30 дней
+    до даты снимка): выполнено / дней по расписанию начиная с habits.start_day.
+    """
+    start, end = _window(snap, start, end, 30)
+    hidx, day, _ = _progress_rows(snap)
+    inside = (day >= start) & (day <= end)
+    n = len(snap["habits.id"])
+    done = np.bincount(hidx[inside], minlength=n)
+    expected = _scheduled_counts(snap["habits.schedule_mask"], np.maximum(snap["habits.start_day"], start), end)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        rate = np.where(expected > 0, done / expected, np.nan)
+    return {
+        "start": start,
+        "end": end,
+        "habit_id": np.asarray(snap["habits.id"]),
+        "user_id": np.asarray(snap["habits.user_id"]),
+        "done": done,
+        "expected": expected,
+        "rate": rate,
+        "overall": float(done.sum() / expected.sum()) if expected.sum() else float("nan"),
+    }
+
+
+def streak_distribution(snap: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Серии выполнения по всей истории: подряд идущие отметки без пропуска дня по
+    расписанию (как в habit_stats — отметки вне расписания тоже входят в серию).
+    histogram[k] — число серий длины k, longest — самая длинная серия каждой привычки.
+    """
+    hidx, day, mask = _progress_rows(snap, scheduled_only=False)
+    n = len(snap["habits.id"])
+    if not len(day):
+        return {"histogram": np.zeros(1, dtype=np.int64), "longest": np.zeros(n, dtype=np.int64), "runs": 0}
+    # серия продолжается, если между соседними отметками нет ни одного дня по расписанию
+    # (stats.streak_continues)
+    gap = _scheduled_counts(mask[1:], day[:-1] + 1, day[1:] - 1)
+    continues = (hidx[1:] == hidx[:-1]) & (gap == 0)
+    starts = np.flatnonzero(np.concatenate(([True], ~continues)))
+    lengths = np.diff(np.append(starts, len(day)))
+    longest = np.zeros(n, dtype=np.int64)
+    np.maximum.at(longest, hidx[starts], lengths)
+    return {"histogram": np.bincount(lengths), "longest": longest, "runs": len(lengths)}
+
+
+def weekday_heatmap(snap: Dict[str, Any], start: Optional[int] = None, end: Optional[int] = None) -> Dict[str, Any]:
+    """
+    Недели × дни недели (пн..вс) за [start, end] (по умолчанию 12 недель): done —
+    отметок, expected — привычек по расписанию на этот день, rate — их отношение.
+    Дни вне окна — нули в expected и NaN в rate.
+    """
+    start, end = _window(snap, start, end, 84)
+    days = np.arange(start, end + 1, dtype=np.int64)
+    monday = start - int(weekday(start))
+    week = (days - monday) // 7
+    wd = weekday(days)
+    hidx, day, _ = _progress_rows(snap)
+    inside = (day >= start) & (day <= end)
+    done_by_day = np.bincount(day[inside] - start, minlength=len(days))
+
+    expected_by_day = np.zeros(len(days), dtype=np.int64)
+    masks = np.asarray(snap["habits.schedule_mask"], dtype=np.int64)
+    start_day = np.asarray(snap["habits.start_day"], dtype=np.int64)
+    for w in range(7):
+        # привычки с этим днём в расписании, начатые не позже дня
+        born = np.sort(start_day[((masks >> w) & 1).astype(bool)])
+        sel = wd == w
+        expected_by_day[sel] = np.searchsorted(born, days[sel], side="right")
+
+    weeks = int(week[-1]) + 1 if len(days) else 0
+    done = np.zeros((weeks, 7), dtype=np.int64)
+    expected = np.zeros((weeks, 7), dtype=np.int64)
+    done[week, wd] = done_by_day
+    expected[week, wd] = expected_by_day
+    with np.errstate(divide="ignore", invalid="ignore"):
+        rate = np.where(expected > 0, done / expected, np.nan)
+    return {
+        "week_start": monday + 7 * np.arange(weeks),
+        "done": done,
+        "expected": expected,
+        "rate": rate,
+        "by_weekday": done.sum(axis=0) / np.maximum(expected.sum(axis=0), 1),
+    }
+
+
+def retention(snap: Dict[str, Any], period: int = 7, periods: int = 12) -> Dict[str, Any]:
+    """
+    Удержание по когортам. Когорта — период (по умолчанию неделя с пн), в котором
+    пользователь начал первую привычку (habits.start_day); active[c, k] — сколько пользователей когорты c
+    отметили хоть что-то в k-й период от своего начала, rate — доля от size.
+    """
+    user_ids = snap["users.id"]
+    start_day = np.asarray(snap["habits.start_day"], dtype=np.int64)
+    huser = np.searchsorted(user_ids, snap["habits.user_id"])
+    first = np.full(len(user_ids), np.iinfo(np.int64).max, dtype=np.int64)
+    np.minimum.at(first, huser, start_day)
+    has_habits = first != np.iinfo(np.int64).max
+
+    bucket = (first + 3) // period  # при period=7 недели начинаются с понедельника
+    cohorts = np.unique(bucket[has_habits])
+    cohort_of = np.searchsorted(cohorts, bucket)
+    size = np.bincount(cohort_of[has_habits], minlength=len(cohorts))
+
+    hidx, day, _ = _progress_rows(snap)
+    users = huser[hidx]
+    k = (day - first[users]) // period
+    valid = (k >= 0) & (k < periods)
+    # каждый пользователь учитывается в периоде один раз
+    pairs = np.unique(users[valid] * periods + k[valid])
+    active = np.zeros((len(cohorts), periods), dtype=np.int64)
+    np.add.at(active, (cohort_of[pairs // periods], pairs % periods), 1)
+    return {
+        "cohort_start": cohorts * period - 3,
+        "size": size,
+        "active": active,
+        "rate": active / np.maximum(size, 1)[:, None],
+    }
+
+
+# ---------- CLI ----------
+def _print_rates(snap: Dict[str, Any], start: Optional[int], end: Optional[int]) -> None:
+    r = completion_rates(snap, start, end)
+    rate = r["rate"][~np.isnan(r["rate"])]
+    print(f"{day_date(r['start'])} — {day_date(r['end'])}: habits {len(rate)}, overall {r['overall']:.1%}")
+    if len(rate):
+        for q in (0.1, 0.25, 0.5, 0.75, 0.9):
+            print(f"  p{int(q * 100):<2} {np.quantile(rate, q):.1%}")
+
+
+def _print_streaks(snap: Dict[str, Any]) -> None:
+    s = streak_distribution(snap)
+    hist = s["histogram"]
+    print(f"runs {s['runs']}, longest {len(hist) - 1}")
+    for lo, hi in ((1, 1), (2, 3), (4, 7), (8, 14), (15, 30), (31, 90), (91, len(hist))):
+        if lo >= len(hist):
+            break
+        print(f"  {lo}-{hi}: {int(hist[lo:hi + 1].sum())}")
+
+
+def _print_heatmap(snap: Dict[str, Any], start: Optional[int], end: Optional[int]) -> None:
+    h = weekday_heatmap(snap, start, end)
+    print("week        " + " ".join(f"{d:>5}" for d in ("пн", "вт", "ср", "чт", "пт", "сб", "вс")))
+    for i, ws in enumerate(h["week_start"]):
+        cells = " ".join("    ·" if np.isnan(x) else f"{x:5.0%}" for x in h["rate"][i])
+        print(f"{day_date(ws)}  {cells}")
+    print("all         " + " ".join(f"{x:5.0%}" for x in h["by_weekday"]))
+
+
+def _print_retention(snap: Dict[str, Any], period: int) -> None:
+    r = retention(snap, period=period)
+    print("cohort        size  " + " ".join(f"{k:>5}" for k in range(r["rate"].shape[1])))
+    for i, cs in enumerate(r["cohort_start"]):
+        print(f"{day_date(cs)}  {r['size'][i]:>5}  " + " ".join(f"{x:5.0%}" for x in r["rate"][i]))
+
+
+def _cli_main(argv: List[str]) -> int:
+    opts = dict(a[2:].split("=", 1) for a in argv if a.startswith("--") and "=" in a)
+    args = [a for a in argv if not a.startswith("--")]
+    if not args or len(args) > 2 or (len(args) == 2 and args[1] not in ("rates", "streaks", "heatmap", "retention")):
+        print(__doc__)
+        return 2
+    snap = load_snapshot(args[0])
+    start = day_number(opts["from"]) if "from" in opts else None
+    end = day_number(opts["to"]) if "to" in opts else None
+    print(f"snapshot {snap['path']} ({snap['meta']['created_at']})")
+    command = args[1] if len(args) == 2 else "rates"
+    if command == "rates":
+        _print_rates(snap, start, end)
+    elif command == "streaks":
+        _print_streaks(snap)
+    elif command == "heatmap":
+        _print_heatmap(snap, start, end)
+    else:
+        _print_retention(snap, int(opts.get("period", 7)))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(_cli_main(sys.argv[1:]))
@@ -0,0 +1,29 @@
+# archive.py
+import calendar
+import datetime
+from typing import Iterable, List
+
+
+def month_key(day: str) -> str:
+    """'YYYY-MM-DD' -> 'YYYY-MM'"""
+    return day[:7]
+
+
+def days_to_bits(days: Iterable[str]) -> int:
+    """Даты одного месяца -> битовая маска (бит 0 = 1-е число)."""
+    bits = 0
+    for d in days:
+        bits |= 1 << (int(d[8:10]) - 1)
+    return bits
+
+
+def expand_month(month: str, bits: int) -> List[str]:
+    """'YYYY-MM' + маска -> отсортированный список ISO-дат."""
+    year, mon = int(month[:4]), int(month[5:7])
+    last = calendar.monthrange(year, mon)[1]
+    return [f"{month}-{d:02d}" for d in range(1, last + 1) if bits >> (d - 1) & 1]
+
+
+def archive_cutoff(today: datetime.date, horizon_days: int) -> datetime.date:
+    """Граница архива: первое число месяца, в который попадает today - horizon_days (архивируются только целые месяцы)."""
+    return (today - datetime.timedelta(days=horizon_days)).replace(day=1)
@@ -0,0 +1,225 @@
+# cache.py
+import datetime
+import itertools
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, List, Optional
+
+from data.db import Database
+
+_MISSING = object()
+
+
+class LRUCache:
+    """
+    Простой LRU-кэш с TTL. Размер ограничен maxsize — самые старые записи вытесняются.
+    """
+
+    def __init__(self, maxsize: int = 10000, ttl: float = 300.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: "OrderedDict[Hashable, tuple]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        item = self._data.get(key, _MISSING)
+        if item is _MISSING:
+            self.misses += 1
+            return default
+        value, expires = item
+        if expires < time.monotonic():
+            del self._data[key]
+            self.misses += 1
+            return default
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None) -> None:
+        """ttl — срок жизни этой записи в секундах, по умолчанию общий self.ttl."""
+        if self.maxsize <= 0:
+            return
+        self._data[key] = (value, time.monotonic() + (self.ttl if ttl is None else ttl))
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key: Hashable) -> None:
+        self._data.pop(key, None)
+
+    def clear(self) -> None:
+        self._data.clear()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def stats(self) -> Dict[str, int]:
+        return {"size": len(self._data), "hits": self.hits, "misses": self.misses}
+
+
+def cache_prometheus(stats: Dict[str, Dict[str, int]], prefix: str = "habits_bot") -> str:
+    """Метрики кэшей {имя: LRUCache.stats()} в формате Prometheus, имя — метка cache."""
+    lines = []
+    for field, kind in (("hits", "counter"), ("misses", "counter"), ("size", "gauge")):
+        metric = f"{prefix}_cache_{field}" + ("_total" if kind == "counter" else "")
+        lines.append(f"# TYPE {metric} {kind}")
+        for name, s in stats.items():
+            lines.append(f'{metric}{{cache="{name}"}} {s[field]}')
+    return "\n".join(lines) + "\n"
+
+
+def format_cache_stats(stats: Dict[str, Dict[str, int]]) -> str:
+    """Однострочная сводка для /dbstats: имя hit-rate (попаданий/обращений, размер)."""
+    parts = []
+    for name, s in stats.items():
+        total = s["hits"] + s["misses"]
+        rate = f"{s['hits'] / total:.0%}" if total else "—"
+        parts.append(f"{name} {rate} ({s['hits']}/{total}, {s['size']} зап.)")
+    return "Кэш: " + ", ".join(parts)
+
+
+class CachedDatabase:
+    """
+    Read-through кэш поверх Database: пользователи, привычки и статус на сегодня.
+    Записи (add_habit, update_habit, delete_habit, mark_done) явно сбрасывают
+    затронутые ключи. Остальные методы прозрачно проксируются в Database.
+    """
+
+    def __init__(self, db: Database, maxsize: int = 10000, ttl: float = 300.0):
+        self.db = db
+        self.users = LRUCache(maxsize, ttl)        # chat_id -> user
+        self.habits = LRUCache(maxsize, ttl)       # habit_id -> habit
+        self.user_habits = LRUCache(maxsize, ttl)  # user_id -> [habit]
+        self.today = LRUCache(maxsize, ttl)        # (user_id, date) -> [habit + done]
+        self.versions = LRUCache(maxsize, ttl)     # user_id -> версия данных
+        self._version_seq = itertools.count(1)
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self.db, name)
+
+    def stats(self) -> Dict[str, Dict[str, int]]:
+        return {
+            "users": self.users.stats(),
+            "habits": self.habits.stats(),
+            "user_habits": self.user_habits.stats(),
+            "today": self.today.stats(),
+        }
+
+    def data_version(self, user_id: int) -> int:
+        """
+        Версия данных пользователя для кэша отрисовки. Номера берутся из общего
+        счётчика, поэтому вытесненная запись не может вернуть старую версию.
+        """
+        version = self.versions.get(user_id)
+        if version is None:
+            version = next(self._version_seq)
+            self.versions.set(user_id, version)
+        return version
+
+    def invalidate_user(self, user_id: int) -> None:
+        self.versions.set(user_id, next(self._version_seq))
+        self.user_habits.pop(user_id)
+        # «сегодня» пользователя в его поясе отличается от даты сервера не больше чем на день
+        server_today = datetime.date.today()
+        for shift in (-1, 0, 1):
+            self.today.pop((user_id, (server_today + datetime.timedelta(days=shift)).isoformat()))
+
+    # ---------- Users ----------
+    async def add_user(self, chat_id: int, username: Optional[str] = None) -> int:
+        self.users.pop(chat_id)
+        return await self.db.add_user(chat_id=chat_id, username=username)
+
+    async def get_user_by_chat(self, chat_id: int) -> Optional[dict]:
+        user = self.users.get(chat_id)
+        if user is None:
+            user = await self.db.get_user_by_chat(chat_id)
+            if user is not None:
+                self.users.set(chat_id, user)
+        return user
+
+    async def set_user_timezone(self, chat_id: int, tz: Optional[str]) -> None:
+        user = await self.get_user_by_chat(chat_id)
+        await self.db.set_user_timezone(chat_id, tz)
+        self.users.pop(chat_id)
+        if user:
+            self.invalidate_user(user["id"])
+
+    async def set_user_digest(self, chat_id: int, enabled: bool) -> None:
+        await self.db.set_user_digest(chat_id, enabled)
+        self.users.pop(chat_id)
+
+    async def get_user_and_habit(self, chat_id: int, habit_id: int):
+        user = self.users.get(chat_id)
+        habit = self.habits.get(habit_id)
+        if user is not None and habit is not None and habit["user_id"] == user["id"]:
+            return user, habit
+        user, habit = await self.db.get_user_and_habit(chat_id, habit_id)
+        if user is not None:
+            self.users.set(chat_id, user)
+        if habit is not None:
+            self.habits.set(habit_id, habit)
+        return user, habit
+
+    # ---------- Habits ----------
+    async def get_habit(self, habit_id: int) -> Optional[dict]:
+        habit = self.habits.get(habit_id)
+        if habit is None:
+            habit = await self.db.get_habit(habit_id)
+            if habit is not None:
+                self.habits.set(habit_id, habit)
+        return habit
+
+    async def get_habits(self, user_id: int) -> List[dict]:
+        habits = self.user_habits.get(user_id)
+        if habits is None:
+            habits = await self.db.get_habits(user_id)
+            self.user_habits.set(user_id, habits)
+        return habits
+
+    async def get_today_habits(self, user_id: int, today: Optional[datetime.date] = None) -> List[dict]:
+        today_wd = (today or datetime.date.today()).weekday()
+        return [h for h in await self.get_habits(user_id) if Database._is_scheduled(h, today_wd)]
+
+    async def get_today_status(self, user_id: int, today: Optional[datetime.date] = None) -> List[dict]:
+        today = today or datetime.date.today()
+        key = (user_id, today.isoformat())
+        status = self.today.get(key)
+        if status is None:
+            status = await self.db.get_today_status(user_id, today)
+            self.today.set(key, status)
+        return status
+
+    async def add_habit(self, user_id: int, name: str, frequency: str, schedule=None, reminder_time=None):
+        habit_id = await self.db.add_habit(user_id, name, frequency, schedule=schedule, reminder_time=reminder_time)
+        self.invalidate_user(user_id)
+        return habit_id
+
+    async def update_habit(self, habit_id: int, **fields) -> None:
+        habit = await self.get_habit(habit_id)
+        await self.db.update_habit(habit_id, **fields)
+        self.habits.pop(habit_id)
+        if habit:
+            self.invalidate_user(habit["user_id"])
+
+    async def delete_habit(self, habit_id: int) -> None:
+        habit = await self.get_habit(habit_id)
+        await self.db.delete_habit(habit_id)
+        self.habits.pop(habit_id)
+        if habit:
+            self.invalidate_user(habit["user_id"])
+
+    # ---------- Progress ----------
+    async def mark_done(self, habit_id: int, date: Optional[str] = None, today: Optional[datetime.date] = None) -> None:
+        await self.db.mark_done(habit_id, date=date, today=today)
+        habit = await self.get_habit(habit_id)
+        if habit:
+            self.invalidate_user(habit["user_id"])
+
+    async def mark_many(self, habit_ids: List[int], dates: List[str], today: Optional[datetime.date] = None) -> int:
+        added = await self.db.mark_many(habit_ids, dates, today=today)
+        # версия данных меняется один раз на пользователя, а не на каждую отметку
+        users = {h["user_id"] for h in [await self.get_habit(hid) for hid in habit_ids] if h}
+        for user_id in users:
+            self.invalidate_user(user_id)
+        return added
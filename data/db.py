@@ -1,18 +1,368 @@
 # db.py
+import asyncio
 import aiosqlite
+import contextvars
+import logging
 import os
 import json
+import re
+import time
 import datetime
-from typing import Optional, List, Dict, Any
+from contextlib import asynccontextmanager
+from typing import Optional, List, Dict, Any, Set, Tuple, Callable, Awaitable
+
+from data.archive import archive_cutoff, expand_month, month_key
+from data.metrics import QueryMetrics, current_timings, instrument_methods, normalize_sql
+from data.stats import compute_habit_stats, parse_iso, previous_scheduled, streak_continues
+from data.tz import local_today
+
+logger = logging.getLogger(__name__)
 
 DB_DIR = "data"
 DB_FILE = os.path.join(DB_DIR, "habits.db")
 
 
+ALL_DAYS = 0b1111111  # маска «каждый день»
+ALL_ZONES = "*"  # rollover_habit_stats: пользователи всех поясов
+
+
+def days_to_mask(days) -> int:
+    """Список дней недели 0..6 (0=пн) -> битовая маска."""
+    mask = 0
+    for d in days:
+        mask |= 1 << int(d)
+    return mask
+
+
+def mask_to_days(mask: int) -> List[int]:
+    """Битовая маска -> отсортированный список дней недели 0..6."""
+    return [d for d in range(7) if mask >> d & 1]
+
+
+class ManyRows(list):
+    """Параметры для executemany: команда с такими параметрами выполняется по всем строкам сразу."""
+
+
+class Deferred:
+    """
+    Команды, которые строит сам писатель в момент выполнения: build() — корутина,
+    возвращающая список (SQL, параметры). Чтения внутри build() идут через соединение
+    писателя и видят все записи, поставленные в очередь раньше (в т.ч. этим же _write_many).
+    """
+
+    def __init__(self, build: Callable[[], Awaitable[List[Tuple[str, Any]]]]):
+        self.build = build
+
+
+# True внутри задачи писателя: её чтения идут через соединение писателя
+_in_writer: contextvars.ContextVar[bool] = contextvars.ContextVar("in_writer", default=False)
+
+
+# ---------- Миграции ----------
+# Миграция — корутина (conn) -> список SQL-команд. Номер версии = позиция в MIGRATIONS.
+async def _m001_base_schema(conn: aiosqlite.Connection) -> List[str]:
+    return [
+        """
+        CREATE TABLE IF NOT EXISTS users (
+          id INTEGER PRIMARY KEY AUTOINCREMENT,
+          username TEXT,
+          chat_id INTEGER UNIQUE NOT NULL
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS habits (
+          id INTEGER PRIMARY KEY AUTOINCREMENT,
+          user_id INTEGER NOT NULL,
+          name TEXT NOT NULL,
+          frequency TEXT NOT NULL DEFAULT 'daily',
+          schedule TEXT,
+          created_at TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP,
+          FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS progress (
+          id INTEGER PRIMARY KEY AUTOINCREMENT,
+          habit_id INTEGER NOT NULL,
+          date TEXT NOT NULL,
+          status INTEGER NOT NULL DEFAULT 1,
+          UNIQUE (habit_id, date),
+          FOREIGN KEY (habit_id) REFERENCES habits(id) ON DELETE CASCADE
+        )
+        """,
+    ]
+
+
+async def _m002_reminder_time(conn: aiosqlite.Connection) -> List[str]:
+    # в старых базах колонку добавляли вручную — проверяем, есть ли она
+    cur = await conn.execute("PRAGMA table_info(habits)")
+    columns = {r[1] for r in await cur.fetchall()}
+    if "reminder_time" in columns:
+        return []
+    return ["ALTER TABLE habits ADD COLUMN reminder_time TEXT"]
+
+
+async def _m003_indexes(conn: aiosqlite.Connection) -> List[str]:
+    return [
+        "CREATE INDEX IF NOT EXISTS idx_habits_user ON habits(user_id)",
+        "CREATE INDEX IF NOT EXISTS idx_habits_reminder ON habits(reminder_time)",
+        "CREATE INDEX IF NOT EXISTS idx_progress_date_habit ON progress(date, habit_id)",
+    ]
+
+
+async def _m004_schedule_mask(conn: aiosqlite.Connection) -> List[str]:
+    # расписание -> 7-битная маска дней недели (бит 0 = понедельник);
+    # старая текстовая колонка schedule остаётся в таблице, но больше не используется
+    statements = [f"ALTER TABLE habits ADD COLUMN schedule_mask INTEGER NOT NULL DEFAULT {ALL_DAYS}"]
+    cur = await conn.execute("SELECT id, schedule, created_at FROM habits WHERE frequency = 'weekly'")
+    for habit_id, schedule, created_at in await cur.fetchall():
+        mask = 0
+        try:
+            if schedule:
+                mask = days_to_mask(json.loads(schedule))
+            elif created_at:
+                # weekly без расписания раньше считался по дню недели создания
+                created = datetime.datetime.strptime(created_at.split(" ")[0], "%Y-%m-%d").date()
+                mask = 1 << created.weekday()
+        except (ValueError, TypeError):
+            mask = 0
+        statements.append(f"UPDATE habits SET schedule_mask = {mask or ALL_DAYS} WHERE id = {int(habit_id)}")
+    return statements
+
+
+async def _m005_fsm_states(conn: aiosqlite.Connection) -> List[str]:
+    return [
+        """
+        CREATE TABLE IF NOT EXISTS fsm_states (
+          key TEXT PRIMARY KEY,
+          state TEXT,
+          data TEXT NOT NULL DEFAULT '{}',
+          updated_at REAL NOT NULL
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_fsm_states_updated ON fsm_states(updated_at)",
+    ]
+
+
+async def _m006_habit_stats(conn: aiosqlite.Connection) -> List[Any]:
+    statements: List[Any] = [
+        """
+        CREATE TABLE IF NOT EXISTS habit_stats (
+          habit_id INTEGER PRIMARY KEY,
+          current_streak INTEGER NOT NULL DEFAULT 0,
+          longest_streak INTEGER NOT NULL DEFAULT 0,
+          total_done INTEGER NOT NULL DEFAULT 0,
+          last_done TEXT,
+          done_7d INTEGER NOT NULL DEFAULT 0,
+          done_30d INTEGER NOT NULL DEFAULT 0,
+          updated_on TEXT,
+          FOREIGN KEY (habit_id) REFERENCES habits(id) ON DELETE CASCADE
+        )
+        """,
+    ]
+    # заполняем агрегаты по уже накопленной истории
+    cur = await conn.execute(
+        "SELECT h.id, h.schedule_mask, p.date FROM habits h JOIN progress p ON p.habit_id = h.id ORDER BY h.id, p.date"
+    )
+    today = datetime.date.today()
+    grouped: Dict[int, Tuple[int, List[datetime.date]]] = {}
+    for habit_id, mask, day in await cur.fetchall():
+        grouped.setdefault(habit_id, (mask, []))[1].append(parse_iso(day))
+    for habit_id, (mask, dates) in grouped.items():
+        statements.append((SQL_UPSERT_HABIT_STATS, {"habit_id": habit_id, **compute_habit_stats(dates, mask, today)}))
+    return statements
+
+
+async def _m007_progress_archive(conn: aiosqlite.Connection) -> List[str]:
+    return [
+        """
+        CREATE TABLE IF NOT EXISTS progress_archive (
+          habit_id INTEGER NOT NULL,
+          month TEXT NOT NULL,
+          days INTEGER NOT NULL,
+          PRIMARY KEY (habit_id, month),
+          FOREIGN KEY (habit_id) REFERENCES habits(id) ON DELETE CASCADE
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS meta (
+          key TEXT PRIMARY KEY,
+          value TEXT
+        )
+        """,
+    ]
+
+
+async def _m008_user_timezone(conn: aiosqlite.Connection) -> List[str]:
+    # NULL — местное время сервера (как было до появления поясов)
+    return [
+        "ALTER TABLE users ADD COLUMN tz TEXT",
+        "CREATE INDEX IF NOT EXISTS idx_users_tz ON users(tz)",
+    ]
+
+
+async def _m009_user_digest(conn: aiosqlite.Connection) -> List[str]:
+    # 1 — напоминания одной минуты приходят одним сообщением-сводкой
+    return ["ALTER TABLE users ADD COLUMN digest INTEGER NOT NULL DEFAULT 0"]
+
+
+MIGRATIONS = [
+    _m001_base_schema,
+    _m002_reminder_time,
+    _m003_indexes,
+    _m004_schedule_mask,
+    _m005_fsm_states,
+    _m006_habit_stats,
+    _m007_progress_archive,
+    _m008_user_timezone,
+    _m009_user_digest,
+]
+
+
+# ---------- Горячие запросы ----------
+SQL_USER_BY_CHAT = "SELECT * FROM users WHERE chat_id = ?"
+SQL_HABIT_BY_ID = "SELECT * FROM habits WHERE id = ?"
+# пользователь по чату и его привычка одним запросом; чужая или несуществующая привычка — NULL-колонки h.*
+SQL_USER_AND_HABIT = """
+SELECT u.id AS owner_id, u.username AS owner_username, u.chat_id AS owner_chat_id, u.tz AS owner_tz,
+       u.digest AS owner_digest, h.*
+FROM users u
+LEFT JOIN habits h ON h.id = ? AND h.user_id = u.id
+WHERE u.chat_id = ?
+"""
+SQL_HABITS_BY_USER = "SELECT * FROM habits WHERE user_id = ?"
+# reminder_time > '' отсекает и NULL, и пустую строку, и при этом идёт по индексу;
+# пояс владельца нужен, чтобы перевести время напоминания в UTC
+SQL_HABITS_WITH_REMINDERS = """
+    SELECT h.*, u.tz
+    FROM habits h
+    JOIN users u ON u.id = h.user_id
+    WHERE h.reminder_time > ''
+"""
+SQL_HABIT_PROGRESS_RANGE = "SELECT * FROM progress WHERE habit_id = ? AND date BETWEEN ? AND ? ORDER BY date"
+SQL_TODAY_HABITS = "SELECT * FROM habits WHERE user_id = ? AND schedule_mask & (1 << ?)"
+SQL_TODAY_STATUS = """
+    SELECT h.*, p.id IS NOT NULL AS done
+    FROM habits h
+    LEFT JOIN progress p ON p.habit_id = h.id AND p.date = ?
+    WHERE h.user_id = ? AND h.schedule_mask & (1 << ?)
+    ORDER BY h.id
+"""
+SQL_USER_PROGRESS = """
+    SELECT h.*, p.date AS done_date
+    FROM habits h
+    LEFT JOIN progress p ON p.habit_id = h.id AND p.date BETWEEN ? AND ?
+    WHERE h.user_id = ?
+    ORDER BY h.id
+"""
+SQL_DUE_REMINDERS = """
+    SELECT h.*, u.chat_id, u.tz, u.digest
+    FROM habits h
+    JOIN users u ON u.id = h.user_id
+    WHERE h.id IN (SELECT value FROM json_each(?))
+      AND h.schedule_mask & (1 << ?)
+      AND NOT EXISTS (
+        SELECT 1 FROM progress p WHERE p.habit_id = h.id AND p.date = ?
+      )
+"""
+
+SQL_USER_STATS = """
+    SELECT h.id, h.name, s.*
+    FROM habits h
+    LEFT JOIN habit_stats s ON s.habit_id = h.id
+    WHERE h.user_id = ?
+    ORDER BY h.id
+"""
+SQL_UPSERT_HABIT_STATS = """
+    INSERT OR REPLACE INTO habit_stats
+      (habit_id, current_streak, longest_streak, total_done, last_done, done_7d, done_30d, updated_on)
+    VALUES
+      (:habit_id, :current_streak, :longest_streak, :total_done, :last_done, :done_7d, :done_30d, :updated_on)
+"""
+# инкрементальное обновление при отметке за day >= last_done; серия продолжается,
+# если последняя отметка не раньше предыдущего дня по расписанию (:prev)
+SQL_MARK_HABIT_STATS = """
+    INSERT INTO habit_stats
+      (habit_id, current_streak, longest_streak, total_done, last_done, done_7d, done_30d, updated_on)
+    VALUES (:habit_id, 1, 1, 1, :day, :in_7d, :in_30d, :today)
+    ON CONFLICT(habit_id) DO UPDATE SET
+      current_streak = CASE WHEN last_done = :day THEN current_streak
+                            WHEN last_done >= :prev THEN current_streak + 1 ELSE 1 END,
+      longest_streak = MAX(longest_streak, CASE WHEN last_done = :day THEN current_streak
+                                                WHEN last_done >= :prev THEN current_streak + 1 ELSE 1 END),
+      total_done = total_done + (last_done IS NOT :day),
+      done_7d = done_7d + (:in_7d AND last_done IS NOT :day),
+      done_30d = done_30d + (:in_30d AND last_done IS NOT :day),
+      last_done = :day
+    WHERE last_done IS NULL OR last_done <= :day
+"""
+
+SQL_HABIT_ARCHIVE_RANGE = "SELECT habit_id, month, days FROM progress_archive WHERE habit_id = ? AND month BETWEEN ? AND ?"
+SQL_USER_ARCHIVE_RANGE = """
+    SELECT a.habit_id, a.month, a.days
+    FROM habits h
+    JOIN progress_archive a ON a.habit_id = h.id AND a.month BETWEEN ? AND ?
+    WHERE h.user_id = ?
+"""
+
+# запросы, которые не должны делать полный скан таблиц (проверяет check_query_plans)
+HOT_QUERIES = {
+    "get_user_by_chat": (SQL_USER_BY_CHAT, (1,)),
+    "get_habit": (SQL_HABIT_BY_ID, (1,)),
+    "get_user_and_habit": (SQL_USER_AND_HABIT, (1, 1)),
+    "get_habits": (SQL_HABITS_BY_USER, (1,)),
+    "get_all_habits_with_reminders": (SQL_HABITS_WITH_REMINDERS, ()),
+    "get_progress_for_habit": (SQL_HABIT_PROGRESS_RANGE, (1, "2000-01-01", "2000-01-31")),
+    "get_today_habits": (SQL_TODAY_HABITS, (1, 0)),
+    "get_today_status": (SQL_TODAY_STATUS, ("2000-01-01", 1, 0)),
+    "get_user_progress": (SQL_USER_PROGRESS, ("2000-01-01", "2000-01-31", 1)),
+    "get_due_reminders": (SQL_DUE_REMINDERS, ("[1]", 0, "2000-01-01")),
+    "get_user_stats": (SQL_USER_STATS, (1,)),
+    "archive_for_habit": (SQL_HABIT_ARCHIVE_RANGE, (1, "2000-01", "2000-12")),
+    "archive_for_user": (SQL_USER_ARCHIVE_RANGE, ("2000-01", "2000-12", 1)),
+}
+# «SCAN habits», «SCAN p» и т.п. — полный проход по таблице (виртуальные json_each не в счёт)
+FULL_SCAN_RE = re.compile(r"^SCAN (?!.*VIRTUAL TABLE)")
+
+
 class Database:
-    def __init__(self, path: str = DB_FILE):
+    def __init__(
+        self,
+        path: str = DB_FILE,
+        journal_mode: str = "WAL",
+        synchronous: str = "NORMAL",
+        batch_delay: float = 0.005,
+        batch_size: int = 100,
+        readers: int = 0,
+        slow_query_threshold: float = 0.1,
+    ):
+        if synchronous.upper() not in ("OFF", "NORMAL", "FULL", "EXTRA"):
+            raise ValueError(f"Unknown synchronous level: {synchronous}")
+        if readers and journal_mode.upper() != "WAL":
+            raise ValueError("Reader connections require journal_mode=WAL")
         self.path = path
         self.conn: Optional[aiosqlite.Connection] = None
+        self.journal_mode = journal_mode
+        self.synchronous = synchronous
+        # group commit: записи копятся batch_delay секунд (или до batch_size штук)
+        # и фиксируются одной транзакцией
+        self.batch_delay = batch_delay
+        self.batch_size = batch_size
+        self._write_queue: Optional[asyncio.Queue] = None
+        self._writer_task: Optional[asyncio.Task] = None
+        # пул: conn — единственный писатель, чтения идут через readers соединений
+        # только для чтения (при readers=0 — через conn)
+        self.readers = readers
+        self._reader_conns: List[aiosqlite.Connection] = []
+        self._reader_pool: Optional[asyncio.Queue] = None
+        # даты раньше этой границы (ISO) лежат в progress_archive, а не в progress
+        self.archived_before: Optional[str] = None
+        # пояс -> местная дата, на которую уже сделан rollover_zones
+        self._rolled_over: Dict[Optional[str], datetime.date] = {}
+        # счётчики по методам и SQL; запросы дольше slow_query_threshold сек пишутся в лог с планом
+        self.metrics = QueryMetrics(slow_query_threshold)
+        self._slow_plans: Dict[str, List[str]] = {}
+        self._slow_tasks: Set[asyncio.Task] = set()
 
     async def connect(self):
         os.makedirs(os.path.dirname(self.path), exist_ok=True)
@@ -20,44 +370,256 @@ class Database:
         # чтобы получать строки как dict-like
         self.conn.row_factory = aiosqlite.Row
         await self.conn.execute("PRAGMA foreign_keys = ON;")
-        await self._create_tables()
+        await self.conn.execute(f"PRAGMA journal_mode = {self.journal_mode};")
+        await self.conn.execute(f"PRAGMA synchronous = {self.synchronous};")
+        await self._migrate()
+        row = await (await self.conn.execute("SELECT value FROM meta WHERE key = 'archived_before'")).fetchone()
+        self.archived_before = row["value"] if row else None
+        self._write_queue = asyncio.Queue()
+        self._writer_task = asyncio.create_task(self._writer_loop())
+        if self.readers:
+            self._reader_pool = asyncio.Queue()
+            for _ in range(self.readers):
+                rconn = await aiosqlite.connect(f"file:{os.path.abspath(self.path)}?mode=ro", uri=True)
+                rconn.row_factory = aiosqlite.Row
+                await rconn.execute("PRAGMA query_only = ON;")
+                self._reader_conns.append(rconn)
+                self._reader_pool.put_nowait(rconn)
 
     async def close(self):
+        if self._writer_task:
+            await self._write_queue.put(None)
+            await self._writer_task
+            self._writer_task = None
+        for rconn in self._reader_conns:
+            await rconn.close()
+        self._reader_conns = []
+        self._reader_pool = None
         if self.conn:
             await self.conn.close()
             self.conn = None
 
-    async def _create_tables(self):
+    # ---------- Чтение ----------
+    @asynccontextmanager
+    async def _reader(self):
+        """Взять соединение для чтения из пула (или писателя, если пула нет или читает он сам)."""
+        if self._reader_pool is None or _in_writer.get():
+            yield self.conn
+            return
+        rconn = await self._reader_pool.get()
+        try:
+            yield rconn
+        finally:
+            self._reader_pool.put_nowait(rconn)
+
+    async def _fetchall(self, sql: str, params: Any = ()) -> List[aiosqlite.Row]:
+        started = time.perf_counter()
+        async with self._reader() as conn:
+            cur = await conn.execute(sql, params)
+            rows = await cur.fetchall()
+        self._observe_query(sql, params, time.perf_counter() - started, len(rows))
+        return rows
+
+    async def _fetchone(self, sql: str, params: Any = ()) -> Optional[aiosqlite.Row]:
+        started = time.perf_counter()
+        async with self._reader() as conn:
+            cur = await conn.execute(sql, params)
+            row = await cur.fetchone()
+        self._observe_query(sql, params, time.perf_counter() - started, 0 if row is None else 1)
+        return row
+
+    # ---------- Инструментирование ----------
+    def _observe_query(self, sql: str, params: Any, elapsed: float, rows: int) -> None:
+        timings = current_timings.get()
+        if timings is not None:
+            timings.db += elapsed
+        if self.metrics.observe_query(sql, elapsed, rows):
+            task = asyncio.create_task(self._log_slow_query(sql, params, elapsed))
+            self._slow_tasks.add(task)
+            task.add_done_callback(self._slow_tasks.discard)
+
+    async def _log_slow_query(self, sql: str, params: Any, elapsed: float) -> None:
+        """Записать медленный запрос в лог вместе с планом (план кэшируется по тексту запроса)."""
+        key = normalize_sql(sql)
+        plan = self._slow_plans.get(key)
+        if plan is None:
+            if isinstance(params, ManyRows):
+                # executemany: план одинаков для всех строк, берётся по первой
+                params = params[0] if params else ()
+            try:
+                plan = await self.explain(sql, params)
+                self._slow_plans[key] = plan
+            except Exception as e:
+                plan = [f"<no plan: {e}>"]  # не кэшируется: в следующий раз попробуем снова
+        logger.warning("Slow query %.1f ms: %s | plan: %s", elapsed * 1000, key, "; ".join(plan))
+
+    # ---------- Group commit ----------
+    async def _write(self, sql: str, params: Any = ()) -> int:
+        """
+        Поставить запись в очередь group commit. Возвращает lastrowid,
+        когда транзакция с этой записью зафиксирована.
+        """
+        return await self._write_many([(sql, params)])
+
+    async def _write_many(self, statements: List[Any]) -> int:
+        """
+        Несколько команд, которые применяются атомарно (в одном SAVEPOINT) внутри
+        общей group-commit транзакции. Элемент — (SQL, параметры) или Deferred.
+        Возвращает lastrowid первой команды (для команды с ManyRows — число изменённых строк).
+        """
+        assert self._write_queue is not None
+        started = time.perf_counter()
+        fut = asyncio.get_running_loop().create_future()
+        await self._write_queue.put((statements, fut))
+        rowid, executed = await fut
+        # в гистограмму и журнал медленных запросов — только выполнение команд писателем;
+        # ожидание в очереди и COMMIT учитываются отдельно (write_wait)
+        for sql, params, spent in executed:
+            self._observe_query(sql, params, spent, 0)
+        wait = max(0.0, time.perf_counter() - started - sum(spent for _, _, spent in executed))
+        self.metrics.observe_write_wait(wait)
+        timings = current_timings.get()
+        if timings is not None:
+            timings.db += wait
+        return rowid
+
+    async def _writer_loop(self):
+        _in_writer.set(True)
+        queue = self._write_queue
+        stopping = False
+        while not stopping:
+            item = await queue.get()
+            if item is None:
+                break
+            if self.batch_delay and queue.qsize() < self.batch_size:
+                await asyncio.sleep(self.batch_delay)
+            batch = [item]
+            while len(batch) < self.batch_size and not queue.empty():
+                item = queue.get_nowait()
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+            try:
+                await self._flush(batch)
+            except Exception as e:
+                # непредвиденная ошибка не должна останавливать писателя: пакет
+                # откатывается целиком, ожидающие получают исключение
+                logger.exception("Write batch of %d failed", len(batch))
+                try:
+                    await self.conn.rollback()
+                except Exception:
+                    logger.exception("Rollback after failed write batch failed")
+                for _, fut in batch:
+                    if not fut.done():
+                        fut.set_exception(e)
+
+    async def _execute(self, sql: str, params: Any) -> Optional[int]:
+        """Выполнить команду писателем. Для ManyRows — executemany, результат — число изменённых строк."""
+        if isinstance(params, ManyRows):
+            cur = await self.conn.executemany(sql, params)
+            return cur.rowcount
+        cur = await self.conn.execute(sql, params)
+        return cur.lastrowid
+
+    async def _timed_execute(self, sql: str, params: Any, executed: List[Tuple[str, Any, float]]) -> Optional[int]:
+        started = time.perf_counter()
+        try:
+            return await self._execute(sql, params)
+        finally:
+            executed.append((sql, params, time.perf_counter() - started))
+
+    async def _flush(self, batch: list) -> None:
+        # future получает (результат, [(SQL, параметры, время выполнения) каждой команды])
+        results = []
+        # весь пакет — одна транзакция: без явного BEGIN sqlite3 не открывает её перед
+        # SAVEPOINT, и RELEASE внешней точки сохранения фиксировал бы каждую запись отдельно
+        if not self.conn.in_transaction:
+            await self.conn.execute("BEGIN")
+        for statements, fut in batch:
+            executed: List[Tuple[str, Any, float]] = []
+            if len(statements) == 1 and not isinstance(statements[0], Deferred):
+                sql, params = statements[0]
+                try:
+                    results.append((fut, (await self._timed_execute(sql, params, executed), executed), None))
+                except Exception as e:
+                    # неудачная команда откатывается сама, остальные остаются в транзакции
+                    results.append((fut, None, e))
+                continue
+            try:
+                await self.conn.execute("SAVEPOINT write_many")
+                rowid = None
+                for statement in statements:
+                    built = await statement.build() if isinstance(statement, Deferred) else [statement]
+                    for sql, params in built:
+                        result = await self._timed_execute(sql, params, executed)
+                        if rowid is None:
+                            rowid = result
+                await self.conn.execute("RELEASE write_many")
+                results.append((fut, (rowid, executed), None))
+            except Exception as e:
+                # если не удался и откат к точке сохранения, пакет откатывает _writer_loop
+                await self.conn.execute("ROLLBACK TO write_many")
+                await self.conn.execute("RELEASE write_many")
+                results.append((fut, None, e))
+        try:
+            await self.conn.commit()
+        except Exception as e:
+            results = [(fut, None, e) for fut, _, _ in results]
+            try:
+                await self.conn.rollback()
+            except Exception:
+                logger.exception("Rollback after failed commit failed")
+        for fut, result, err in results:
+            if fut.done():
+                continue
+            if err is not None:
+                fut.set_exception(err)
+            else:
+                fut.set_result(result)
+
+    # ---------- Миграции ----------
+    async def _migrate(self):
+        """
+        Доводит схему до последней версии. Текущая версия хранится в PRAGMA user_version,
+        каждая миграция выполняется в своей транзакции вместе с обновлением версии.
+        """
         assert self.conn is not None
-        await self.conn.executescript(
-            """
-            CREATE TABLE IF NOT EXISTS users (
-              id INTEGER PRIMARY KEY AUTOINCREMENT,
-              username TEXT,
-              chat_id INTEGER UNIQUE NOT NULL
-            );
-
-            CREATE TABLE IF NOT EXISTS habits (
-              id INTEGER PRIMARY KEY AUTOINCREMENT,
-              user_id INTEGER NOT NULL,
-              name TEXT NOT NULL,
-              frequency TEXT NOT NULL DEFAULT 'daily',
-              schedule TEXT,
-              created_at TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP,
-              FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
-            );
-
-            CREATE TABLE IF NOT EXISTS progress (
-              id INTEGER PRIMARY KEY AUTOINCREMENT,
-              habit_id INTEGER NOT NULL,
-              date TEXT NOT NULL,
-              status INTEGER NOT NULL DEFAULT 1,
-              UNIQUE (habit_id, date),
-              FOREIGN KEY (habit_id) REFERENCES habits(id) ON DELETE CASCADE
-            );
-            """
-        )
-        await self.conn.commit()
+        row = await (await self.conn.execute("PRAGMA user_version")).fetchone()
+        version = row[0]
+        for number, migration in enumerate(MIGRATIONS, start=1):
+            if number <= version:
+                continue
+            try:
+                for statement in await migration(self.conn):
+                    # команда — строка SQL или пара (SQL, параметры)
+                    if isinstance(statement, tuple):
+                        await self.conn.execute(*statement)
+                    else:
+                        await self.conn.execute(statement)
+                await self.conn.execute(f"PRAGMA user_version = {number}")
+                await self.conn.commit()
+            except Exception:
+                await self.conn.rollback()
+                raise
+
+    async def explain(self, sql: str, params: Any = ()) -> List[str]:
+        """Строки EXPLAIN QUERY PLAN для запроса."""
+        async with self._reader() as conn:
+            cur = await conn.execute(f"EXPLAIN QUERY PLAN {sql}", params)
+            return [r["detail"] for r in await cur.fetchall()]
+
+    async def check_query_plans(self) -> List[Tuple[str, str]]:
+        """
+        Прогоняет EXPLAIN QUERY PLAN для всех HOT_QUERIES.
+        Возвращает список (имя запроса, строка плана) для полных сканов таблиц.
+        """
+        problems = []
+        for name, (sql, params) in HOT_QUERIES.items():
+            for detail in await self.explain(sql, params):
+                if FULL_SCAN_RE.match(detail):
+                    problems.append((name, detail))
+        return problems
 
     # ---------- Habits / Reminders ----------
     async def get_all_habits_with_reminders(self) -> List[dict]:
@@ -65,48 +627,88 @@ class Database:
         Возвращает все привычки с ненулевым reminder_time.
         """
         assert self.conn is not None
-        cur = await self.conn.execute(
-            "SELECT * FROM habits WHERE reminder_time IS NOT NULL AND reminder_time != ''"
-        )
-        rows = await cur.fetchall()
+        rows = await self._fetchall(SQL_HABITS_WITH_REMINDERS)
+        return [self._row_to_habit_dict(r) for r in rows]
+
+    async def get_due_reminders(self, habit_ids: List[int], day: datetime.date) -> List[dict]:
+        """
+        Из переданных привычек возвращает те, что по расписанию на day и ещё не отмечены.
+        Один запрос на любой размер пачки: id передаются JSON-массивом.
+        К каждой привычке добавляются chat_id, tz и digest владельца.
+        """
+        assert self.conn is not None
+        if not habit_ids:
+            return []
+        rows = await self._fetchall(SQL_DUE_REMINDERS, (json.dumps(habit_ids), day.weekday(), day.isoformat()))
         return [self._row_to_habit_dict(r) for r in rows]
 
 
     # ---------- Users ----------
     async def add_user(self, chat_id: int, username: Optional[str] = None) -> int:
         assert self.conn is not None
-        
-        await self.conn.commit()
-        row = await (await self.conn.execute("SELECT id FROM users WHERE chat_id = ?", (chat_id,))).fetchone()
+        await self._write(
+            "INSERT OR IGNORE INTO users (chat_id, username) VALUES (?, ?)",
+            (chat_id, username),
+        )
+        row = await self._fetchone("SELECT id FROM users WHERE chat_id = ?", (chat_id,))
         return row["id"]
 
     async def get_user_by_chat(self, chat_id: int) -> Optional[dict]:
         assert self.conn is not None
-        row = await (await self.conn.execute("SELECT * FROM users WHERE chat_id = ?", (chat_id,))).fetchone()
+        row = await self._fetchone(SQL_USER_BY_CHAT, (chat_id,))
         return dict(row) if row else None
 
+    async def set_user_timezone(self, chat_id: int, tz: Optional[str]) -> None:
+        """tz — имя из data.tz.normalize_tz; None — вернуть время сервера."""
+        assert self.conn is not None
+        await self._write("UPDATE users SET tz = ? WHERE chat_id = ?", (tz, chat_id))
+
+    async def set_user_digest(self, chat_id: int, enabled: bool) -> None:
+        assert self.conn is not None
+        await self._write("UPDATE users SET digest = ? WHERE chat_id = ?", (int(enabled), chat_id))
+
+    async def get_user_and_habit(self, chat_id: int, habit_id: int) -> Tuple[Optional[dict], Optional[dict]]:
+        """
+        Пользователь чата и его привычка habit_id. Привычка None, если её нет
+        или она принадлежит другому пользователю; (None, None) — чат не зарегистрирован.
+        """
+        assert self.conn is not None
+        row = await self._fetchone(SQL_USER_AND_HABIT, (habit_id, chat_id))
+        if row is None:
+            return None, None
+        d = dict(row)
+        user = {
+            "id": d.pop("owner_id"),
+            "username": d.pop("owner_username"),
+            "chat_id": d.pop("owner_chat_id"),
+            "tz": d.pop("owner_tz"),
+            "digest": d.pop("owner_digest"),
+        }
+        if d["id"] is None:
+            return user, None
+        d.pop("schedule", None)
+        return user, d
+
     # ---------- Habits ----------
     async def add_habit(self, user_id: int, name: str, frequency: str, schedule=None, reminder_time=None):
-        async with self.conn.execute(
+        """schedule — список дней недели 0..6; None — каждый день."""
+        return await self._write(
             """
-            INSERT INTO habits (user_id, name, frequency, schedule, reminder_time)
+            INSERT INTO habits (user_id, name, frequency, schedule_mask, reminder_time)
             VALUES (?, ?, ?, ?, ?)
             """,
-            (user_id, name, frequency, str(schedule) if schedule else None, reminder_time)
-        ) as cursor:
-            await self.conn.commit()
-            return cursor.lastrowid
+            (user_id, name, frequency, days_to_mask(schedule) if schedule else ALL_DAYS, reminder_time)
+        )
 
 
     async def get_habits(self, user_id: int) -> List[dict]:
         assert self.conn is not None
-        cur = await self.conn.execute("SELECT * FROM habits WHERE user_id = ?", (user_id,))
-        rows = await cur.fetchall()
+        rows = await self._fetchall(SQL_HABITS_BY_USER, (user_id,))
         return [self._row_to_habit_dict(r) for r in rows]
 
     async def get_habit(self, habit_id: int) -> Optional[dict]:
         assert self.conn is not None
-        row = await (await self.conn.execute("SELECT * FROM habits WHERE id = ?", (habit_id,))).fetchone()
+        row = await self._fetchone(SQL_HABIT_BY_ID, (habit_id,))
         return self._row_to_habit_dict(row) if row else None
 
     async def update_habit(self, habit_id: int, **fields) -> None:
@@ -120,100 +722,436 @@ class Database:
             if k not in allowed:
                 continue
             if k == "schedule":
-                v = json.dumps(v) if v is not None else None
+                k = "schedule_mask"
+                v = days_to_mask(v) if v else ALL_DAYS
             sets.append(f"{k} = ?")
             params.append(v)
         params.append(habit_id)
         q = f"UPDATE habits SET {', '.join(sets)} WHERE id = ?"
-        await self.conn.execute(q, params)
-        await self.conn.commit()
+        await self._write(q, params)
 
 
     async def delete_habit(self, habit_id: int) -> None:
         assert self.conn is not None
-        await self.conn.execute("DELETE FROM habits WHERE id = ?", (habit_id,))
-        await self.conn.commit()
+        await self._write("DELETE FROM habits WHERE id = ?", (habit_id,))
 
     # ---------- Progress ----------
-    async def mark_done(self, habit_id: int, date: Optional[str] = None) -> None:
+    async def insert_progress_rows(self, rows: List[Tuple[int, str]]) -> int:
+        """
+        Массовая вставка отметок (habit_id, date) одним executemany в одной транзакции.
+        Уже существующие пары пропускаются. habit_stats не трогает — после загрузки
+        нужен rebuild_habit_stats. Возвращает число добавленных строк.
+        """
+        if not rows:
+            return 0
+        return await self._write(
+            "INSERT OR IGNORE INTO progress (habit_id, date, status) VALUES (?, ?, 1)",
+            ManyRows(rows),
+        )
+
+    async def mark_done(self, habit_id: int, date: Optional[str] = None, today: Optional[datetime.date] = None) -> None:
         """
         Отметить привычку сделанной на date (ISO YYYY-MM-DD). По умолчанию сегодня.
+        today — «сегодня» владельца (его часовой пояс), по умолчанию дата сервера.
+        Вместе с отметкой обновляются агрегаты в habit_stats.
         """
         assert self.conn is not None
+        today = today or datetime.date.today()
         if date is None:
-            date = datetime.date.today().isoformat()
-        await self.conn.execute(
-            "INSERT OR REPLACE INTO progress (habit_id, date, status) VALUES (?, ?, 1)",
-            (habit_id, date),
+            date = today.isoformat()
+        insert = ("INSERT OR REPLACE INTO progress (habit_id, date, status) VALUES (?, ?, 1)", (habit_id, date))
+        row = await self._fetchone(
+            "SELECT h.schedule_mask, s.last_done FROM habits h LEFT JOIN habit_stats s ON s.habit_id = h.id WHERE h.id = ?",
+            (habit_id,),
         )
-        await self.conn.commit()
+        if row is None:
+            await self._write(*insert)  # привычки нет — ошибку вернёт внешний ключ
+            return
+        if row["last_done"] is not None and date < row["last_done"]:
+            # отметка задним числом — серии проще пересчитать целиком
+            await self._write(*insert)
+            await self.rebuild_habit_stats([habit_id])
+            return
+        day = parse_iso(date)
+        prev = previous_scheduled(day, row["schedule_mask"])
+        params = {
+            "habit_id": habit_id,
+            "day": date,
+            "prev": prev.isoformat() if prev else date,
+            "in_7d": int(today - datetime.timedelta(days=7) < day <= today),
+            "in_30d": int(today - datetime.timedelta(days=30) < day <= today),
+            "today": today.isoformat(),
+        }
+        await self._write_many([insert, (SQL_MARK_HABIT_STATS, params)])
+
+    async def mark_many(self, habit_ids: List[int], dates: List[str], today: Optional[datetime.date] = None) -> int:
+        """
+        Отметить каждую привычку из habit_ids на каждую дату из dates (ISO), кроме дней
+        вне её расписания. Отметки и пересчитанные habit_stats фиксируются одной транзакцией;
+        habit_stats считается писателем уже после вставки, поэтому учитывает и отметки,
+        записанные между чтением расписания и этой записью.
+        Возвращает число новых отметок (уже существующие пропускаются).
+        """
+        assert self.conn is not None
+        if not habit_ids or not dates:
+            return 0
+        rows = await self._fetchall(
+            "SELECT id, schedule_mask FROM habits WHERE id IN (SELECT value FROM json_each(?))",
+            (json.dumps(list(habit_ids)),),
+        )
+        masks = {r["id"]: r["schedule_mask"] for r in rows}
+        weekdays = {d: parse_iso(d).weekday() for d in dates}
+        scheduled = {hid: [d for d in dates if mask >> weekdays[d] & 1] for hid, mask in masks.items()}
+        pairs = ManyRows((hid, d) for hid, days in scheduled.items() for d in days)
+        if not pairs:
+            return 0
+        today = today or datetime.date.today()
+        return await self._write_many([
+            ("INSERT OR IGNORE INTO progress (habit_id, date, status) VALUES (?, ?, 1)", pairs),
+            Deferred(lambda: self._habit_stats_statements(masks, today)),
+        ])
 
     async def get_progress_for_habit(self, habit_id: int, start_date: Optional[str] = None, end_date: Optional[str] = None) -> List[dict]:
         assert self.conn is not None
         if start_date and end_date:
-            cur = await self.conn.execute(
-                "SELECT * FROM progress WHERE habit_id = ? AND date BETWEEN ? AND ? ORDER BY date",
-                (habit_id, start_date, end_date),
-            )
+            rows = await self._fetchall(SQL_HABIT_PROGRESS_RANGE, (habit_id, start_date, end_date))
         elif start_date:
-            cur = await self.conn.execute(
+            rows = await self._fetchall(
                 "SELECT * FROM progress WHERE habit_id = ? AND date >= ? ORDER BY date",
                 (habit_id, start_date),
             )
         else:
-            cur = await self.conn.execute(
+            rows = await self._fetchall(
                 "SELECT * FROM progress WHERE habit_id = ? ORDER BY date",
                 (habit_id,),
             )
-        rows = await cur.fetchall()
+        result = [dict(r) for r in rows]
+        if self._needs_archive(start_date):
+            archived = await self._fetchall(
+                SQL_HABIT_ARCHIVE_RANGE,
+                (habit_id, month_key(start_date or "0000-01-01"), month_key(end_date or "9999-12-31")),
+            )
+            extra = [
+                {"id": None, "habit_id": habit_id, "date": d, "status": 1}
+                for r in archived
+                for d in expand_month(r["month"], r["days"])
+                if (not start_date or d >= start_date) and (not end_date or d <= end_date)
+            ]
+            result = sorted(extra + result, key=lambda x: x["date"])
+        return result
+
+    # ---------- Архив ----------
+    def _needs_archive(self, start_date: Optional[str]) -> bool:
+        return self.archived_before is not None and (not start_date or start_date < self.archived_before)
+
+    async def archive_progress(self, horizon_days: int, today: Optional[datetime.date] = None) -> int:
+        """
+        Переносит отметки старше horizon_days (целыми месяцами) из progress в
+        progress_archive — по одной битовой маске на привычку и месяц.
+        Каждый месяц переносится атомарно. Возвращает число перенесённых строк.
+        """
+        if horizon_days < 31:
+            # окна 7/30 дней в habit_stats пересчитываются только по progress
+            raise ValueError("horizon_days must be at least 31")
+        cutoff = archive_cutoff(today or datetime.date.today(), horizon_days).isoformat()
+        moved = 0
+        while True:
+            first = await self._fetchone("SELECT MIN(date) AS d FROM progress WHERE date < ?", (cutoff,))
+            if first["d"] is None:
+                break
+            month = month_key(first["d"])
+            start, end = f"{month}-01", f"{month}-31"
+            year, mon = int(month[:4]), int(month[5:7])
+            next_month = datetime.date(year + mon // 12, mon % 12 + 1, 1).isoformat()
+            count = await self._fetchone(
+                "SELECT COUNT(*) AS n FROM progress WHERE date BETWEEN ? AND ?", (start, end)
+            )
+            # граница выставляется до переноса: читатели заранее смотрят и в архив,
+            # а после сбоя посреди работы перенесённые месяцы не пропадут из выборок
+            boundary = max(self.archived_before or "", next_month)
+            self.archived_before = boundary
+            # маска строится и строки удаляются писателем в одной транзакции — отметка,
+            # добавленная между чтением и удалением, не потеряется; дни месяца уникальны,
+            # поэтому SUM битов равен их OR
+            await self._write_many([
+                (
+                    """
+                    INSERT INTO progress_archive (habit_id, month, days)
+                    SELECT habit_id, ?, SUM(1 << (CAST(substr(date, 9, 2) AS INTEGER) - 1))
+                    FROM progress WHERE date BETWEEN ? AND ?
+                    GROUP BY habit_id
+                    ON CONFLICT(habit_id, month) DO UPDATE SET days = days | excluded.days
+                    """,
+                    (month, start, end),
+                ),
+                ("DELETE FROM progress WHERE date BETWEEN ? AND ?", (start, end)),
+                ("INSERT OR REPLACE INTO meta (key, value) VALUES ('archived_before', ?)", (boundary,)),
+            ])
+            moved += count["n"]
+        if self.archived_before is None or cutoff > self.archived_before:
+            self.archived_before = cutoff
+            await self._write(
+                "INSERT OR REPLACE INTO meta (key, value) VALUES ('archived_before', ?)", (cutoff,)
+            )
+        return moved
+
+    # ---------- Статистика (habit_stats) ----------
+    async def get_user_stats(self, user_id: int) -> List[dict]:
+        """Агрегаты по привычкам пользователя — только чтение habit_stats, без истории."""
+        rows = await self._fetchall(SQL_USER_STATS, (user_id,))
         return [dict(r) for r in rows]
 
+    async def rebuild_habit_stats(self, habit_ids: Optional[List[int]] = None, user_id: Optional[int] = None) -> int:
+        """
+        Пересчитывает habit_stats из progress: для habit_ids, для привычек user_id или для всех.
+        Возвращает число пересчитанных привычек.
+        """
+        today = datetime.date.today()
+        if habit_ids is None:
+            if user_id is not None:
+                rows = await self._fetchall("SELECT id, schedule_mask FROM habits WHERE user_id = ?", (user_id,))
+            else:
+                rows = await self._fetchall("SELECT id, schedule_mask FROM habits")
+        else:
+            rows = await self._fetchall(
+                "SELECT id, schedule_mask FROM habits WHERE id IN (SELECT value FROM json_each(?))",
+                (json.dumps(habit_ids),),
+            )
+        masks = {r["id"]: r["schedule_mask"] for r in rows}
+        ids = list(masks)
+        chunk = 500
+        for i in range(0, len(ids), chunk):
+            part = ids[i:i + chunk]
+            part_masks = {hid: masks[hid] for hid in part}
+            # считает писатель: отметка, пришедшая во время пересчёта, не затирается
+            await self._write_many([Deferred(lambda part_masks=part_masks: self._habit_stats_statements(part_masks, today))])
+        return len(ids)
+
+    async def _habit_stats_statements(self, masks: Dict[int, int], today: datetime.date) -> List[Tuple[str, Any]]:
+        """
+        Команды upsert habit_stats для привычек masks (id -> schedule_mask), посчитанные
+        по progress и архиву. Вызывается писателем (через Deferred), чтобы чтение и запись
+        шли в одной транзакции.
+        """
+        ids = list(masks)
+        dates: Dict[int, List[datetime.date]] = {hid: [] for hid in ids}
+        for r in await self._fetchall(
+            "SELECT habit_id, date FROM progress WHERE habit_id IN (SELECT value FROM json_each(?)) ORDER BY habit_id, date",
+            (json.dumps(ids),),
+        ):
+            dates[r["habit_id"]].append(parse_iso(r["date"]))
+        if self.archived_before is not None:
+            for r in await self._fetchall(
+                "SELECT habit_id, month, days FROM progress_archive WHERE habit_id IN (SELECT value FROM json_each(?))",
+                (json.dumps(ids),),
+            ):
+                dates[r["habit_id"]].extend(parse_iso(d) for d in expand_month(r["month"], r["days"]))
+        if self.archived_before is not None:
+            for hid in ids:
+                dates[hid] = sorted(set(dates[hid]))
+        return [
+            (SQL_UPSERT_HABIT_STATS, {"habit_id": hid, **compute_habit_stats(dates[hid], masks[hid], today)})
+            for hid in ids
+        ]
+
+    async def rollover_habit_stats(self, today: Optional[datetime.date] = None, tz: Optional[str] = ALL_ZONES) -> int:
+        """
+        Обслуживание habit_stats при смене дня: пересчёт окон 7/30 дней и обнуление
+        прерванных серий (пропущен день по расписанию). Трогает только строки с
+        updated_on < today; tz — только пользователи этого пояса (None — время сервера),
+        ALL_ZONES — все. Возвращает число обновлённых привычек.
+        """
+        today = today or datetime.date.today()
+        day = today.isoformat()
+        if tz == ALL_ZONES:
+            rows = await self._fetchall(
+                """
+                SELECT s.habit_id, s.last_done, s.current_streak, h.schedule_mask
+                FROM habit_stats s JOIN habits h ON h.id = s.habit_id
+                WHERE s.updated_on < ?
+                """,
+                (day,),
+            )
+        else:
+            rows = await self._fetchall(
+                """
+                SELECT s.habit_id, s.last_done, s.current_streak, h.schedule_mask
+                FROM users u
+                JOIN habits h ON h.user_id = u.id
+                JOIN habit_stats s ON s.habit_id = h.id
+                WHERE u.tz IS ? AND s.updated_on < ?
+                """,
+                (tz, day),
+            )
+        if not rows:
+            return 0
+        ids = json.dumps([r["habit_id"] for r in rows])
+        statements: List[Tuple[str, Any]] = [(
+            """
+            UPDATE habit_stats SET
+              done_7d = (SELECT COUNT(*) FROM progress p WHERE p.habit_id = habit_stats.habit_id AND p.date > ? AND p.date <= ?),
+              done_30d = (SELECT COUNT(*) FROM progress p WHERE p.habit_id = habit_stats.habit_id AND p.date > ? AND p.date <= ?),
+              updated_on = ?
+            WHERE habit_id IN (SELECT value FROM json_each(?))
+            """,
+            (
+                (today - datetime.timedelta(days=7)).isoformat(), day,
+                (today - datetime.timedelta(days=30)).isoformat(), day,
+                day, ids,
+            ),
+        )]
+        broken = [
+            r["habit_id"] for r in rows
+            if r["current_streak"] > 0
+            and r["last_done"] != day
+            and not streak_continues(parse_iso(r["last_done"]), today, r["schedule_mask"])
+        ]
+        if broken:
+            statements.append((
+                "UPDATE habit_stats SET current_streak = 0 WHERE habit_id IN (SELECT value FROM json_each(?))",
+                (json.dumps(broken),),
+            ))
+        await self._write_many(statements)
+        return len(rows)
+
+    async def rollover_zones(self, now: Optional[datetime.datetime] = None) -> int:
+        """
+        Смена дня по часовым поясам: для каждого пояса пользователей — rollover_habit_stats
+        на его местную дату. Вызывается несколько раз в час; пояса, где день с прошлого
+        вызова не сменился, пропускаются без запросов. Возвращает число обновлённых привычек.
+        """
+        total = 0
+        for r in await self._fetchall("SELECT DISTINCT tz FROM users"):
+            tz = r["tz"]
+            today = local_today(tz, now)
+            if self._rolled_over.get(tz) == today:
+                continue
+            total += await self.rollover_habit_stats(today, tz=tz)
+            self._rolled_over[tz] = today
+        return total
+
+    # ---------- FSM ----------
+    async def get_fsm_record(self, key: str) -> Optional[dict]:
+        row = await self._fetchone("SELECT state, data, updated_at FROM fsm_states WHERE key = ?", (key,))
+        if not row:
+            return None
+        return {"state": row["state"], "data": json.loads(row["data"]), "updated_at": row["updated_at"]}
+
+    async def set_fsm_record(self, key: str, state: Optional[str], data: Dict[str, Any], updated_at: float) -> None:
+        if state is None and not data:
+            await self._write("DELETE FROM fsm_states WHERE key = ?", (key,))
+            return
+        await self._write(
+            """
+            INSERT INTO fsm_states (key, state, data, updated_at) VALUES (?, ?, ?, ?)
+            ON CONFLICT(key) DO UPDATE SET state = excluded.state, data = excluded.data, updated_at = excluded.updated_at
+            """,
+            (key, state, json.dumps(data, ensure_ascii=False), updated_at),
+        )
+
+    async def delete_expired_fsm_records(self, before: float) -> int:
+        """Удаляет состояния, которые не менялись с момента before. Возвращает их число."""
+        row = await self._fetchone("SELECT COUNT(*) AS n FROM fsm_states WHERE updated_at < ?", (before,))
+        if row["n"]:
+            await self._write("DELETE FROM fsm_states WHERE updated_at < ?", (before,))
+        return row["n"]
+
     # ---------- Helpers / Reports ----------
     def _row_to_habit_dict(self, row: aiosqlite.Row) -> dict:
         if row is None:
             return None
         d = dict(row)
-        schedule = d.get("schedule")
-        d["schedule"] = json.loads(schedule) if schedule else None
+        d.pop("schedule", None)  # устаревшая текстовая колонка, см. _m004_schedule_mask
         return d
 
-    async def get_today_habits(self, user_id: int) -> List[dict]:
-        assert self.conn is not None
-        all_habits = await self.get_habits(user_id)
-        today_wd = datetime.date.today().weekday() 
-        today = []
-        for h in all_habits:
-            freq = h.get("frequency", "daily")
-            schedule = h.get("schedule")
-            if freq == "daily":
-                today.append(h)
-            elif freq == "weekly":
-                if schedule is None:
-                    today.append(h)  
-                else:
-                    try:
-                        if int(today_wd) in [int(x) for x in schedule]:
-                            today.append(h)
-                    except Exception:
-                        today.append(h)
-            else:
-                today.append(h)
-        return today
+    @staticmethod
+    def _is_scheduled(habit: dict, weekday: int) -> bool:
+        return bool(habit.get("schedule_mask", ALL_DAYS) >> weekday & 1)
 
-    async def get_user_progress_summary(self, user_id: int, start_date: str, end_date: str) -> List[Dict[str, Any]]:
+    async def get_today_habits(self, user_id: int, today: Optional[datetime.date] = None) -> List[dict]:
+        assert self.conn is not None
+        today_wd = (today or datetime.date.today()).weekday()
+        rows = await self._fetchall(SQL_TODAY_HABITS, (user_id, today_wd))
+        return [self._row_to_habit_dict(r) for r in rows]
+
+    async def get_today_status(self, user_id: int, today: Optional[datetime.date] = None) -> List[dict]:
         """
-        Возвращает список привычек пользователя с количеством выполненных дней в диапазоне
+        Привычки пользователя на сегодня вместе с флагом выполнения (done).
+        Один запрос: LEFT JOIN habits и progress за сегодняшнюю дату.
+        today — «сегодня» в поясе пользователя, по умолчанию дата сервера.
         """
         assert self.conn is not None
-        q = """
-        SELECT h.id as habit_id, h.name, COUNT(p.id) as done_count
-        FROM habits h
-        LEFT JOIN progress p ON p.habit_id = h.id AND p.date BETWEEN ? AND ?
-        WHERE h.user_id = ?
-        GROUP BY h.id, h.name
-        ORDER BY done_count DESC;
+        today = today or datetime.date.today()
+        rows = await self._fetchall(SQL_TODAY_STATUS, (today.isoformat(), user_id, today.weekday()))
+        result = []
+        for r in rows:
+            h = self._row_to_habit_dict(r)
+            h["done"] = bool(h["done"])
+            result.append(h)
+        return result
+
+    async def get_user_progress(self, user_id: int, start_date: str, end_date: str) -> Tuple[List[dict], Dict[int, Set[str]]]:
         """
-        cur = await self.conn.execute(q, (start_date, end_date, user_id))
-        rows = await cur.fetchall()
-        return [dict(r) for r in rows]
+        Все привычки пользователя и их отметки в диапазоне — одним запросом.
+        Возвращает (habits, {habit_id: set(ISO-дат)}).
+        """
+        assert self.conn is not None
+        rows = await self._fetchall(SQL_USER_PROGRESS, (start_date, end_date, user_id))
+        habits: List[dict] = []
+        progress: Dict[int, Set[str]] = {}
+        for r in rows:
+            habit_id = r["id"]
+            if habit_id not in progress:
+                h = self._row_to_habit_dict(r)
+                h.pop("done_date", None)
+                habits.append(h)
+                progress[habit_id] = set()
+            if r["done_date"] is not None:
+                progress[habit_id].add(r["done_date"])
+        if self._needs_archive(start_date):
+            for r in await self._fetchall(SQL_USER_ARCHIVE_RANGE, (month_key(start_date), month_key(end_date), user_id)):
+                progress[r["habit_id"]].update(
+                    d for d in expand_month(r["month"], r["days"]) if start_date <= d <= end_date
+                )
+        return habits, progress
+
+    async def get_user_progress_summary(self, user_id: int, start_date: str, end_date: str) -> List[Dict[str, Any]]:
+        """
+        Возвращает список привычек пользователя с количеством выполненных дней в диапазоне
+        """
+        habits, progress = await self.get_user_progress(user_id, start_date, end_date)
+        summary = [
+            {"habit_id": h["id"], "name": h["name"], "done_count": len(progress[h["id"]])}
+            for h in habits
+        ]
+        summary.sort(key=lambda x: x["done_count"], reverse=True)
+        return summary
+
+
+instrument_methods(Database, skip=("connect", "close", "explain", "check_query_plans"))
+
+
+async def _cli_main(argv: List[str]) -> int:
+    rebuild = "--rebuild-stats" in argv
+    archive = next((int(a.split("=", 1)[1]) for a in argv if a.startswith("--archive=")), None)
+    args = [a for a in argv if not a.startswith("--")]
+    db = Database(args[0] if args else DB_FILE)
+    await db.connect()
+    try:
+        if archive is not None:
+            print(f"{await db.archive_progress(archive)} progress rows archived")
+        if rebuild:
+            print(f"habit_stats rebuilt for {await db.rebuild_habit_stats()} habits")
+        problems = await db.check_query_plans()
+    finally:
+        await db.close()
+    for name, detail in problems:
+        print(f"FULL SCAN in {name}: {detail}")
+    return 1 if problems else 0
+
 
+if __name__ == "__main__":
+    # python -m data.db [path] [--archive=DAYS] [--rebuild-stats] — миграция базы,
+    # архивация старых отметок, пересчёт habit_stats и проверка планов горячих запросов
+    import sys
+    sys.exit(asyncio.run(_cli_main(sys.argv[1:])))
@@ -0,0 +1,99 @@
+# fsm_storage.py
+import asyncio
+import logging
+import time
+from typing import Any, Dict, Mapping, Optional
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, StorageKey
+
+from data.cache import LRUCache
+
+logger = logging.getLogger(__name__)
+
+
+class SQLiteStorage(BaseStorage):
+    """
+    FSM-хранилище aiogram поверх Database (таблица fsm_states).
+    Перед базой — write-through LRU, поэтому чтения обычно не доходят до SQLite.
+    Состояния, которые не менялись дольше ttl секунд, считаются брошенными:
+    они не возвращаются и периодически удаляются фоновой задачей (start()).
+    """
+
+    def __init__(self, db, ttl: float = 86400.0, maxsize: int = 10000, sweep_interval: float = 3600.0):
+        self.db = db
+        self.ttl = ttl
+        self.sweep_interval = sweep_interval
+        self.cache = LRUCache(maxsize, ttl)
+        self._sweeper: Optional[asyncio.Task] = None
+
+    # ---------- Жизненный цикл ----------
+    def start(self) -> None:
+        if self._sweeper is None:
+            self._sweeper = asyncio.create_task(self._sweep_loop())
+
+    async def close(self) -> None:
+        if self._sweeper is not None:
+            self._sweeper.cancel()
+            try:
+                await self._sweeper
+            except asyncio.CancelledError:
+                pass
+            self._sweeper = None
+
+    async def sweep(self) -> int:
+        removed = await self.db.delete_expired_fsm_records(time.time() - self.ttl)
+        if removed:
+            logger.info("FSM sweeper removed %d idle states", removed)
+        return removed
+
+    async def _sweep_loop(self) -> None:
+        while True:
+            try:
+                await self.sweep()
+            except Exception:
+                logger.exception("FSM sweeper failed")
+            await asyncio.sleep(self.sweep_interval)
+
+    # ---------- BaseStorage ----------
+    async def set_state(self, key: StorageKey, state: Optional[Any] = None) -> None:
+        record = await self._load(key)
+        record["state"] = state.state if isinstance(state, State) else state
+        await self._save(key, record)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        return (await self._load(key))["state"]
+
+    async def set_data(self, key: StorageKey, data: Mapping[str, Any]) -> None:
+        record = await self._load(key)
+        record["data"] = dict(data)
+        await self._save(key, record)
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        return dict((await self._load(key))["data"])
+
+    # ---------- Внутреннее ----------
+    @staticmethod
+    def _key(key: StorageKey) -> str:
+        parts = [key.bot_id, key.chat_id, key.user_id, getattr(key, "thread_id", None), key.destiny]
+        return ":".join("" if p is None else str(p) for p in parts)
+
+    async def _load(self, key: StorageKey) -> dict:
+        k = self._key(key)
+        record = self.cache.get(k)
+        if record is None:
+            record = await self.db.get_fsm_record(k)
+            # срок жизни в кэше — от сохранённого updated_at, а не от момента загрузки
+            left = record["updated_at"] + self.ttl - time.time() if record is not None else 0.0
+            if left <= 0:
+                record = {"state": None, "data": {}, "updated_at": 0.0}
+                self.cache.set(k, record)
+            else:
+                self.cache.set(k, record, ttl=left)
+        return {"state": record["state"], "data": dict(record["data"]), "updated_at": record["updated_at"]}
+
+    async def _save(self, key: StorageKey, record: dict) -> None:
+        k = self._key(key)
+        record["updated_at"] = time.time()
+        await self.db.set_fsm_record(k, record["state"], record["data"], record["updated_at"])
+        self.cache.set(k, record)
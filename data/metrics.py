@@ -0,0 +1,220 @@
+# metrics.py
+import bisect
+import functools
+import inspect
+import time
+from contextvars import ContextVar
+from typing import Any, Dict, List, Optional, Tuple
+
+# имя обработчика aiogram, из которого идёт вызов; выставляет middleware,
+# "-" — фоновые задачи (напоминания, планировщик)
+current_handler: ContextVar[str] = ContextVar("current_handler", default="-")
+
+
+class Timings:
+    """Накопленное за обработку одного обновления время в SQL и в запросах к Bot API, сек."""
+
+    __slots__ = ("db", "api")
+
+    def __init__(self):
+        self.db = 0.0
+        self.api = 0.0
+
+
+# выставляет middleware обновления; вне обработки обновления — None
+current_timings: ContextVar[Optional[Timings]] = ContextVar("current_timings", default=None)
+
+# верхние границы корзин гистограммы, сек
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+
+class Histogram:
+    """Гистограмма с фиксированными корзинами: counts[i] — попадания в (b[i-1], b[i]], последняя — +Inf."""
+
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q: float) -> float:
+        """Оценка квантиля сверху — граница корзины, в которую он попал."""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for bound, n in zip(self.buckets, self.counts):
+            seen += n
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+    def cumulative(self) -> List[Tuple[str, int]]:
+        out, seen = [], 0
+        for bound, n in zip(self.buckets, self.counts):
+            seen += n
+            out.append((repr(bound), seen))
+        out.append(("+Inf", self.count))
+        return out
+
+
+class Series:
+    __slots__ = ("hist", "rows")
+
+    def __init__(self):
+        self.hist = Histogram()
+        self.rows = 0
+
+
+class QueryMetrics:
+    """
+    Счётчики Database: по методам и по SQL-командам, в разрезе обработчика.
+    Ключи — (метод или SQL, обработчик).
+    """
+
+    def __init__(self, slow_threshold: float = 0.1):
+        self.slow_threshold = slow_threshold
+        self.methods: Dict[Tuple[str, str], Series] = {}
+        self.queries: Dict[Tuple[str, str], Series] = {}
+        self.write_wait = Histogram()  # ожидание записи в очереди group commit и COMMIT
+        self.slow = 0
+
+    def _observe(self, table: Dict[Tuple[str, str], Series], name: str, elapsed: float, rows: int) -> None:
+        key = (name, current_handler.get())
+        series = table.get(key)
+        if series is None:
+            series = table[key] = Series()
+        series.hist.observe(elapsed)
+        series.rows += rows
+
+    def observe_method(self, name: str, elapsed: float, rows: int) -> None:
+        self._observe(self.methods, name, elapsed, rows)
+
+    def observe_query(self, sql: str, elapsed: float, rows: int) -> bool:
+        """Записать выполнение SQL. True — если запрос медленнее порога."""
+        self._observe(self.queries, normalize_sql(sql), elapsed, rows)
+        if elapsed >= self.slow_threshold:
+            self.slow += 1
+            return True
+        return False
+
+    def observe_write_wait(self, elapsed: float) -> None:
+        self.write_wait.observe(elapsed)
+
+    def reset(self) -> None:
+        self.methods.clear()
+        self.queries.clear()
+        self.write_wait = Histogram()
+        self.slow = 0
+
+    # ---------- Выдача ----------
+    @staticmethod
+    def _top(table: Dict[Tuple[str, str], Series], by_handler: bool, limit: int) -> List[Dict[str, Any]]:
+        merged: Dict[str, Histogram] = {}
+        rows: Dict[str, int] = {}
+        for (name, handler), series in table.items():
+            key = handler if by_handler else name
+            hist = merged.get(key)
+            if hist is None:
+                hist = merged[key] = Histogram(series.hist.buckets)
+            for i, n in enumerate(series.hist.counts):
+                hist.counts[i] += n
+            hist.sum += series.hist.sum
+            hist.count += series.hist.count
+            rows[key] = rows.get(key, 0) + series.rows
+        items = [
+            {
+                "name": key,
+                "calls": hist.count,
+                "total": hist.sum,
+                "p50": hist.quantile(0.5),
+                "p99": hist.quantile(0.99),
+                "rows": rows[key],
+            }
+            for key, hist in merged.items()
+        ]
+        items.sort(key=lambda x: x["total"], reverse=True)
+        return items[:limit]
+
+    def top_methods(self, limit: int = 10) -> List[Dict[str, Any]]:
+        return self._top(self.methods, False, limit)
+
+    def top_queries(self, limit: int = 10) -> List[Dict[str, Any]]:
+        return self._top(self.queries, False, limit)
+
+    def top_handlers(self, limit: int = 10) -> List[Dict[str, Any]]:
+        """Время в SQL по обработчикам."""
+        return self._top(self.queries, True, limit)
+
+    def prometheus(self, prefix: str = "habits_db") -> str:
+        lines: List[str] = []
+        for kind, label, table in (("method", "method", self.methods), ("query", "sql", self.queries)):
+            metric = f"{prefix}_{kind}_seconds"
+            lines.append(f"# HELP {metric} Database {kind} latency")
+            lines.append(f"# TYPE {metric} histogram")
+            for (name, handler), series in table.items():
+                labels = f'{label}="{_escape(name)}",handler="{_escape(handler)}"'
+                for le, n in series.hist.cumulative():
+                    lines.append(f'{metric}_bucket{{{labels},le="{le}"}} {n}')
+                lines.append(f"{metric}_sum{{{labels}}} {series.hist.sum:.6f}")
+                lines.append(f"{metric}_count{{{labels}}} {series.hist.count}")
+            rows_metric = f"{prefix}_{kind}_rows_total"
+            lines.append(f"# TYPE {rows_metric} counter")
+            for (name, handler), series in table.items():
+                lines.append(f'{rows_metric}{{{label}="{_escape(name)}",handler="{_escape(handler)}"}} {series.rows}')
+        metric = f"{prefix}_write_wait_seconds"
+        lines.append(f"# HELP {metric} Time a write spends in the group commit queue and COMMIT")
+        lines.append(f"# TYPE {metric} histogram")
+        for le, n in self.write_wait.cumulative():
+            lines.append(f'{metric}_bucket{{le="{le}"}} {n}')
+        lines.append(f"{metric}_sum {self.write_wait.sum:.6f}")
+        lines.append(f"{metric}_count {self.write_wait.count}")
+        lines.append(f"# TYPE {prefix}_slow_queries_total counter")
+        lines.append(f"{prefix}_slow_queries_total {self.slow}")
+        return "\n".join(lines) + "\n"
+
+
+def normalize_sql(sql: str) -> str:
+    return " ".join(sql.split())
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _rows_in(result: Any) -> int:
+    if result is None:
+        return 0
+    if isinstance(result, (list, dict, set)):
+        return len(result)
+    return 1
+
+
+def instrument_methods(cls, skip: Tuple[str, ...] = ()):
+    """
+    Оборачивает публичные корутины класса: время и число строк результата пишутся
+    в self.metrics.observe_method под именем метода.
+    """
+    for name, fn in list(vars(cls).items()):
+        if name.startswith("_") or name in skip or not inspect.iscoroutinefunction(fn):
+            continue
+        setattr(cls, name, _timed(name, fn))
+    return cls
+
+
+def _timed(name: str, fn):
+    @functools.wraps(fn)
+    async def wrapper(self, *args, **kwargs):
+        started = time.perf_counter()
+        result = await fn(self, *args, **kwargs)
+        self.metrics.observe_method(name, time.perf_counter() - started, _rows_in(result))
+        return result
+
+    return wrapper
@@ -0,0 +1,51 @@
+# reports.py
+from datetime import date, timedelta
+from typing import List, Dict, Any
+
+from data.db import ALL_DAYS
+
+
+def daterange(start_date: date, end_date: date):
+    """Генерирует даты от start_date до end_date включительно."""
+    for n in range((end_date - start_date).days + 1):
+        yield start_date + timedelta(days=n)
+
+
+def count_weekdays(start_date: date, end_date: date, mask: int) -> int:
+    """
+    Сколько дат в интервале [start_date, end_date] попадает на дни недели из маски (бит 0 = пн).
+    Считается в закрытой форме: полные недели × число дней + остаток (< 7 дней).
+    """
+    days = (end_date - start_date).days + 1
+    if days <= 0:
+        return 0
+    full_weeks, rest = divmod(days, 7)
+    start_wd = start_date.weekday()
+    tail = sum(mask >> ((start_wd + i) % 7) & 1 for i in range(rest))
+    return full_weeks * bin(mask).count("1") + tail
+
+
+def expected_occurrences(habit: dict, start_date: date, end_date: date) -> int:
+    """
+    Считает, сколько раз привычка должна была появиться в интервале:
+    число дней из schedule_mask (у daily — все 7 дней).
+    """
+    return count_weekdays(start_date, end_date, habit.get("schedule_mask", ALL_DAYS))
+
+
+async def build_period_report(db, user_id: int, start_date: date, end_date: date) -> List[Dict[str, Any]]:
+    """
+    Отчёт по всем привычкам пользователя за период — один запрос к БД.
+    Каждый элемент: habit, done_dates (set ISO-дат), done_count, expected.
+    """
+    habits, progress = await db.get_user_progress(user_id, start_date.isoformat(), end_date.isoformat())
+    report = []
+    for h in habits:
+        done_dates = progress.get(h["id"], set())
+        report.append({
+            "habit": h,
+            "done_dates": done_dates,
+            "done_count": len(done_dates),
+            "expected": expected_occurrences(h, start_date, end_date),
+        })
+    return report
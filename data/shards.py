@@ -0,0 +1,79 @@
+# shards.py
+import asyncio
+import os
+import sqlite3
+import sys
+from typing import List
+
+from data.db import Database, DB_FILE
+
+
+def shard_for(chat_id: int, shards: int) -> int:
+    """Номер шарда для чата. Остаток в Python всегда неотрицательный, поэтому группы (chat_id < 0) тоже подходят."""
+    return chat_id % shards if shards > 1 else 0
+
+
+def shard_path(base_path: str, index: int) -> str:
+    """data/habits.db -> data/habits.shard0.db"""
+    root, ext = os.path.splitext(base_path)
+    return f"{root}.shard{index}{ext}"
+
+
+# Что копируется в шард: таблица -> условие отбора строк (shard_users — id пользователей шарда).
+# Состояния FSM не переносятся: это незавершённые диалоги, их можно начать заново.
+SHARDED_TABLES = [
+    ("users", "id IN (SELECT id FROM shard_users)"),
+    ("habits", "user_id IN (SELECT id FROM shard_users)"),
+    ("progress", "habit_id IN (SELECT h.id FROM src.habits h JOIN shard_users u ON u.id = h.user_id)"),
+    ("habit_stats", "habit_id IN (SELECT h.id FROM src.habits h JOIN shard_users u ON u.id = h.user_id)"),
+    ("progress_archive", "habit_id IN (SELECT h.id FROM src.habits h JOIN shard_users u ON u.id = h.user_id)"),
+    ("meta", "1"),
+]
+
+
+def split_database(src_path: str, shards: int) -> List[str]:
+    """
+    Разбивает базу src_path на shards файлов по shard_for(chat_id).
+    id строк сохраняются. Исходная база сначала доводится до текущей схемы
+    (как при обычном запуске бота), других изменений в ней нет.
+    """
+    asyncio.run(_create_schema(src_path))
+    paths = []
+    for index in range(shards):
+        path = shard_path(src_path, index)
+        if os.path.exists(path):
+            raise FileExistsError(path)
+        asyncio.run(_create_schema(path))
+        conn = sqlite3.connect(path)
+        try:
+            conn.execute("ATTACH DATABASE ? AS src", (src_path,))
+            conn.execute(
+                "CREATE TEMP TABLE shard_users AS SELECT id FROM src.users WHERE ((chat_id % ?) + ?) % ? = ?",
+                (shards, shards, shards, index),
+            )
+            for table, where in SHARDED_TABLES:
+                columns = [r[1] for r in conn.execute(f"PRAGMA src.table_info({table})")]
+                target = {r[1] for r in conn.execute(f"PRAGMA main.table_info({table})")}
+                cols = ", ".join(c for c in columns if c in target)
+                conn.execute(f"INSERT INTO main.{table} ({cols}) SELECT {cols} FROM src.{table} WHERE {where}")
+            conn.commit()
+            conn.execute("DETACH DATABASE src")
+        finally:
+            conn.close()
+        paths.append(path)
+    return paths
+
+
+async def _create_schema(path: str) -> None:
+    db = Database(path)
+    await db.connect()
+    await db.close()
+
+
+if __name__ == "__main__":
+    # python -m data.shards N [path] — разбить базу на N шардов
+    if len(sys.argv) < 2:
+        print("usage: python -m data.shards N [path]")
+        sys.exit(2)
+    for p in split_database(sys.argv[2] if len(sys.argv) > 2 else DB_FILE, int(sys.argv[1])):
+        print(p)
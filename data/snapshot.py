@@ -0,0 +1,227 @@
+# snapshot.py
+"""
+Снимок базы для аналитики в колоночном виде: каталог с файлами .npy (по одному на
+колонку) и meta.json. Пишется только стандартной библиотекой (array + заголовок .npy),
+читается как numpy.load(..., mmap_mode="r"), так и без numpy — read_column().
+
+  users.id, users.chat_id                       — int32, int64
+  habits.id, habits.user_id, habits.schedule_mask, habits.start_day
+  progress.habit_id, progress.day               — отсортированы по (habit_id, day)
+
+habits.start_day — день создания привычки или первой отметки, если она раньше
+(история, загруженная через data.transfer, старше самой привычки).
+
+Даты — номера дней от 1970-01-01 (как numpy datetime64[D]); день недели —
+(day + 3) % 7, 0 = пн. Отметки из progress_archive разворачиваются в обычные строки.
+
+Снимки лежат в ROOT/<метка времени>/, ROOT/LATEST — имя последнего готового;
+хранятся keep последних.
+
+python -m data.snapshot ROOT [--db=PATH] [--keep=N]
+"""
+import array
+import ast
+import datetime
+import json
+import os
+import shutil
+import sqlite3
+import sys
+import time
+from typing import Any, Dict, List, Optional
+
+from data.archive import expand_month
+from data.db import DB_FILE
+
+EPOCH = datetime.date(1970, 1, 1)
+LATEST = "LATEST"
+KEEP = 3
+
+# typecode array -> dtype numpy (little-endian)
+DTYPES = {"b": "|i1", "B": "|u1", "i": "<i4", "q": "<i8"}
+TYPECODES = {v: k for k, v in DTYPES.items()}
+
+
+def day_number(iso: str) -> int:
+    """'YYYY-MM-DD' (или 'YYYY-MM-DD HH:MM:SS') -> дней от 1970-01-01."""
+    return (datetime.date.fromisoformat(iso[:10]) - EPOCH).days
+
+
+def day_date(day: int) -> datetime.date:
+    return EPOCH + datetime.timedelta(days=int(day))
+
+
+# ---------- Формат .npy ----------
+def _write_npy(path: str, values: array.array) -> None:
+    header = repr({"descr": DTYPES[values.typecode], "fortran_order": False, "shape": (len(values),)})
+    # магия + версия + длина заголовка, заголовок дополняется пробелами до кратного 64
+    pad = 64 - (10 + len(header) + 1) % 64
+    header = header + " " * pad + "\n"
+    if sys.byteorder == "big":
+        values = array.array(values.typecode, values)
+        values.byteswap()
+    with open(path, "wb") as f:
+        f.write(b"\x93NUMPY\x01\x00")
+        f.write(len(header).to_bytes(2, "little"))
+        f.write(header.encode("latin1"))
+        values.tofile(f)
+
+
+def read_column(path: str) -> array.array:
+    """Колонка .npy без numpy (только одномерные массивы, записанные _write_npy)."""
+    with open(path, "rb") as f:
+        if f.read(8) != b"\x93NUMPY\x01\x00":
+            raise ValueError(f"Not an .npy v1.0 file: {path}")
+        header = ast.literal_eval(f.read(int.from_bytes(f.read(2), "little")).decode("latin1"))
+        values = array.array(TYPECODES[header["descr"]])
+        values.frombytes(f.read())
+    if sys.byteorder == "big":
+        values.byteswap()
+    return values
+
+
+# ---------- Запись ----------
+def _collect(conn: sqlite3.Connection) -> Dict[str, array.array]:
+    cols = {
+        "users.id": array.array("i"),
+        "users.chat_id": array.array("q"),
+        "habits.id": array.array("i"),
+        "habits.user_id": array.array("i"),
+        "habits.schedule_mask": array.array("B"),
+        "habits.start_day": array.array("i"),
+        "progress.habit_id": array.array("i"),
+        "progress.day": array.array("i"),
+    }
+    for uid, chat_id in conn.execute("SELECT id, chat_id FROM users ORDER BY id"):
+        cols["users.id"].append(uid)
+        cols["users.chat_id"].append(chat_id)
+    for hid, uid, mask, created in conn.execute("SELECT id, user_id, schedule_mask, created_at FROM habits ORDER BY id"):
+        cols["habits.id"].append(hid)
+        cols["habits.user_id"].append(uid)
+        cols["habits.schedule_mask"].append(mask)
+        cols["habits.start_day"].append(day_number(created))
+
+    archived: Dict[int, List[int]] = {}
+    if conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'progress_archive'").fetchone():
+        for hid, month, bits in conn.execute("SELECT habit_id, month, days FROM progress_archive ORDER BY habit_id, month"):
+            archived.setdefault(hid, []).extend(day_number(d) for d in expand_month(month, bits))
+    archived_ids = sorted(archived)
+    habit_col, day_col = cols["progress.habit_id"], cols["progress.day"]
+    habit_ids, start_col = cols["habits.id"], cols["habits.start_day"]
+    hpos = 0  # позиция привычки в habits.* (обе последовательности идут по возрастанию id)
+
+    def emit(hid: int, days: List[int]) -> None:
+        nonlocal hpos
+        extra = archived.get(hid)
+        if extra:
+            # отметка могла попасть в progress и после архивации (загрузка старой истории)
+            days = sorted(set(days).union(extra))
+        habit_col.extend([hid] * len(days))
+        day_col.extend(days)
+        while hpos < len(habit_ids) and habit_ids[hpos] < hid:
+            hpos += 1
+        if days and hpos < len(habit_ids) and habit_ids[hpos] == hid:
+            start_col[hpos] = min(start_col[hpos], days[0])
+
+    # привычки идут по возрастанию id; архивные без живых отметок вставляются на своё место
+    pos = 0
+    current: Optional[int] = None
+    days: List[int] = []
+    for hid, date in conn.execute("SELECT habit_id, date FROM progress ORDER BY habit_id, date"):
+        if hid != current:
+            if current is not None:
+                emit(current, days)
+            while pos < len(archived_ids) and archived_ids[pos] < hid:
+                emit(archived_ids[pos], [])
+                pos += 1
+            if pos < len(archived_ids) and archived_ids[pos] == hid:
+                pos += 1
+            current, days = hid, []
+        days.append(day_number(date))
+    if current is not None:
+        emit(current, days)
+    for hid in archived_ids[pos:]:
+        emit(hid, [])
+    return cols
+
+
+def write_snapshot(db_path: str, root: str, keep: int = KEEP) -> str:
+    """
+    Снимок базы db_path в новый каталог внутри root. База открывается отдельным
+    соединением только для чтения, все таблицы читаются в одной транзакции.
+    Синхронная функция — из бота вызывается через asyncio.to_thread.
+    Возвращает путь к снимку.
+    """
+    started = time.perf_counter()
+    conn = sqlite3.connect(f"file:{os.path.abspath(db_path)}?mode=ro", uri=True)
+    try:
+        conn.execute("BEGIN")  # один снимок на все таблицы
+        cols = _collect(conn)
+        conn.rollback()
+    finally:
+        conn.close()
+
+    os.makedirs(root, exist_ok=True)
+    name = datetime.datetime.now(datetime.timezone.utc).strftime("%Y%m%dT%H%M%S")
+    tmp = os.path.join(root, f".{name}.tmp")
+    shutil.rmtree(tmp, ignore_errors=True)
+    os.makedirs(tmp)
+    for column, values in cols.items():
+        _write_npy(os.path.join(tmp, f"{column}.npy"), values)
+    meta = {
+        "created_at": datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds"),
+        "source": os.path.abspath(db_path),
+        "today": (datetime.date.today() - EPOCH).days,
+        "rows": {column: len(values) for column, values in cols.items()},
+        "dtypes": {column: DTYPES[values.typecode] for column, values in cols.items()},
+        "seconds": round(time.perf_counter() - started, 3),
+    }
+    with open(os.path.join(tmp, "meta.json"), "w", encoding="utf-8") as f:
+        json.dump(meta, f, indent=2)
+
+    path = os.path.join(root, name)
+    shutil.rmtree(path, ignore_errors=True)
+    os.replace(tmp, path)
+    # LATEST переключается атомарно: читатель видит либо старый, либо новый снимок
+    with open(os.path.join(root, LATEST + ".tmp"), "w", encoding="utf-8") as f:
+        f.write(name)
+    os.replace(os.path.join(root, LATEST + ".tmp"), os.path.join(root, LATEST))
+    _prune(root, keep)
+    return path
+
+
+def _prune(root: str, keep: int) -> None:
+    names = sorted(n for n in os.listdir(root) if not n.startswith(".") and os.path.isdir(os.path.join(root, n)))
+    for n in names[:-keep] if keep > 0 else []:
+        shutil.rmtree(os.path.join(root, n), ignore_errors=True)
+
+
+# ---------- Чтение ----------
+def latest_snapshot(root: str) -> str:
+    """Путь к последнему готовому снимку в root (или сам root, если это каталог снимка)."""
+    if os.path.exists(os.path.join(root, "meta.json")):
+        return root
+    with open(os.path.join(root, LATEST), encoding="utf-8") as f:
+        return os.path.join(root, f.read().strip())
+
+
+def read_meta(path: str) -> Dict[str, Any]:
+    with open(os.path.join(latest_snapshot(path), "meta.json"), encoding="utf-8") as f:
+        return json.load(f)
+
+
+# ---------- CLI ----------
+def _cli_main(argv: List[str]) -> int:
+    opts = dict(a[2:].split("=", 1) for a in argv if a.startswith("--") and "=" in a)
+    args = [a for a in argv if not a.startswith("--")]
+    if len(args) != 1:
+        print(__doc__)
+        return 2
+    path = write_snapshot(opts.get("db", DB_FILE), args[0], keep=int(opts.get("keep", KEEP)))
+    meta = read_meta(path)
+    print(f"snapshot: {path} {meta['rows']} ({meta['seconds']}s)")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(_cli_main(sys.argv[1:]))
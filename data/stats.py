@@ -0,0 +1,45 @@
+# stats.py
+import datetime
+from datetime import date, timedelta
+from typing import Any, Dict, List, Optional
+
+
+def previous_scheduled(day: date, mask: int) -> Optional[date]:
+    """Ближайший день по расписанию (маска, бит 0 = пн) строго раньше day."""
+    for k in range(1, 8):
+        d = day - timedelta(days=k)
+        if mask >> d.weekday() & 1:
+            return d
+    return None
+
+
+def streak_continues(last_done: Optional[date], day: date, mask: int) -> bool:
+    """Продолжает ли отметка за day серию, закончившуюся last_done (между ними не пропущен ни один день по расписанию)."""
+    if last_done is None:
+        return False
+    prev = previous_scheduled(day, mask)
+    return prev is not None and last_done >= prev
+
+
+def compute_habit_stats(dates: List[date], mask: int, today: date) -> Dict[str, Any]:
+    """Агрегаты по отсортированному списку дат выполнения — то же, что поддерживает mark_done инкрементально."""
+    longest = run = 0
+    prev: Optional[date] = None
+    for d in dates:
+        run = run + 1 if streak_continues(prev, d, mask) else 1
+        longest = max(longest, run)
+        prev = d
+    current = run if prev is not None and (prev == today or streak_continues(prev, today, mask)) else 0
+    return {
+        "current_streak": current,
+        "longest_streak": longest,
+        "total_done": len(dates),
+        "last_done": prev.isoformat() if prev else None,
+        "done_7d": sum(1 for d in dates if today - timedelta(days=7) < d <= today),
+        "done_30d": sum(1 for d in dates if today - timedelta(days=30) < d <= today),
+        "updated_on": today.isoformat(),
+    }
+
+
+def parse_iso(s: str) -> date:
+    return datetime.date.fromisoformat(s)
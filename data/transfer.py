@@ -0,0 +1,253 @@
+# transfer.py
+"""
+Выгрузка и загрузка привычек и истории отметок в JSONL / CSV.
+
+Поток записей (одна запись — одна строка файла):
+  {"type": "user", "chat_id": 1, "username": "...", "tz": "Europe/Moscow", "digest": 0}
+  {"type": "habit", "id": 10, "chat_id": 1, "name": "...", "frequency": "daily", "schedule_mask": 127, "reminder_time": "08:30"}
+  {"type": "progress", "habit_id": 10, "date": "2024-01-31"}
+id привычки — из исходной базы: progress ссылается на него, при загрузке он
+сопоставляется с привычкой в целевой базе (существующей с тем же именем у того же
+пользователя или новой). Привычка идёт в потоке раньше своих отметок.
+
+python -m data.transfer export OUT.{jsonl,csv} [--db=PATH] [--chat=CHAT_ID]
+python -m data.transfer import IN.{jsonl,csv} [--db=PATH] [--chunk=N]
+"""
+import asyncio
+import csv
+import datetime
+import json
+import os
+import sys
+import time
+from typing import Any, AsyncIterator, Dict, IO, Iterable, Iterator, List, Optional, Tuple
+
+import aiosqlite
+
+from data.archive import expand_month
+from data.db import ALL_DAYS, DB_FILE, Database, mask_to_days
+from data.tz import normalize_tz
+
+CSV_FIELDS = ["type", "chat_id", "username", "tz", "digest", "id", "name", "frequency", "schedule_mask", "reminder_time", "habit_id", "date"]
+CHUNK_SIZE = 50000
+
+
+def detect_format(path: str) -> str:
+    return "csv" if path.lower().endswith(".csv") else "jsonl"
+
+
+# ---------- Выгрузка ----------
+async def iter_records(path: str, chat_id: Optional[int] = None) -> AsyncIterator[Dict[str, Any]]:
+    """
+    Записи базы по одной, без загрузки всей истории в память. Читает через отдельное
+    соединение только для чтения — вся выгрузка видит один снимок базы и не мешает боту.
+    chat_id — только этот пользователь, иначе все.
+    """
+    async with aiosqlite.connect(f"file:{os.path.abspath(path)}?mode=ro", uri=True, iter_chunk_size=1000) as conn:
+        conn.row_factory = aiosqlite.Row
+        await conn.execute("BEGIN")  # один снимок на всю выгрузку
+        where, params = ("WHERE u.chat_id = ?", (chat_id,)) if chat_id is not None else ("", ())
+
+        async with conn.execute(f"SELECT u.chat_id, u.username, u.tz, u.digest FROM users u {where} ORDER BY u.id", params) as cur:
+            async for r in cur:
+                yield {"type": "user", "chat_id": r["chat_id"], "username": r["username"], "tz": r["tz"], "digest": r["digest"]}
+
+        habits_sql = f"""
+            SELECT h.id, u.chat_id, h.name, h.frequency, h.schedule_mask, h.reminder_time
+            FROM habits h JOIN users u ON u.id = h.user_id {where} ORDER BY h.id
+        """
+        async with conn.execute(habits_sql, params) as cur:
+            async for r in cur:
+                yield {"type": "habit", **dict(r)}
+
+        # архив (месячные маски) и живые отметки — по привычкам, внутри привычки по дате
+        user_filter = "WHERE habit_id IN (SELECT h.id FROM habits h JOIN users u ON u.id = h.user_id WHERE u.chat_id = ?)" if chat_id is not None else ""
+        async with conn.execute(f"SELECT habit_id, month, days FROM progress_archive {user_filter} ORDER BY habit_id, month", params) as cur:
+            async for r in cur:
+                for day in expand_month(r["month"], r["days"]):
+                    yield {"type": "progress", "habit_id": r["habit_id"], "date": day}
+        async with conn.execute(f"SELECT habit_id, date FROM progress {user_filter} ORDER BY habit_id, date", params) as cur:
+            async for r in cur:
+                yield {"type": "progress", "habit_id": r["habit_id"], "date": r["date"]}
+
+
+async def export_to(path: str, out: IO[str], fmt: str = "jsonl", chat_id: Optional[int] = None) -> int:
+    """Пишет записи в открытый текстовый файл. Возвращает число записей."""
+    count = 0
+    if fmt == "csv":
+        writer = csv.DictWriter(out, fieldnames=CSV_FIELDS, extrasaction="ignore")
+        writer.writeheader()
+        async for record in iter_records(path, chat_id):
+            writer.writerow(record)
+            count += 1
+    else:
+        async for record in iter_records(path, chat_id):
+            out.write(json.dumps(record, ensure_ascii=False))
+            out.write("\n")
+            count += 1
+    return count
+
+
+# ---------- Загрузка ----------
+def read_records(inp: IO[str], fmt: str = "jsonl") -> Iterator[Dict[str, Any]]:
+    """Записи из файла по одной (генератор)."""
+    if fmt == "csv":
+        for row in csv.DictReader(inp):
+            yield {k: v for k, v in row.items() if v not in ("", None)}
+        return
+    for line in inp:
+        line = line.strip()
+        if line:
+            yield json.loads(line)
+
+
+async def import_records(
+    db, records: Iterable[Dict[str, Any]], chunk_size: int = CHUNK_SIZE
+) -> Tuple[Dict[str, int], List[Dict[str, Any]]]:
+    """
+    Загрузка потока записей в подключённую Database (или CachedDatabase).
+    Пользователи — INSERT OR IGNORE по chat_id, привычки сопоставляются по имени у
+    пользователя, отметки вставляются пачками по chunk_size строк (одна транзакция на пачку),
+    повторы по UNIQUE(habit_id, date) пропускаются. В конце пересчитывается habit_stats
+    затронутых привычек. Записи с неверными id, датами или маской не загружаются
+    и считаются в skipped.
+    Возвращает (счётчики, созданные привычки — id, chat_id и reminder_time), чтобы
+    вызывающий поставил напоминания только новым привычкам.
+    """
+    users: Dict[int, int] = {}           # chat_id -> id пользователя в базе
+    existing: Dict[int, Dict[str, int]] = {}  # id пользователя -> {имя привычки: id}
+    habit_map: Dict[int, int] = {}       # id привычки в файле -> id в базе
+    touched_users = set()
+    created: List[Dict[str, Any]] = []
+    chunk: List[Tuple[int, str]] = []
+    pending: Optional[asyncio.Task] = None  # пачка, которую сейчас вставляет писатель
+    counts = {"users": 0, "habits": 0, "habits_created": 0, "progress": 0, "progress_inserted": 0, "skipped": 0}
+
+    async def user_id_for(chat_id: int, username: Optional[str] = None) -> int:
+        uid = users.get(chat_id)
+        if uid is None:
+            uid = users[chat_id] = await db.add_user(chat_id=chat_id, username=username)
+            existing[uid] = {h["name"]: h["id"] for h in await db.get_habits(uid)}
+        return uid
+
+    async def wait_pending() -> None:
+        nonlocal pending
+        if pending is not None:
+            counts["progress_inserted"] += await pending
+            pending = None
+
+    async def flush() -> None:
+        # вставка пачки идёт в потоке SQLite, пока разбирается следующая
+        nonlocal pending
+        await wait_pending()
+        if chunk:
+            pending = asyncio.create_task(db.insert_progress_rows(list(chunk)))
+            chunk.clear()
+
+    for n, record in enumerate(records):
+        if n % 1000 == 0:
+            await asyncio.sleep(0)  # дать писателю и боту поработать во время разбора файла
+        kind = record.get("type")
+        try:
+            if kind == "progress":
+                source_id = int(record["habit_id"])
+                day = datetime.date.fromisoformat(record["date"]).isoformat()
+            elif kind == "habit":
+                chat_id, source_id, name = int(record["chat_id"]), int(record["id"]), record["name"]
+                mask = int(record.get("schedule_mask") or ALL_DAYS)
+                if not isinstance(name, str) or not name or not 0 < mask <= ALL_DAYS:
+                    raise ValueError
+            elif kind == "user":
+                chat_id = int(record["chat_id"])
+        except (KeyError, TypeError, ValueError):
+            counts["skipped"] += 1
+            continue
+
+        if kind == "progress":
+            habit_id = habit_map.get(source_id)
+            if habit_id is None:
+                counts["skipped"] += 1
+                continue
+            chunk.append((habit_id, day))
+            counts["progress"] += 1
+            if len(chunk) >= chunk_size:
+                await flush()
+        elif kind == "habit":
+            uid = await user_id_for(chat_id)
+            habit_id = existing[uid].get(name)
+            if habit_id is None:
+                habit_id = await db.add_habit(
+                    uid,
+                    name,
+                    record.get("frequency") or "daily",
+                    schedule=mask_to_days(mask),
+                    reminder_time=record.get("reminder_time") or None,
+                )
+                existing[uid][name] = habit_id
+                counts["habits_created"] += 1
+                created.append({"id": habit_id, "chat_id": chat_id, "reminder_time": record.get("reminder_time") or None})
+            habit_map[source_id] = habit_id
+            touched_users.add(uid)
+            counts["habits"] += 1
+        elif kind == "user":
+            await user_id_for(chat_id, record.get("username"))
+            try:
+                tz = normalize_tz(record["tz"]) if record.get("tz") else None
+            except ValueError:
+                tz = None  # неизвестный пояс — остаётся время сервера
+            if tz:
+                await db.set_user_timezone(chat_id, tz)
+            if str(record.get("digest") or 0) not in ("0", "False", "false"):
+                await db.set_user_digest(chat_id, True)
+            counts["users"] += 1
+        else:
+            counts["skipped"] += 1
+    await flush()
+    await wait_pending()
+
+    if habit_map:
+        await db.rebuild_habit_stats(habit_ids=sorted(set(habit_map.values())))
+    invalidate = getattr(db, "invalidate_user", None)
+    if invalidate:
+        for uid in touched_users:
+            invalidate(uid)
+    return counts, created
+
+
+async def import_file(
+    db, path: str, fmt: Optional[str] = None, chunk_size: int = CHUNK_SIZE
+) -> Tuple[Dict[str, int], List[Dict[str, Any]]]:
+    with open(path, encoding="utf-8", newline="") as inp:
+        return await import_records(db, read_records(inp, fmt or detect_format(path)), chunk_size)
+
+
+# ---------- CLI ----------
+async def _cli_main(argv: List[str]) -> int:
+    opts = dict(a[2:].split("=", 1) for a in argv if a.startswith("--") and "=" in a)
+    args = [a for a in argv if not a.startswith("--")]
+    if len(args) != 2 or args[0] not in ("export", "import"):
+        print(__doc__)
+        return 2
+    command, path = args
+    db_path = opts.get("db", DB_FILE)
+    started = time.perf_counter()
+    if command == "export":
+        chat_id = int(opts["chat"]) if "chat" in opts else None
+        db = Database(db_path)
+        await db.connect()  # миграции — чтобы выгрузка шла по актуальной схеме
+        await db.close()
+        with open(path, "w", encoding="utf-8", newline="") as out:
+            result: Any = await export_to(db_path, out, detect_format(path), chat_id)
+    else:
+        db = Database(db_path, batch_delay=0)
+        await db.connect()
+        try:
+            result, _ = await import_file(db, path, chunk_size=int(opts.get("chunk", CHUNK_SIZE)))
+        finally:
+            await db.close()
+    print(f"{command}: {result} ({time.perf_counter() - started:.1f}s)")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(_cli_main(sys.argv[1:])))
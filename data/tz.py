@@ -0,0 +1,79 @@
+# tz.py
+import datetime
+import re
+from functools import lru_cache
+from typing import Optional
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+
+# "+3", "UTC+03:00", "GMT-5", "+0530"
+OFFSET_RE = re.compile(r"^(?:UTC|GMT)?\s*([+-])(\d{1,2})(?::?(\d{2}))?$", re.IGNORECASE)
+
+
+def normalize_tz(text: str) -> str:
+    """
+    Имя пояса IANA ('Europe/Moscow') или смещение ('+3', 'UTC-05:30') -> каноническое
+    имя для колонки users.tz. ValueError, если пояс не распознан.
+    """
+    text = (text or "").strip()
+    if text.upper() in ("UTC", "GMT", "Z"):
+        return "UTC"
+    m = OFFSET_RE.match(text)
+    if m:
+        sign, hours, minutes = m.group(1), int(m.group(2)), int(m.group(3) or 0)
+        if hours > 14 or minutes > 59:
+            raise ValueError(f"Bad UTC offset: {text}")
+        return f"UTC{sign}{hours:02d}:{minutes:02d}"
+    try:
+        return ZoneInfo(text).key
+    except (ZoneInfoNotFoundError, ValueError):
+        raise ValueError(f"Unknown timezone: {text}") from None
+
+
+@lru_cache(maxsize=None)
+def get_zone(name: Optional[str]) -> Optional[datetime.tzinfo]:
+    """tzinfo по имени из users.tz; None — местное время сервера."""
+    if not name:
+        return None
+    m = OFFSET_RE.match(name) if name.startswith("UTC") else None
+    if m:
+        sign = -1 if m.group(1) == "-" else 1
+        offset = datetime.timedelta(hours=int(m.group(2)), minutes=int(m.group(3) or 0))
+        return datetime.timezone(sign * offset, name)
+    try:
+        return ZoneInfo(name)
+    except (ZoneInfoNotFoundError, ValueError):
+        return None  # пояс пропал из базы tzdata — считаем по серверу
+
+
+def utcnow() -> datetime.datetime:
+    return datetime.datetime.now(datetime.timezone.utc)
+
+
+def local_now(name: Optional[str], now: Optional[datetime.datetime] = None) -> datetime.datetime:
+    """Текущее (или now, aware) время в поясе name."""
+    now = now or utcnow()
+    zone = get_zone(name)
+    return now.astimezone(zone) if zone else now.astimezone()
+
+
+def local_today(name: Optional[str], now: Optional[datetime.datetime] = None) -> datetime.date:
+    """«Сегодня» для пользователя с поясом name."""
+    return local_now(name, now).date()
+
+
+def next_fire(minute: int, name: Optional[str], after: datetime.datetime) -> datetime.datetime:
+    """
+    Ближайший момент (UTC, строго позже after) местного времени minute (минута суток)
+    в поясе name. Переходы на летнее время учитывает zoneinfo: «пропавшее» время
+    срабатывает со сдвигом, повторяющееся — один раз (fold=0).
+    """
+    zone = get_zone(name)
+    day = local_now(name, after).date()
+    clock = datetime.time(minute // 60, minute % 60)
+    while True:
+        naive = datetime.datetime.combine(day, clock)
+        # naive без пояса astimezone() трактует как местное время сервера
+        fire = (naive.replace(tzinfo=zone) if zone else naive).astimezone(datetime.timezone.utc)
+        if fire > after:
+            return fire
+        day += datetime.timedelta(days=1)
@@ -0,0 +1,279 @@
+# middlewares.py
+import time
+from collections import deque
+from typing import Any, Awaitable, Callable, Deque, Dict, List, Optional, Tuple
+
+from aiogram import BaseMiddleware
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.dispatcher.flags import get_flag
+from aiogram.types import CallbackQuery, Message, TelegramObject
+
+from data.metrics import Timings, current_handler, current_timings
+
+
+def handler_name(data: Dict[str, Any]) -> str:
+    handler = data.get("handler")
+    callback = getattr(handler, "callback", None)
+    return getattr(callback, "__name__", "-")
+
+
+def percentile(sorted_values: List[float], q: float) -> float:
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * q))]
+
+
+class LatencyWindow:
+    """Последние window замеров (всего, SQL, Bot API) — для скользящих перцентилей."""
+
+    def __init__(self, window: int = 1000):
+        self.samples: Deque[Tuple[float, float, float]] = deque(maxlen=window)
+        self.calls = 0
+        self.errors = 0
+
+    def add(self, total: float, db: float = 0.0, api: float = 0.0) -> None:
+        self.samples.append((total, db, api))
+        self.calls += 1
+
+    def summary(self) -> Dict[str, float]:
+        samples = list(self.samples)
+        total = sorted(s[0] for s in samples)
+        spent = sum(total) or 1.0
+        db = sum(s[1] for s in samples)
+        api = sum(s[2] for s in samples)
+        return {
+            "calls": self.calls,
+            "errors": self.errors,
+            "p50": percentile(total, 0.50),
+            "p95": percentile(total, 0.95),
+            "p99": percentile(total, 0.99),
+            "max": total[-1] if total else 0.0,
+            # доли времени окна: SQL, Bot API и всё остальное (рендеринг, логика)
+            "db_share": db / spent if samples else 0.0,
+            "api_share": api / spent if samples else 0.0,
+            "other_share": max(0.0, 1 - (db + api) / spent) if samples else 0.0,
+        }
+
+
+class HandlerMetrics:
+    """
+    Задержки обработчиков и обновлений в целом, число одновременно обрабатываемых
+    обновлений и пропускная способность за последнюю минуту.
+    """
+
+    def __init__(self, window: int = 1000):
+        self.window = window
+        self.handlers: Dict[str, LatencyWindow] = {}
+        self.api_methods: Dict[str, LatencyWindow] = {}
+        self.updates = LatencyWindow(window)
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self._finished: Deque[float] = deque(maxlen=100000)
+
+    def _window(self, table: Dict[str, LatencyWindow], name: str) -> LatencyWindow:
+        w = table.get(name)
+        if w is None:
+            w = table[name] = LatencyWindow(self.window)
+        return w
+
+    def handler(self, name: str) -> LatencyWindow:
+        return self._window(self.handlers, name)
+
+    def api_method(self, name: str) -> LatencyWindow:
+        return self._window(self.api_methods, name)
+
+    def update_started(self) -> None:
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+
+    def update_finished(self) -> None:
+        self.in_flight -= 1
+        self._finished.append(time.monotonic())
+
+    def throughput(self, period: float = 60.0) -> float:
+        """Обработанных обновлений в секунду за последние period секунд."""
+        border = time.monotonic() - period
+        return sum(1 for t in self._finished if t >= border) / period
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "in_flight": self.in_flight,
+            "max_in_flight": self.max_in_flight,
+            "throughput": self.throughput(),
+            "updates": self.updates.summary(),
+            "handlers": {name: w.summary() for name, w in self.handlers.items()},
+            "api": {name: w.summary() for name, w in self.api_methods.items()},
+        }
+
+    def prometheus(self, prefix: str = "habits_bot") -> str:
+        lines = [
+            f"# TYPE {prefix}_updates_in_flight gauge",
+            f"{prefix}_updates_in_flight {self.in_flight}",
+            f"# TYPE {prefix}_updates_in_flight_max gauge",
+            f"{prefix}_updates_in_flight_max {self.max_in_flight}",
+            f"# TYPE {prefix}_updates_per_second gauge",
+            f"{prefix}_updates_per_second {self.throughput():.3f}",
+        ]
+        for kind, label, table in (
+            ("update", None, {"all": self.updates}),
+            ("handler", "handler", self.handlers),
+            ("api", "method", self.api_methods),
+        ):
+            metric = f"{prefix}_{kind}_seconds"
+            lines.append(f"# TYPE {metric} summary")
+            for name, w in table.items():
+                s = w.summary()
+                labels = [f'{label}="{name}"'] if label else []
+                selector = "{" + ",".join(labels) + "}" if labels else ""
+                for q in ("p50", "p95", "p99"):
+                    q_labels = ",".join(labels + [f'quantile="0.{q[1:]}"'])
+                    lines.append(f"{metric}{{{q_labels}}} {s[q]:.6f}")
+                lines.append(f"{metric}_count{selector} {s['calls']}")
+                lines.append(f"{prefix}_{kind}_errors_total{selector} {s['errors']}")
+                if kind != "api":
+                    for part in ("db", "api", "other"):
+                        part_labels = ",".join(labels + [f'part="{part}"'])
+                        lines.append(f"{prefix}_{kind}_time_share{{{part_labels}}} {s[part + '_share']:.4f}")
+        return "\n".join(lines) + "\n"
+
+
+class UpdateTimingMiddleware(BaseMiddleware):
+    """
+    Outer middleware на dp.update: считает одновременно обрабатываемые обновления
+    и полное время обработки; заводит Timings, куда Database и Bot API добавляют своё время.
+    """
+
+    def __init__(self, metrics: HandlerMetrics):
+        self.metrics = metrics
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        timings = Timings()
+        token = current_timings.set(timings)
+        self.metrics.update_started()
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception:
+            self.metrics.updates.errors += 1
+            raise
+        finally:
+            self.metrics.updates.add(time.perf_counter() - started, timings.db, timings.api)
+            self.metrics.update_finished()
+            current_timings.reset(token)
+
+
+class HandlerNameMiddleware(BaseMiddleware):
+    """
+    Inner middleware: выставляет current_handler на время обработчика,
+    чтобы замеры Database попадали в разрез по обработчикам, и пишет задержку
+    обработчика с разбивкой на SQL / Bot API / остальное.
+    """
+
+    def __init__(self, metrics: HandlerMetrics = None):
+        self.metrics = metrics
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        name = handler_name(data)
+        token = current_handler.set(name)
+        timings = current_timings.get()
+        db_before, api_before = (timings.db, timings.api) if timings else (0.0, 0.0)
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception:
+            if self.metrics:
+                self.metrics.handler(name).errors += 1
+            raise
+        finally:
+            if self.metrics:
+                db, api = (timings.db - db_before, timings.api - api_before) if timings else (0.0, 0.0)
+                self.metrics.handler(name).add(time.perf_counter() - started, db, api)
+            current_handler.reset(token)
+
+
+class ApiTimingMiddleware(BaseRequestMiddleware):
+    """Middleware сессии бота: время запросов к Bot API по методам и в Timings текущего обновления."""
+
+    def __init__(self, metrics: HandlerMetrics):
+        self.metrics = metrics
+
+    async def __call__(self, make_request, bot, method):
+        started = time.perf_counter()
+        window = self.metrics.api_method(type(method).__name__)
+        try:
+            return await make_request(bot, method)
+        except Exception:
+            window.errors += 1
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            window.add(elapsed, 0.0, elapsed)
+            timings = current_timings.get()
+            if timings is not None:
+                timings.api += elapsed
+
+
+def callback_habit_id(data: Optional[str]) -> Optional[int]:
+    """id привычки из callback data вида mark:ID, habit:del:ID, habit:del:yes:ID, habit:edit:ID."""
+    if not data:
+        return None
+    tail = data.rsplit(":", 1)[-1]
+    return int(tail) if tail.isdigit() else None
+
+
+class AuthMiddleware(BaseMiddleware):
+    """
+    Inner middleware: находит пользователя (и привычку) один раз на обновление и
+    передаёт их обработчику аргументами user и habit.
+
+    Флаги обработчика:
+      user=True  — пользователь чата (сообщение или callback), при необходимости регистрируется;
+      habit="…"  — callback: привычка из callback data вместе с владельцем одним запросом;
+                   если id в данных нет, привычка чужая или не найдена, отвечает этим текстом
+                   и обработчик не вызывается.
+    """
+
+    def __init__(self, db):
+        self.db = db
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        denied = get_flag(data, "habit")
+        if denied and isinstance(event, CallbackQuery):
+            habit_id = callback_habit_id(event.data)
+            user, habit = (None, None) if habit_id is None else await self.db.get_user_and_habit(
+                event.message.chat.id, habit_id
+            )
+            # нечисловые или подделанные данные — тот же отказ: обработчик ждёт habit
+            if habit is None:
+                await event.answer(denied, show_alert=True)
+                return None
+            data["user"] = user
+            data["habit"] = habit
+        elif get_flag(data, "user"):
+            message = event.message if isinstance(event, CallbackQuery) else event
+            if isinstance(message, Message):
+                data["user"] = await self.get_or_register(message.chat.id, event.from_user)
+        return await handler(event, data)
+
+    async def get_or_register(self, chat_id: int, from_user=None) -> dict:
+        user = await self.db.get_user_by_chat(chat_id)
+        if not user:
+            username = from_user.username if from_user else None
+            await self.db.add_user(chat_id=chat_id, username=username)
+            user = await self.db.get_user_by_chat(chat_id)
+        return user
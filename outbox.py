@@ -0,0 +1,257 @@
+# outbox.py
+import asyncio
+import logging
+import time
+from collections import OrderedDict, deque
+from typing import Any, Dict, Optional
+
+from aiogram.exceptions import TelegramAPIError, TelegramRetryAfter
+
+logger = logging.getLogger(__name__)
+
+
+def _consume_exception(fut: "asyncio.Future") -> None:
+    # ошибка уже залогирована; помечаем её прочитанной, если future никто не ждёт
+    if not fut.cancelled():
+        fut.exception()
+
+
+class TokenBucket:
+    """
+    Token bucket: rate токенов в секунду, не больше capacity в запасе.
+    reserve() сразу забирает токен и возвращает, сколько секунд нужно подождать.
+    """
+
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self) -> float:
+        """Сколько ждать до следующего токена (без списания)."""
+        self._refill()
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def reserve(self) -> float:
+        self._refill()
+        self.tokens -= 1
+        return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def pause(self, seconds: float) -> None:
+        """Следующий токен — не раньше чем через seconds (после TelegramRetryAfter)."""
+        self._refill()
+        self.tokens = min(self.tokens, 1 - seconds * self.rate)
+
+
+class Outbox:
+    """
+    Очередь исходящих сообщений с ограничением скорости.
+    Глобальный лимит и лимит на чат — token bucket'ы; отправляет пул из workers задач.
+    На TelegramRetryAfter сообщение возвращается в очередь через retry_after секунд,
+    а глобальный лимит приостанавливается на то же время.
+    """
+
+    def __init__(
+        self,
+        bot,
+        rate: float = 25.0,
+        per_chat_rate: float = 1.0,
+        per_chat_burst: float = 3.0,
+        workers: int = 8,
+        max_queue: int = 100000,
+        max_retries: int = 3,
+        max_chats: int = 100000,
+    ):
+        self.bot = bot
+        self.global_bucket = TokenBucket(rate)
+        self.per_chat_rate = per_chat_rate
+        self.per_chat_burst = per_chat_burst
+        self.workers = workers
+        self.max_retries = max_retries
+        self.max_chats = max_chats
+        self.queue: "asyncio.Queue[dict]" = asyncio.Queue(maxsize=max_queue)
+        self._chat_buckets: "OrderedDict[int, TokenBucket]" = OrderedDict()
+        self._tasks: list = []
+        self._delayed: Dict[asyncio.TimerHandle, dict] = {}  # отложенные через call_later
+        # метрики
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+        self.dropped = 0
+        self.latencies: deque = deque(maxlen=1000)
+
+    # ---------- Жизненный цикл ----------
+    async def start(self) -> None:
+        if self._tasks:
+            return
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self, drain: bool = True, timeout: float = 10.0) -> None:
+        """
+        Остановить worker'ы. С drain — сначала дождаться (не дольше timeout) отправки
+        очереди и отложенных сообщений; неотправленные завершаются ошибкой.
+        """
+        if drain:
+            try:
+                await asyncio.wait_for(self._drain(), timeout)
+            except asyncio.TimeoutError:
+                logger.warning(
+                    "Outbox stopped with %d messages in queue, %d delayed",
+                    self.queue.qsize(), len(self._delayed),
+                )
+        for t in self._tasks:
+            t.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        left = list(self._delayed.values())
+        for handle in self._delayed:
+            handle.cancel()
+        self._delayed.clear()
+        while not self.queue.empty():
+            left.append(self.queue.get_nowait())
+        for item in left:
+            if not item["future"].done():
+                item["future"].set_exception(RuntimeError("Outbox stopped"))
+
+    async def _drain(self) -> None:
+        # отложенное сообщение возвращается в очередь позже, поэтому join() повторяется
+        while True:
+            await self.queue.join()
+            if not self._delayed:
+                return
+            await asyncio.sleep(0.1)
+
+    # ---------- API ----------
+    def send_message(self, chat_id: int, text: str, **kwargs: Any) -> "asyncio.Future":
+        """
+        Поставить сообщение в очередь. Не ждёт отправки: возвращает future,
+        который завершится результатом bot.send_message или исключением.
+        """
+        fut = asyncio.get_running_loop().create_future()
+        fut.add_done_callback(_consume_exception)
+        item = {
+            "chat_id": chat_id,
+            "text": text,
+            "kwargs": kwargs,
+            "future": fut,
+            "attempt": 0,
+            "queued_at": time.monotonic(),
+        }
+        try:
+            self.queue.put_nowait(item)
+        except asyncio.QueueFull:
+            self.dropped += 1
+            fut.set_exception(RuntimeError("Outbox queue is full"))
+        return fut
+
+    def metrics(self) -> Dict[str, Any]:
+        lat = sorted(self.latencies)
+        return {
+            "queue_depth": self.queue.qsize(),
+            "delayed": len(self._delayed),
+            "sent": self.sent,
+            "failed": self.failed,
+            "retried": self.retried,
+            "dropped": self.dropped,
+            "latency_avg": sum(lat) / len(lat) if lat else 0.0,
+            "latency_p99": lat[int(len(lat) * 0.99) - 1] if lat else 0.0,
+            "latency_max": lat[-1] if lat else 0.0,
+        }
+
+    def prometheus(self, prefix: str = "habits_bot") -> str:
+        m = self.metrics()
+        lines = []
+        for name in ("queue_depth", "delayed"):
+            lines.append(f"# TYPE {prefix}_outbox_{name} gauge")
+            lines.append(f"{prefix}_outbox_{name} {m[name]}")
+        for name in ("sent", "failed", "retried", "dropped"):
+            lines.append(f"# TYPE {prefix}_outbox_{name}_total counter")
+            lines.append(f"{prefix}_outbox_{name}_total {m[name]}")
+        metric = f"{prefix}_outbox_latency_seconds"
+        lines.append(f"# TYPE {metric} gauge")
+        for stat in ("avg", "p99", "max"):
+            lines.append(f'{metric}{{stat="{stat}"}} {m["latency_" + stat]:.6f}')
+        return "\n".join(lines) + "\n"
+
+    # ---------- Внутреннее ----------
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = TokenBucket(self.per_chat_rate, self.per_chat_burst)
+            self._chat_buckets[chat_id] = bucket
+            if len(self._chat_buckets) > self.max_chats:
+                self._chat_buckets.popitem(last=False)
+        else:
+            self._chat_buckets.move_to_end(chat_id)
+        return bucket
+
+    def _requeue_later(self, item: dict, delay: float) -> None:
+        """Вернуть сообщение в очередь через delay секунд, не занимая worker."""
+        def _put():
+            self._delayed.pop(handle, None)
+            try:
+                self.queue.put_nowait(item)
+            except asyncio.QueueFull:
+                self.dropped += 1
+                if not item["future"].done():
+                    item["future"].set_exception(RuntimeError("Outbox queue is full"))
+
+        handle = asyncio.get_running_loop().call_later(delay, _put)
+        self._delayed[handle] = item
+
+    async def _worker(self) -> None:
+        while True:
+            item = await self.queue.get()
+            try:
+                await self._process(item)
+            except Exception:
+                logger.exception("Outbox worker error")
+            finally:
+                self.queue.task_done()
+
+    async def _process(self, item: dict) -> None:
+        # лимит на чат: если чат «перегрет», откладываем сообщение и берём следующее
+        chat_bucket = self._chat_bucket(item["chat_id"])
+        chat_wait = chat_bucket.delay()
+        if chat_wait > 0:
+            self._requeue_later(item, chat_wait)
+            return
+        chat_bucket.reserve()
+
+        wait = self.global_bucket.reserve()
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+        fut = item["future"]
+        try:
+            result = await self.bot.send_message(item["chat_id"], item["text"], **item["kwargs"])
+        except TelegramRetryAfter as e:
+            item["attempt"] += 1
+            if item["attempt"] > self.max_retries:
+                self.failed += 1
+                if not fut.done():
+                    fut.set_exception(e)
+                return
+            self.retried += 1
+            logger.warning("Flood limit for chat %s, retry in %ss", item["chat_id"], e.retry_after)
+            # флуд-лимит Telegram общий для бота: остальные чаты тоже ждут
+            self.global_bucket.pause(e.retry_after)
+            self._requeue_later(item, e.retry_after)
+            return
+        except (TelegramAPIError, OSError) as e:
+            self.failed += 1
+            logger.warning("Failed to send message to %s: %s", item["chat_id"], e)
+            if not fut.done():
+                fut.set_exception(e)
+            return
+
+        self.sent += 1
+        self.latencies.append(time.monotonic() - item["queued_at"])
+        if not fut.done():
+            fut.set_result(result)
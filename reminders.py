@@ -0,0 +1,132 @@
+# reminders.py
+import asyncio
+import datetime
+import heapq
+import logging
+from collections import defaultdict
+from typing import Awaitable, Callable, Dict, Iterator, List, Optional, Tuple
+
+from data.tz import local_today, next_fire, utcnow
+
+logger = logging.getLogger(__name__)
+
+
+def minute_of_day(reminder_time: str) -> Optional[int]:
+    """'HH:MM' -> номер минуты в сутках (0..1439) или None при неверном формате."""
+    try:
+        hour, minute = map(int, reminder_time.split(":"))
+    except (AttributeError, ValueError):
+        return None
+    if not (0 <= hour <= 23 and 0 <= minute <= 59):
+        return None
+    return hour * 60 + minute
+
+
+class ReminderDispatcher:
+    """
+    Диспетчер напоминаний: куча (момент срабатывания в UTC, habit_id).
+    Время напоминания — местное время владельца привычки; в куче оно уже переведено
+    в UTC, поэтому tick() снимает с вершины только наступившие напоминания и не
+    перебирает остальные. Снятые группируются по (пояс, местная дата) — для каждой
+    группы один запрос отбирает привычки, которые сегодня по расписанию и ещё не
+    отмечены, — и сразу планируются на следующие сутки (с учётом летнего времени).
+    Пользователям с режимом сводки (users.digest) напоминания одного тика уходят
+    одним вызовом send_digest(chat_id, habits) вместо send(habit) на каждую привычку.
+    """
+
+    # напоминания, опоздавшие сильнее (бот был выключен), не отправляются, а переносятся
+    MAX_DELAY = 300.0
+
+    def __init__(
+        self,
+        db,
+        send: Callable[[dict], Awaitable[None]],
+        send_digest: Optional[Callable[[int, List[dict]], Awaitable[None]]] = None,
+    ):
+        self.db = db
+        self.send = send
+        self.send_digest = send_digest
+        self.heap: List[Tuple[float, int]] = []               # (UTC timestamp, habit_id)
+        # habit_id -> (UTC timestamp, минута суток, пояс); записи кучи, не совпадающие
+        # с entries, устарели (привычку удалили или перепланировали) и пропускаются
+        self.entries: Dict[int, Tuple[float, int, Optional[str]]] = {}
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    async def load(self, now: Optional[datetime.datetime] = None) -> None:
+        self.heap = []
+        self.entries = {}
+        now = now or utcnow()
+        for h in await self.db.get_all_habits_with_reminders():
+            self.add(h, now)
+        zones = {tz for _, _, tz in self.entries.values()}
+        logger.info("Reminder index loaded: %d habits in %d timezones", len(self.entries), len(zones))
+
+    def add(self, habit: dict, now: Optional[datetime.datetime] = None) -> None:
+        """habit — id, reminder_time и tz владельца (None — время сервера)."""
+        self.remove(habit["id"])
+        minute = minute_of_day(habit.get("reminder_time"))
+        if minute is None:
+            return
+        self._schedule(habit["id"], minute, habit.get("tz"), now or utcnow())
+
+    def remove(self, habit_id: int) -> None:
+        self.entries.pop(habit_id, None)
+
+    def _schedule(self, habit_id: int, minute: int, tz: Optional[str], after: datetime.datetime) -> None:
+        fire = next_fire(minute, tz, after).timestamp()
+        self.entries[habit_id] = (fire, minute, tz)
+        heapq.heappush(self.heap, (fire, habit_id))
+        if len(self.heap) > 2 * len(self.entries) + 1000:
+            self._compact()
+
+    def _compact(self) -> None:
+        # выбросить устаревшие записи, если их накопилось больше живых
+        self.heap = [(fire, hid) for hid, (fire, _, _) in self.entries.items()]
+        heapq.heapify(self.heap)
+
+    def next_fire_at(self) -> Optional[datetime.datetime]:
+        """Ближайшее запланированное срабатывание (UTC) или None."""
+        while self.heap:
+            fire, hid = self.heap[0]
+            entry = self.entries.get(hid)
+            if entry is not None and entry[0] == fire:
+                return datetime.datetime.fromtimestamp(fire, datetime.timezone.utc)
+            heapq.heappop(self.heap)
+        return None
+
+    async def tick(self, now: Optional[datetime.datetime] = None) -> int:
+        """Отправить напоминания, время которых наступило. Возвращает их число."""
+        now = now or utcnow()
+        cutoff = now.timestamp()
+        groups: Dict[Tuple[Optional[str], datetime.date], List[int]] = defaultdict(list)
+        while self.heap and self.heap[0][0] <= cutoff:
+            fire, hid = heapq.heappop(self.heap)
+            entry = self.entries.get(hid)
+            if entry is None or entry[0] != fire:
+                continue
+            _, minute, tz = entry
+            fire_at = datetime.datetime.fromtimestamp(fire, datetime.timezone.utc)
+            self._schedule(hid, minute, tz, max(fire_at, now))
+            if cutoff - fire > self.MAX_DELAY:
+                continue
+            groups[(tz, local_today(tz, fire_at))].append(hid)
+        if not groups:
+            return 0
+        due: List[dict] = []
+        for (tz, day), ids in groups.items():
+            due.extend(await self.db.get_due_reminders(ids, day))
+        if due:
+            await asyncio.gather(*self._deliveries(due))
+        return len(due)
+
+    def _deliveries(self, due: List[dict]) -> Iterator[Awaitable[None]]:
+        digests: Dict[int, List[dict]] = defaultdict(list)
+        for h in due:
+            if self.send_digest is not None and h.get("digest"):
+                digests[h["chat_id"]].append(h)
+            else:
+                yield self.send(h)
+        for chat_id, habits in digests.items():
+            yield self.send_digest(chat_id, habits)
@@ -0,0 +1,61 @@
+# render.py
+import datetime
+from typing import Any, Callable, Awaitable, Hashable, Optional
+
+from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup
+
+from data.cache import LRUCache
+
+
+class RenderCache:
+    """
+    Кэш готовых текстов отчётов и inline-клавиатур.
+    Ключ — (user_id, вид, дата, версия данных пользователя). Версию выдаёт
+    CachedDatabase.data_version и меняет при mark_done и правке привычек,
+    так что старые записи просто перестают находиться и вытесняются LRU.
+    """
+
+    def __init__(self, db, maxsize: int = 10000, ttl: float = 300.0):
+        self.db = db
+        self.cache = LRUCache(maxsize, ttl)
+
+    def key(self, user_id: int, kind: str, day: Optional[str] = None) -> tuple:
+        day = day or datetime.date.today().isoformat()
+        return (user_id, kind, day, self.db.data_version(user_id))
+
+    async def get_or_render(self, key: Hashable, render: Callable[[], Awaitable[Any]]) -> Any:
+        value = self.cache.get(key)
+        if value is None:
+            value = await render()
+            if value is not None:
+                self.cache.set(key, value)
+        return value
+
+    def set(self, key: Hashable, value: Any) -> None:
+        self.cache.set(key, value)
+
+    def stats(self):
+        return self.cache.stats()
+
+
+def patch_mark_button(markup: Optional[InlineKeyboardMarkup], habit_id: int, done: bool = True) -> Optional[InlineKeyboardMarkup]:
+    """
+    Вернуть копию клавиатуры, где у кнопки mark:{habit_id} заменён статус.
+    Остальные кнопки переиспользуются как есть. None — если кнопки нет.
+    """
+    if markup is None:
+        return None
+    target = f"mark:{habit_id}"
+    text = "✅" if done else "⬜"
+    rows = []
+    found = False
+    for row in markup.inline_keyboard:
+        new_row = []
+        for button in row:
+            if button.callback_data == target:
+                found = True
+                if button.text != text:
+                    button = InlineKeyboardButton(text=text, callback_data=target)
+            new_row.append(button)
+        rows.append(new_row)
+    return InlineKeyboardMarkup(inline_keyboard=rows) if found else None
@@ -0,0 +1,158 @@
+# sharding.py
+import asyncio
+import logging
+import multiprocessing
+import os
+from functools import partial
+from queue import Full
+from typing import Optional
+
+from aiogram import Bot, Dispatcher
+from aiogram.exceptions import TelegramNetworkError, TelegramServerError
+from aiogram.types import Update
+from aiogram.utils.backoff import Backoff, BackoffConfig
+
+from data.shards import shard_for, shard_path
+
+logger = logging.getLogger(__name__)
+
+# столько фронт ждёт места в очереди воркера, потом обновление отбрасывается
+PUT_TIMEOUT = 10
+# повтор getUpdates после сетевой ошибки — как в polling самого aiogram
+BACKOFF = BackoffConfig(min_delay=1.0, max_delay=5.0, factor=1.3, jitter=0.1)
+
+
+def update_chat_id(update: Update) -> Optional[int]:
+    """chat_id, по которому маршрутизируется обновление."""
+    event = update.event
+    chat = getattr(event, "chat", None)
+    if chat is None and getattr(event, "message", None) is not None:
+        chat = getattr(event.message, "chat", None)  # callback_query
+    if chat is not None:
+        return chat.id
+    user = getattr(event, "from_user", None)
+    return user.id if user is not None else None
+
+
+def worker_main(index: int, queue, db_path: str, send_rate: float) -> None:
+    """
+    Точка входа процесса-воркера: свой шард базы, свой диспетчер напоминаний.
+
+    Так и задумано, что воркер получает всё окружение бота импортом bot: его
+    модульная настройка (Bot, Database, Dispatcher, обработчики) читает параметры
+    из окружения, поэтому перед импортом сюда подставляются путь шарда и его доля
+    лимита отправки. Соединения открываются только в startup(), так что копия
+    главного модуля, которую spawn импортирует как __mp_main__, ничего не занимает.
+    """
+    os.environ["DB_PATH"] = db_path
+    os.environ["SEND_RATE"] = str(send_rate)
+    os.environ["SHARDS"] = "1"
+    import bot
+    logging.getLogger(__name__).info("Worker %d serving %s", index, db_path)
+    asyncio.run(bot.run_worker(queue))
+
+
+async def consume(queue, dp: Dispatcher, bot: Bot, concurrency: int = 100) -> None:
+    """Читает сырые обновления из очереди фронта и обрабатывает их, не больше concurrency сразу."""
+    loop = asyncio.get_running_loop()
+    semaphore = asyncio.Semaphore(concurrency)
+    tasks = set()
+
+    async def process(update: Update) -> None:
+        try:
+            await dp.feed_update(bot, update)
+        except Exception:
+            logger.exception("Failed to process update %s", update.update_id)
+        finally:
+            semaphore.release()
+
+    while True:
+        raw = await loop.run_in_executor(None, queue.get)
+        if raw is None:
+            break
+        update = Update.model_validate_json(raw, context={"bot": bot})
+        await semaphore.acquire()
+        task = asyncio.create_task(process(update))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+    if tasks:
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+async def run_front(bot: Bot, settings) -> None:
+    """
+    Фронт-процесс: получает обновления через long polling и раскладывает их
+    по settings.shards воркерам по shard_for(chat_id). С базой фронт не работает.
+    """
+    n = settings.shards
+    ctx = multiprocessing.get_context("spawn")
+    queues = [ctx.Queue(maxsize=10000) for _ in range(n)]
+    procs = [None] * n
+
+    def start_worker(i: int) -> None:
+        procs[i] = ctx.Process(
+            target=worker_main,
+            args=(i, queues[i], shard_path(settings.db_path, i), settings.send_rate / n),
+            name=f"bot-shard-{i}",
+        )
+        procs[i].start()
+
+    def restart_worker(i: int) -> None:
+        # упавший воркер мог оставить захваченной блокировку очереди — она заменяется новой,
+        # необработанные обновления из старой теряются
+        logger.error(
+            "Worker %d died (exit code %s), restarting; dropping ~%s queued updates",
+            i, procs[i].exitcode, _qsize(queues[i]),
+        )
+        queues[i] = ctx.Queue(maxsize=10000)
+        start_worker(i)
+
+    for i in range(n):
+        start_worker(i)
+
+    loop = asyncio.get_running_loop()
+    await bot.delete_webhook(drop_pending_updates=True)
+    offset = None
+    backoff = Backoff(config=BACKOFF)
+    try:
+        while True:
+            try:
+                updates = await bot.get_updates(offset=offset, timeout=30)
+            except (TelegramNetworkError, TelegramServerError, asyncio.TimeoutError) as e:
+                # сбой сети или Telegram не должен останавливать воркеров
+                logger.error("Failed to fetch updates - %s: %s", type(e).__name__, e)
+                logger.warning("Sleep for %.1f seconds and try again (tries = %d)", backoff.next_delay, backoff.counter)
+                await backoff.asleep()
+                continue
+            backoff.reset()
+            for update in updates:
+                offset = update.update_id + 1
+                index = shard_for(update_chat_id(update) or 0, n)
+                if not procs[index].is_alive():
+                    restart_worker(index)
+                raw = update.model_dump_json(by_alias=True, exclude_none=True)
+                # put может ждать, если воркер не успевает — это и есть backpressure;
+                # зависший воркер задерживает фронт не больше чем на PUT_TIMEOUT
+                try:
+                    await loop.run_in_executor(None, partial(queues[index].put, raw, timeout=PUT_TIMEOUT))
+                except Full:
+                    logger.warning("Worker %d queue is full, dropping update %s", index, update.update_id)
+    finally:
+        for q, p in zip(queues, procs):
+            if not p.is_alive():
+                continue
+            try:
+                await loop.run_in_executor(None, partial(q.put, None, timeout=PUT_TIMEOUT))
+            except Full:
+                logger.warning("Worker %s queue is full, terminating it", p.name)
+                p.terminate()
+        for p in procs:
+            await loop.run_in_executor(None, p.join, 30)
+        await bot.session.close()
+
+
+def _qsize(queue) -> object:
+    try:
+        return queue.qsize()
+    except NotImplementedError:  # macOS
+        return "?"
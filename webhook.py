@@ -0,0 +1,111 @@
+# webhook.py
+import asyncio
+import logging
+import secrets
+from typing import Callable, Optional, Set
+
+from aiogram import Bot, Dispatcher
+from aiogram.types import Update
+from aiohttp import web
+
+logger = logging.getLogger(__name__)
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+class WebhookHandler:
+    """
+    Приём обновлений от Telegram по webhook.
+    Ответ 200 отдаётся сразу, обработка идёт в фоне; одновременно обрабатывается
+    не больше max_concurrency обновлений — сверх лимита запрос ждёт свободного места,
+    и Telegram сам притормаживает отправку.
+    """
+
+    def __init__(self, dp: Dispatcher, bot: Bot, secret: Optional[str] = None, max_concurrency: int = 100):
+        self.dp = dp
+        self.bot = bot
+        self.secret = secret
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        self.tasks: Set[asyncio.Task] = set()
+
+    async def handle(self, request: web.Request) -> web.Response:
+        if self.secret and not secrets.compare_digest(request.headers.get(SECRET_HEADER, ""), self.secret):
+            return web.Response(status=401)
+        try:
+            payload = await request.json()
+            update = Update.model_validate(payload, context={"bot": self.bot})
+        except Exception:
+            logger.warning("Bad webhook payload")
+            return web.Response(status=400)
+
+        await self.semaphore.acquire()
+        task = asyncio.create_task(self._process(update))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return web.Response()
+
+    async def _process(self, update: Update) -> None:
+        try:
+            await self.dp.feed_update(self.bot, update)
+        except Exception:
+            logger.exception("Failed to process update %s", update.update_id)
+        finally:
+            self.semaphore.release()
+
+    async def drain(self) -> None:
+        """Дождаться обработки уже принятых обновлений."""
+        if self.tasks:
+            await asyncio.gather(*self.tasks, return_exceptions=True)
+
+
+def create_app(dp: Dispatcher, bot: Bot, path: str, secret: Optional[str] = None, max_concurrency: int = 100) -> web.Application:
+    handler = WebhookHandler(dp, bot, secret=secret, max_concurrency=max_concurrency)
+    app = web.Application()
+    app["webhook_handler"] = handler
+    app.router.add_post(path, handler.handle)
+
+    async def on_cleanup(app: web.Application) -> None:
+        await handler.drain()
+
+    app.on_cleanup.append(on_cleanup)
+    return app
+
+
+async def run_webhook(dp: Dispatcher, bot: Bot, settings) -> None:
+    """Регистрирует webhook в Telegram и держит aiohttp-сервер, пока задачу не отменят."""
+    app = create_app(
+        dp,
+        bot,
+        path=settings.webhook_path,
+        secret=settings.webhook_secret,
+        max_concurrency=settings.webhook_concurrency,
+    )
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, host=settings.webhook_host, port=settings.webhook_port)
+    await site.start()
+    await bot.set_webhook(
+        settings.webhook_url.rstrip("/") + settings.webhook_path,
+        secret_token=settings.webhook_secret,
+        drop_pending_updates=True,
+    )
+    logger.info("Webhook server listening on %s:%s%s", settings.webhook_host, settings.webhook_port, settings.webhook_path)
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+
+
+async def start_metrics_server(render: Callable[[], str], host: str, port: int) -> web.AppRunner:
+    """Отдельный HTTP-сервер с GET /metrics в текстовом формате Prometheus."""
+
+    async def handle(request: web.Request) -> web.Response:
+        return web.Response(text=render(), content_type="text/plain", charset="utf-8")
+
+    app = web.Application()
+    app.router.add_get("/metrics", handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host=host, port=port).start()
+    logger.info("Metrics server listening on %s:%s/metrics", host, port)
+    return runner